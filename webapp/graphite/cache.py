@@ -0,0 +1,289 @@
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+from django.conf import settings
+from django.core.cache import cache
+from graphite.compat import HttpResponse
+from graphite.logger import log
+from graphite.util import unpickle
+
+
+# Every payload starts with a one byte marker describing how it was stored
+RAW = 'r'
+COMPRESSED = 'z'
+CHUNKED = 'c'
+
+# Seconds between two logs of the hit and miss counters of a TieredCache
+STATS_LOG_INTERVAL = 60
+
+
+class CompactCache(object):
+  """Stores byte string payloads in a Django cache backend.
+
+  Payloads larger than CACHE_COMPRESSION_THRESHOLD are zlib compressed and
+  payloads that are still larger than CACHE_CHUNK_SIZE are split over several
+  cache entries so they fit within memcached's item size limit."""
+  __slots__ = ('backend',)
+
+  def __init__(self, backend=None):
+    self.backend = backend
+
+  def _backend(self):
+    return cache if self.backend is None else self.backend
+
+  def get(self, key):
+    """Returns the payload stored under key, or None. Entries that were not
+    stored by a CompactCache, such as the pickled responses and series
+    cached by previous releases, are treated as missing."""
+    backend = self._backend()
+    head = backend.get(key)
+    if not head or not isinstance(head, str):
+      return None
+
+    marker, body = head[0], head[1:]
+    if marker == CHUNKED:
+      count, sep, digest = body.partition(':')
+      if not (sep and count.isdigit()):
+        log.cache("CompactCache ignoring unknown entry for [%s]" % key)
+        return None
+      chunk_keys = [chunk_key(key, digest, i) for i in xrange(int(count))]
+      chunks = backend.get_many(chunk_keys)
+      if len(chunks) != len(chunk_keys) or not all(isinstance(chunk, str) for chunk in chunks.values()):
+        log.cache("CompactCache missing chunks for [%s]" % key)
+        return None
+      head = ''.join(chunks[k] for k in chunk_keys)
+      marker, body = head[:1], head[1:]
+
+    if marker == COMPRESSED:
+      try:
+        return zlib.decompress(body)
+      except zlib.error:
+        log.cache("CompactCache failed to decompress [%s]" % key)
+        return None
+    if marker == RAW:
+      return body
+    log.cache("CompactCache ignoring unknown entry for [%s]" % key)
+    return None
+
+  def set(self, key, payload, timeout):
+    return self._store(key, payload, timeout, add=False)
+
+  def add(self, key, payload, timeout):
+    return self._store(key, payload, timeout, add=True)
+
+  def _store(self, key, payload, timeout, add):
+    backend = self._backend()
+    threshold = settings.CACHE_COMPRESSION_THRESHOLD
+    if threshold and len(payload) > threshold:
+      framed = COMPRESSED + zlib.compress(payload)
+    else:
+      framed = RAW + payload
+
+    chunk_size = settings.CACHE_CHUNK_SIZE
+    if chunk_size and len(framed) > chunk_size:
+      digest = md5(framed).hexdigest()
+      chunks = {}
+      for i, offset in enumerate(xrange(0, len(framed), chunk_size)):
+        chunks[chunk_key(key, digest, i)] = framed[offset:offset + chunk_size]
+      backend.set_many(chunks, timeout)
+      framed = '%s%d:%s' % (CHUNKED, len(chunks), digest)
+
+    if add:
+      return backend.add(key, framed, timeout)
+    backend.set(key, framed, timeout)
+    return True
+
+
+class LRUCache(object):
+  """A thread-safe, size-bounded in-process cache with per-entry expiry.
+
+  With max_bytes, the byte strings it holds are also kept below that many
+  bytes in total (other values count as empty) and larger ones aren't kept."""
+  __slots__ = ('max_entries', 'max_bytes', 'size', 'entries', 'lock')
+
+  def __init__(self, max_entries, max_bytes=None):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.entries = OrderedDict()
+    self.lock = Lock()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key, default=None):
+    with self.lock:
+      try:
+        (expires, value) = self.entries.pop(key)
+      except KeyError:
+        return default
+
+      if expires is not None and expires <= time.time():
+        self.size -= payload_size(value)
+        return default
+
+      # Re-inserting moves the entry to the most recently used end
+      self.entries[key] = (expires, value)
+      return value
+
+  def set(self, key, value, timeout=None):
+    expires = None if timeout is None else time.time() + timeout
+    size = payload_size(value)
+    with self.lock:
+      self._pop(key)
+      if self.max_bytes and size > self.max_bytes:
+        return
+      self.entries[key] = (expires, value)
+      self.size += size
+      while len(self.entries) > self.max_entries or \
+            (self.max_bytes and self.size > self.max_bytes):
+        (key, (expires, value)) = self.entries.popitem(last=False)
+        self.size -= payload_size(value)
+
+  def _pop(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.size -= payload_size(entry[1])
+
+  def delete(self, key):
+    with self.lock:
+      self._pop(key)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+
+def payload_size(value):
+  return len(value) if isinstance(value, str) else 0
+
+
+class TieredCache(object):
+  """Puts an optional in-process LRUCache in front of a shared cache backend.
+
+  The local tier is enabled by LOCAL_CACHE_MAX_ENTRIES, holds at most
+  LOCAL_CACHE_MAX_BYTES of payloads and keeps entries for at most
+  LOCAL_CACHE_DURATION seconds so that processes don't drift far from what
+  the shared backend holds. The hits and misses of each tier are logged to
+  the cache log every STATS_LOG_INTERVAL seconds."""
+
+  def __init__(self, name, backend=None):
+    self.name = name
+    self.backend = backend
+    self.local = None
+    self.lock = Lock()
+    self.counters = {
+      'local': {'hits': 0, 'misses': 0},
+      'remote': {'hits': 0, 'misses': 0},
+    }
+    self.stats_logged = time.time()
+
+  def _backend(self):
+    return cache if self.backend is None else self.backend
+
+  def _local(self):
+    limits = (settings.LOCAL_CACHE_MAX_ENTRIES, settings.LOCAL_CACHE_MAX_BYTES)
+    if not limits[0]:
+      return None
+    if self.local is None or (self.local.max_entries, self.local.max_bytes) != limits:
+      with self.lock:
+        if self.local is None or (self.local.max_entries, self.local.max_bytes) != limits:
+          self.local = LRUCache(*limits)
+    return self.local
+
+  def _count(self, tier, outcome):
+    now = time.time()
+    with self.lock:
+      self.counters[tier][outcome] += 1
+      if now - self.stats_logged < STATS_LOG_INTERVAL:
+        return
+      self.stats_logged = now
+    log.cache("TieredCache %s stats: %s" % (self.name, self.stats()))
+
+  def _local_timeout(self, timeout):
+    if timeout is None:
+      return settings.LOCAL_CACHE_DURATION
+    return min(timeout, settings.LOCAL_CACHE_DURATION)
+
+  def get(self, key):
+    local = self._local()
+    if local is not None:
+      value = local.get(key)
+      if value is not None:
+        self._count('local', 'hits')
+        return value
+      self._count('local', 'misses')
+
+    value = self._backend().get(key)
+    if value is None:
+      self._count('remote', 'misses')
+      return None
+
+    self._count('remote', 'hits')
+    if local is not None:
+      local.set(key, value, settings.LOCAL_CACHE_DURATION)
+    return value
+
+  def set(self, key, value, timeout):
+    self._backend().set(key, value, timeout)
+    local = self._local()
+    if local is not None:
+      local.set(key, value, self._local_timeout(timeout))
+
+  def add(self, key, value, timeout):
+    added = self._backend().add(key, value, timeout)
+    local = self._local()
+    if added and local is not None:
+      local.set(key, value, self._local_timeout(timeout))
+    return added
+
+  def stats(self):
+    with self.lock:
+      return dict((tier, dict(counts)) for (tier, counts) in self.counters.items())
+
+
+def chunk_key(key, digest, index):
+  return '%s:%s:%d' % (key, digest[:12], index)
+
+
+def encode_response(response):
+  headers = list(response.items())
+  return pickle.dumps((response.status_code, headers, response.content), protocol=-1)
+
+
+def decode_response(payload):
+  (status, headers, content) = unpickle.loads(payload)
+  response = HttpResponse(content, status=status)
+  for (header, value) in headers:
+    response[header] = value
+  return response
+
+
+# The shared caches used by remote finds and the render view
+find_cache = TieredCache('find')
+data_cache = TieredCache('data', CompactCache())
+request_cache = TieredCache('request', CompactCache())
+
+
+def get_response(key):
+  payload = request_cache.get(key)
+  if payload is None:
+    return None
+  try:
+    return decode_response(payload)
+  except:
+    log.exception("Failed to decode cached response [%s]" % key)
+    return None
+
+
+def add_response(key, response, timeout):
+  return request_cache.add(key, encode_response(response), timeout)
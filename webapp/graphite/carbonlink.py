@@ -4,16 +4,24 @@ import struct
 import errno
 import random
 from select import select
+from threading import Lock
 from django.conf import settings
+from graphite.cache import LRUCache
 from graphite.render.hashing import ConsistentHashRing
 from graphite.logger import log
 from graphite.util import load_module, unpickle
+from graphite.worker_pool.pool import Job, PoolTimeoutError, get_pool, pool_exec
 
 try:
   import cPickle as pickle
 except ImportError:
   import pickle
 
+# Number of requests written to a carbon connection before reading their responses
+PIPELINE_SIZE = 1000
+# Number of metrics whose cache-query results are kept, see CARBONLINK_QUERY_CACHE_DURATION
+QUERY_CACHE_MAX_ENTRIES = 10000
+
 
 def load_keyfunc():
   if settings.CARBONLINK_HASHING_KEYFUNC:
@@ -24,6 +32,119 @@ def load_keyfunc():
     return lambda x: x
 
 
+class ConnectionPool(object):
+  """The idle connections to a carbon host, at most max_size of them, the
+  most recently used handed out first. Those idle for more than
+  idle_timeout seconds or closed by the carbon host are closed instead of
+  being handed out. Counts how the connections were used, see stats."""
+
+  def __init__(self, max_size, idle_timeout):
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    # (time put back, connection), the most recent last
+    self.idle = []
+    self.lock = Lock()
+    self.counts = dict(created=0, reused=0, expired=0, stale=0, retried=0, discarded=0)
+    self.in_use = 0
+
+  def __len__(self):
+    return len(self.idle)
+
+  def count(self, event):
+    with self.lock:
+      self.counts[event] += 1
+
+  def get(self):
+    "Returns an idle connection still connected to the host, or None"
+    while True:
+      with self.lock:
+        if not self.idle:
+          return None
+        (released, conn) = self.idle.pop()
+        if time.time() - released > self.idle_timeout:
+          # The other ones have been idle for even longer
+          expired = [conn] + [idle_conn for (_, idle_conn) in self.idle]
+          self.idle = []
+          self.counts['expired'] += len(expired)
+          for conn in expired:
+            conn.close()
+          return None
+
+      try:
+        connected = still_connected(conn)
+      except socket.error:
+        connected = False
+
+      if connected:
+        with self.lock:
+          self.counts['reused'] += 1
+          self.in_use += 1
+        return conn
+
+      self.count('stale')
+      conn.close()
+
+  def opened(self, conn):
+    "Counts a new connection to the host as in use"
+    with self.lock:
+      self.counts['created'] += 1
+      self.in_use += 1
+
+  def put(self, conn):
+    "Puts back a connection done with, closing it if the pool is full"
+    with self.lock:
+      self.in_use -= 1
+      if len(self.idle) < self.max_size:
+        self.idle.append((time.time(), conn))
+        return
+      self.counts['discarded'] += 1
+    conn.close()
+
+  def discard(self, conn):
+    "Closes a connection that can't be used anymore"
+    with self.lock:
+      self.in_use -= 1
+      self.counts['discarded'] += 1
+    conn.close()
+
+  def clear(self):
+    "Closes the idle connections"
+    with self.lock:
+      (idle, self.idle) = (self.idle, [])
+    for (_, conn) in idle:
+      conn.close()
+
+  def stats(self):
+    with self.lock:
+      return dict(self.counts, idle=len(self.idle), in_use=self.in_use)
+
+
+class InflightQuery(object):
+  """A cache query shared by the callers asking for the same metric while it
+  is being sent. The first one to call get sends it, the others wait for its
+  result."""
+
+  def __init__(self, query):
+    self.query = query
+    self.lock = Lock()
+    self.done = False
+    self.result = None
+    self.error = None
+
+  def get(self):
+    with self.lock:
+      if not self.done:
+        try:
+          self.result = self.query()
+        except Exception as e:
+          self.error = e
+        self.done = True
+
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+
 class CarbonLinkPool:
   def __init__(self, hosts, timeout):
     self.hosts = [ (server, instance) for (server, port, instance) in hosts ]
@@ -37,16 +158,28 @@ class CarbonLinkPool:
     self.keyfunc = load_keyfunc()
     self.connections = {}
     self.last_failure = {}
+    self.query_cache = LRUCache(QUERY_CACHE_MAX_ENTRIES)
+    self.inflight_queries = {}
+    self.inflight_lock = Lock()
     # Create a connection pool for each host
     for host in self.hosts:
-      self.connections[host] = set()
+      self.connections[host] = ConnectionPool(settings.CARBONLINK_POOL_SIZE,
+                                              settings.CARBONLINK_POOL_IDLE_TIMEOUT)
 
   def select_host(self, metric):
     "Returns the carbon host that has data for the given metric"
-    key = self.keyfunc(metric)
+    return self.select_hosts([metric])[0]
+
+  def select_hosts(self, metrics):
+    "Same as select_host for several metrics, looked up on the hash ring at once"
+    keys = [self.keyfunc(metric) for metric in metrics]
+    return [self.choose_host(nodes) for nodes in self.hash_ring.get_nodes_many(keys)]
+
+  def choose_host(self, ring_nodes):
+    "Picks an available host among the first REPLICATION_FACTOR servers"
     nodes = []
     servers = set()
-    for node in self.hash_ring.get_nodes(key):
+    for node in ring_nodes:
       (server, instance) = node
       if server in servers:
         continue
@@ -64,30 +197,100 @@ class CarbonLinkPool:
     return (now - last_fail) < settings.CARBONLINK_RETRY_DELAY
 
   def get_connection(self, host):
-    # First try to take one out of the pool for this host
+    """Returns an idle connection to host from its pool, or a new one, and
+    whether it was pooled. Raises when host can't be connected to."""
+    conn = self.connections[host].get()
+    if conn is not None:
+      return (conn, True)
+    return (self.connect(host), False)
+
+  def connect(self, host):
     (server, instance) = host
     port = self.ports[host]
-    connectionPool = self.connections[host]
-    try:
-      return connectionPool.pop()
-    except KeyError:
-      pass #nothing left in the pool, gotta make a new connection
-
     log.cache("CarbonLink creating a new socket for %s" % str(host))
     connection = socket.socket()
     connection.settimeout(self.timeout)
     try:
       connection.connect( (server, port) )
     except:
+      connection.close()
       self.last_failure[host] = time.time()
       raise
-    else:
-      connection.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
-      return connection
+    connection.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
+    self.connections[host].opened(connection)
+    return connection
+
+  def exchange(self, host, conn, reused, packet, count=1):
+    """Sends packet, made of count requests, down conn, a connection to host
+    from get_connection, and returns the responses to them. The connection
+    is put back in the pool of host once done.
+
+    When a pooled connection turns out to have been closed by the carbon
+    host before answering, the requests are sent again once on a new
+    connection, which does not count as a failure of the host. Any other
+    error does, and is raised."""
+    pool = self.connections[host]
+    responses = []
+
+    while True:
+      try:
+        conn.sendall(packet)
+        while len(responses) < count:
+          responses.append(self.recv_response(conn))
+      except Exception as e:
+        pool.discard(conn)
+        if not (reused and not responses and not isinstance(e, socket.timeout)):
+          self.last_failure[host] = time.time()
+          raise
+        log.cache("CarbonLink pooled connection to %s was closed, using a new one: %s" % (str(host), e))
+        pool.count('retried')
+      else:
+        pool.put(conn)
+        return responses
+
+      (conn, reused) = (self.connect(host), False)
+
+  def stats(self):
+    "The connection counts of every host, see ConnectionPool"
+    return dict((host, pool.stats()) for (host, pool) in self.connections.items())
 
   def query(self, metric):
+    """Returns the datapoints of metric in carbon's cache. With
+    CARBONLINK_QUERY_CACHE_DURATION set, they are kept for that many seconds,
+    and the callers querying the same metric at once share a single query."""
+    if not settings.CARBONLINK_QUERY_CACHE_DURATION:
+      return self.send_query(metric)
+
+    datapoints = self.query_cache.get(metric)
+    if datapoints is not None:
+      return datapoints
+
+    with self.inflight_lock:
+      # The query may have completed in the meantime
+      datapoints = self.query_cache.get(metric)
+      if datapoints is not None:
+        return datapoints
+      if metric not in self.inflight_queries:
+        self.inflight_queries[metric] = InflightQuery(lambda: self.send_cached_query(metric))
+      inflight_query = self.inflight_queries[metric]
+
+    return inflight_query.get()
+
+  def send_cached_query(self, metric):
+    "Sends a cache query, caching its datapoints unless a host failed to answer"
+    try:
+      failures = []
+      datapoints = self.send_query(metric, failures)
+      if not failures:
+        self.query_cache.set(metric, datapoints, settings.CARBONLINK_QUERY_CACHE_DURATION)
+      return datapoints
+    finally:
+      with self.inflight_lock:
+        del self.inflight_queries[metric]
+
+  def send_query(self, metric, failures=None):
     request = dict(type='cache-query', metric=metric)
-    results = self.send_request(request)
+    results = self.send_request(request, failures)
     log.cache("CarbonLink cache-query request for %s returned %d datapoints" % (metric, len(results['datapoints'])))
     return results['datapoints']
 
@@ -103,68 +306,179 @@ class CarbonLinkPool:
     log.cache("CarbonLink set-metadata request received for %s:%s" % (metric, key))
     return results
 
-  def send_request(self, request):
+  def get_metadata_many(self, metrics, key):
+    """Same as get_metadata for several metrics at once, see send_requests.
+    Returns the values in the order of metrics, or the exceptions raised for
+    them."""
+    requests = [dict(type='get-metadata', metric=metric, key=key) for metric in metrics]
+    results = self.send_requests(requests)
+    log.cache("CarbonLink get-metadata requests received for %d metrics:%s" % (len(metrics), key))
+    values = []
+    for result in results:
+      if not isinstance(result, Exception):
+        try:
+          result = result['value']
+        except KeyError as e:
+          result = e
+      values.append(result)
+    return values
+
+  def set_metadata_many(self, operations):
+    """Same as set_metadata for several (metric, key, value) operations at
+    once, see send_requests. Returns the results in the order of operations,
+    or the exceptions raised for them."""
+    requests = [dict(type='set-metadata', metric=metric, key=key, value=value)
+                for (metric, key, value) in operations]
+    results = self.send_requests(requests)
+    log.cache("CarbonLink set-metadata requests received for %d metrics" % len(operations))
+    return results
+
+  def send_request(self, request, failures=None):
+    """Sends a request to the host of its metric, or to every host for carbon
+    metrics. Errors sending the request or receiving its response are logged
+    and an empty result is returned, the hosts that failed are appended to
+    failures when it is given."""
     metric = request['metric']
-    serialized_request = pickle.dumps(request, protocol=-1)
-    len_prefix = struct.pack("!L", len(serialized_request))
-    request_packet = len_prefix + serialized_request
+    request_packet = make_request_packet(request)
     result = {}
     result.setdefault('datapoints', [])
 
     if metric.startswith(settings.CARBON_METRIC_PREFIX):
-      return self.send_request_to_all(request)
+      return self.send_request_to_all(request, failures)
 
     if not self.hosts:
       log.cache("CarbonLink is not connected to any host. Returning empty nodes list")
       return result
 
     host = self.select_host(metric)
-    conn = self.get_connection(host)
+    (conn, reused) = self.get_connection(host)
     log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
     try:
-      conn.sendall(request_packet)
-      result = self.recv_response(conn)
+      (result,) = self.exchange(host, conn, reused, request_packet)
     except Exception,e:
-      self.last_failure[host] = time.time()
       log.cache("Exception getting data from cache %s: %s" % (str(host), e))
+      if failures is not None:
+        failures.append(host)
     else:
-      self.connections[host].add(conn)
       if 'error' in result:
         log.cache("Error getting data from cache: %s" % result['error'])
         raise CarbonLinkRequestError(result['error'])
       log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
     return result
 
-  def send_request_to_all(self, request):
+  def send_request_to_all(self, request, failures=None):
+    """Sends a request to every host concurrently, merging their datapoints
+    as they arrive. The hosts that did not answer within the timeout, on
+    top of the timeout of each socket operation, are left out, and so are
+    those that failed: see send_request for failures."""
     metric = request['metric']
-    serialized_request = pickle.dumps(request, protocol=-1)
-    len_prefix = struct.pack("!L", len(serialized_request))
-    request_packet = len_prefix + serialized_request
+    request_packet = make_request_packet(request)
     results = {}
     results.setdefault('datapoints', {})
 
-    for host in self.hosts:
-      conn = self.get_connection(host)
-      log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
-      try:
-        conn.sendall(request_packet)
-        result = self.recv_response(conn)
-      except Exception,e:
-        self.last_failure[host] = time.time()
-        log.cache("Exception getting data from cache %s: %s" % (str(host), e))
-      else:
-        self.connections[host].add(conn)
+    jobs = [Job(self.send_request_to_host, "CarbonLink request for %s to %s" % (metric, str(host)),
+                host, metric, request_packet)
+            for host in self.hosts]
+    answered = set()
+    try:
+      for job in pool_exec(get_pool('carbonlink', len(self.hosts)), jobs, self.timeout):
+        (host, result) = job.get_result()
+        answered.add(host)
+        if result is None:
+          if failures is not None:
+            failures.append(host)
+          continue
         if 'error' in result:
           log.cache("Error getting data from cache %s: %s" % (str(host), result['error']))
+          if failures is not None:
+            failures.append(host)
         else:
           if len(result['datapoints']) > 1:
               results['datapoints'].update(result['datapoints'])
-      log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
+    except PoolTimeoutError as e:
+      log.cache("CarbonLink request for %s left hosts out: %s" % (metric, e))
+      if failures is not None:
+        failures.extend(host for host in self.hosts if host not in answered)
+    return results
+
+  def send_request_to_host(self, host, metric, request_packet):
+    "Returns host along with its response to a request, or None if it failed"
+    try:
+      (conn, reused) = self.get_connection(host)
+      log.cache("CarbonLink sending request for %s to %s" % (metric, str(host)))
+      (result,) = self.exchange(host, conn, reused, request_packet)
+    except Exception,e:
+      log.cache("Exception getting data from cache %s: %s" % (str(host), e))
+      return (host, None)
+
+    log.cache("CarbonLink finished receiving %s from %s" % (str(metric), str(host)))
+    return (host, result)
+
+  def send_requests(self, requests):
+    """Sends several requests, returning their results in order, or the
+    exception raised for each of them.
+
+    The requests are grouped by the carbon host their metric is sent to.
+    Each group is pipelined down a single connection, and the hosts are
+    sent their groups concurrently."""
+    results = [None] * len(requests)
+    hashed = []
+
+    for (index, request) in enumerate(requests):
+      metric = request['metric']
+      if metric.startswith(settings.CARBON_METRIC_PREFIX) or not self.hosts:
+        try:
+          results[index] = self.send_request(request)
+        except Exception as e:
+          results[index] = e
+      else:
+        hashed.append(index)
+
+    indexes_by_host = {}
+    hosts = self.select_hosts([requests[index]['metric'] for index in hashed])
+    for (index, host) in zip(hashed, hosts):
+      indexes_by_host.setdefault(host, []).append(index)
+
+    jobs = {}
+    for (host, indexes) in indexes_by_host.items():
+      job = Job(self.send_pipelined_requests, "CarbonLink requests to %s" % str(host),
+                host, [requests[index] for index in indexes])
+      jobs[job] = indexes
+
+    for job in pool_exec(get_pool('carbonlink', len(self.hosts)), jobs.keys()):
+      for (index, result) in zip(jobs[job], job.get_result()):
+        results[index] = result
+    return results
+
+  def send_pipelined_requests(self, host, requests):
+    """Sends requests to a single host, PIPELINE_SIZE at a time before
+    reading their responses. Returns their results, or the exception raised
+    for each of them."""
+    results = []
+    log.cache("CarbonLink sending %d requests to %s" % (len(requests), str(host)))
+    for start in xrange(0, len(requests), PIPELINE_SIZE):
+      batch = requests[start:start + PIPELINE_SIZE]
+      try:
+        (conn, reused) = self.get_connection(host)
+        responses = self.exchange(host, conn, reused,
+                                  ''.join(make_request_packet(request) for request in batch), len(batch))
+      except Exception as e:
+        log.cache("Exception getting data from cache %s: %s" % (str(host), e))
+        results.extend([e] * (len(requests) - len(results)))
+        return results
+
+      for result in responses:
+        if 'error' in result:
+          log.cache("Error getting data from cache %s: %s" % (str(host), result['error']))
+          result = CarbonLinkRequestError(result['error'])
+        results.append(result)
+
+    log.cache("CarbonLink finished receiving %d responses from %s" % (len(requests), str(host)))
     return results
 
   def recv_response(self, conn):
     len_prefix = recv_exactly(conn, 4)
-    body_size = struct.unpack("!L", len_prefix)[0]
+    body_size = struct.unpack_from("!L", len_prefix)[0]
     body = recv_exactly(conn, body_size)
     return unpickle.loads(body)
 
@@ -173,6 +487,12 @@ class CarbonLinkRequestError(Exception):
   pass
 
 
+def make_request_packet(request):
+  serialized_request = pickle.dumps(request, protocol=-1)
+  len_prefix = struct.pack("!L", len(serialized_request))
+  return len_prefix + serialized_request
+
+
 # Socket helper functions
 def still_connected(sock):
   is_readable = select([sock], [], [], 0)[0]
@@ -194,12 +514,16 @@ def still_connected(sock):
 
 
 def recv_exactly(conn, num_bytes):
-  buf = ''
-  while len(buf) < num_bytes:
-    data = conn.recv( num_bytes - len(buf) )
-    if not data:
+  """Receives num_bytes from a socket straight into a bytearray allocated
+  once, which is returned as is: it can be unpickled without a copy"""
+  buf = bytearray(num_bytes)
+  view = memoryview(buf)
+  received = 0
+  while received < num_bytes:
+    count = conn.recv_into(view[received:], num_bytes - received)
+    if not count:
       raise Exception("Connection lost")
-    buf += data
+    received += count
 
   return buf
 
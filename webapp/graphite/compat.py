@@ -5,6 +5,12 @@ from django.core.serializers.json import DjangoJSONEncoder
 from django.http import (HttpResponse as BaseHttpResponse,
                          HttpResponseBadRequest as Base400)
 
+try:
+    from django.http import StreamingHttpResponse as BaseStreamingHttpResponse
+except ImportError:
+    # Django < 1.5 sends the iterators given to HttpResponse as they go
+    BaseStreamingHttpResponse = BaseHttpResponse
+
 
 class ContentTypeMixin(object):
     def __init__(self, *args, **kwargs):
@@ -21,6 +27,10 @@ class HttpResponseBadRequest(ContentTypeMixin, Base400):
     pass
 
 
+class StreamingHttpResponse(ContentTypeMixin, BaseStreamingHttpResponse):
+    pass
+
+
 class JsonResponse(HttpResponse):
     # Django < 1.7 does not have JsonResponse
     # https://github.com/django/django/commit/024213
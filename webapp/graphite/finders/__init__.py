@@ -1,9 +1,14 @@
-import fnmatch
 import os.path
 import re
 
+from graphite.cache import LRUCache
+from graphite.util import path_key
+
 EXPAND_BRACES_RE = re.compile(r'.*(\{.*?[^\\]?\})')
 
+# Compiled regular expressions of the most recently matched patterns
+PATTERN_CACHE = LRUCache(1000)
+
 def get_real_metric_path(absolute_path, metric_path):
   # Support symbolic links (real_metric_path ensures proper cache queries)
   real_fs_path = os.path.realpath(absolute_path)
@@ -23,6 +28,37 @@ def fs_to_metric(path):
   return os.path.join(dirpath, filename.split('.')[0]).replace(os.sep,'.')
 
 
+def limit_nodes(nodes, query):
+  """Yields the nodes after query.cursor, up to query.limit distinct paths.
+  Nodes yielded in path order, after the cursor, are the first page of
+  results so the search can stop there."""
+  after = None if query.cursor is None else path_key(query.cursor)
+  paths = set()
+
+  for node in nodes:
+    if after is not None and path_key(node.path) <= after:
+      continue
+    if node.path not in paths:
+      if query.limit and len(paths) == query.limit:
+        return
+      paths.add(node.path)
+    yield node
+
+
+def list_directory(path, listings=None, lister=None):
+  """Returns lister(path), os.listdir by default, reusing the listing of the
+  directory when the listings of the request (see FindQuery) already hold
+  it. The listing is shared, it must not be modified."""
+  lister = lister or os.listdir
+  if listings is None:
+    return lister(path)
+  key = (lister, path)
+  entries = listings.get(key)
+  if entries is None:
+    entries = listings[key] = lister(path)
+  return entries
+
+
 def _deduplicate(entries):
   yielded = set()
   for entry in entries:
@@ -44,13 +80,96 @@ def extract_variants(pattern):
 
 
 def match_entries(entries, pattern):
-  # First we check for pattern variants (ie. {foo,bar}baz = foobaz or barbaz)
-  matching = []
-
-  for variant in expand_braces(pattern):
-    matching.extend(fnmatch.filter(entries, variant))
-
-  return list(_deduplicate(matching))
+  """Returns the entries matching a glob pattern, which may contain brace
+  variants (ie. {foo,bar}baz = foobaz or barbaz)."""
+  match = compile_pattern(pattern).match
+  return list(_deduplicate(entry for entry in entries if match(entry)))
+
+
+def compile_pattern(pattern):
+  regex = PATTERN_CACHE.get(pattern)
+  if regex is None:
+    regex = re.compile(translate_pattern(pattern) + r'\Z', re.DOTALL)
+    PATTERN_CACHE.set(pattern, regex)
+  return regex
+
+
+def translate_pattern(pattern):
+  """Translates a glob pattern with brace variants into a regular expression
+  matching the same entries as fnmatch over every expand_braces variant."""
+  regex = _translate_braces(pattern)
+  if regex is None:
+    # Nested, escaped or unbalanced braces and character classes keep the
+    # exact expand_braces semantics
+    variants = sorted(expand_braces(pattern))
+    regex = '(?:%s)' % '|'.join(_translate_glob(v) for v in variants)
+  return regex
+
+
+def _translate_braces(pattern):
+  if '[' in pattern or '\\' in pattern:
+    return None
+
+  regex = []
+  variant = []
+  variants = None
+  for c in pattern:
+    if c == '{':
+      if variants is not None:
+        return None
+      variants = []
+    elif c == '}':
+      if variants is None:
+        return None
+      variants.append(_translate_glob(''.join(variant)))
+      regex.append('(?:%s)' % '|'.join(variants))
+      variant = []
+      variants = None
+    elif c == ',' and variants is not None:
+      variants.append(_translate_glob(''.join(variant)))
+      variant = []
+    elif variants is not None:
+      variant.append(c)
+    else:
+      regex.append(_translate_glob(c))
+
+  if variants is not None:
+    return None
+  return ''.join(regex)
+
+
+def _translate_glob(pattern):
+  "Same as fnmatch.translate, without the end anchor"
+  i, n = 0, len(pattern)
+  res = []
+  while i < n:
+    c = pattern[i]
+    i += 1
+    if c == '*':
+      res.append('.*')
+    elif c == '?':
+      res.append('.')
+    elif c == '[':
+      j = i
+      if j < n and pattern[j] == '!':
+        j += 1
+      if j < n and pattern[j] == ']':
+        j += 1
+      while j < n and pattern[j] != ']':
+        j += 1
+      if j >= n:
+        res.append('\\[')
+      else:
+        stuff = pattern[i:j].replace('\\', '\\\\')
+        i = j + 1
+        if stuff[0] == '!':
+          stuff = '^' + stuff[1:]
+        elif stuff[0] == '^':
+          stuff = '\\' + stuff
+        res.append('[%s]' % stuff)
+    else:
+      res.append(re.escape(c))
+  return ''.join(res)
 
 
 """
@@ -1,37 +1,83 @@
 from __future__ import absolute_import
 
+import os
 import os.path
 
-from glob import glob
 from ceres import CeresTree, CeresNode
 from django.conf import settings
 from graphite.node import BranchNode, LeafNode
-from graphite.readers import CeresReader
+from graphite.readers import CeresReader, get_slice_info
+from graphite.util import is_pattern
 
-from . import get_real_metric_path, extract_variants
+from . import get_real_metric_path, expand_braces, limit_nodes, list_directory, match_entries
 
 
 class CeresFinder:
+  # Every path is a single node directory, found in path order
+  ordered_nodes = True
+
   def __init__(self, directory=None):
     directory = directory or settings.CERES_DIR
     self.directory = directory
     self.tree = CeresTree(directory)
 
   def find_nodes(self, query):
+    # Paths are found in path order, so the search stops at query.limit paths
+    return limit_nodes(self._find_nodes(query), query)
+
+  def _find_nodes(self, query):
+    for fs_path in self._find_paths(self.tree.root, query.pattern.split('.'), query.listings):
+      metric_path = self.tree.getNodePath(fs_path)
+
+      if CeresNode.isNodeDir(fs_path):
+        ceres_node = self.tree.getNode(metric_path)
+
+        if has_data_for_interval(get_slice_info(ceres_node), query.startTime, query.endTime):
+          real_metric_path = get_real_metric_path(fs_path, metric_path)
+          reader = CeresReader(ceres_node, real_metric_path)
+          yield LeafNode(metric_path, reader)
+
+      elif not query.leaves_only and os.path.isdir(fs_path):
+        yield BranchNode(metric_path)
+
+  def _find_paths(self, current_dir, patterns, listings=None):
+    """Walks the pattern one level at a time, in path order. Each directory
+    is listed at most once, whatever the number of brace variants in the
+    pattern, and parts without wildcards are looked up directly."""
+    pattern = patterns[0]
+    patterns = patterns[1:]
 
-    variants = extract_variants(query.pattern)
+    if not is_pattern(pattern):
+      names = [pattern]
+    elif '*' in pattern or '?' in pattern or '[' in pattern:
+      try:
+        entries = list_directory(current_dir, listings)
+      except OSError:
+        return
+      if not pattern.startswith('.'):
+        entries = [e for e in entries if not e.startswith('.')]
+      names = sorted(match_entries(entries, pattern))
+    else:
+      names = sorted(expand_braces(pattern))
 
-    for variant in variants:
-      for fs_path in glob( self.tree.getFilesystemPath(variant)):
-        metric_path = self.tree.getNodePath(fs_path)
+    for name in names:
+      if not name:
+        continue
+      path = os.path.join(current_dir, name)
+      if patterns:
+        if os.path.isdir(path):
+          for match in self._find_paths(path, patterns, listings):
+            yield match
+      elif os.path.lexists(path):
+        yield path
 
-        if CeresNode.isNodeDir(fs_path):
-          ceres_node = self.tree.getNode(metric_path)
 
-          if ceres_node.hasDataForInterval(query.startTime, query.endTime):
-            real_metric_path = get_real_metric_path(fs_path, metric_path)
-            reader = CeresReader(ceres_node, real_metric_path)
-            yield LeafNode(metric_path, reader)
+def has_data_for_interval(slice_info, start_time, end_time):
+  "Same as CeresNode.hasDataForInterval, from already read slice info"
+  if not slice_info:
+    return False
 
-        elif os.path.isdir(fs_path):
-          yield BranchNode(metric_path)
+  earliest = min(start for (start, end, step) in slice_info)
+  latest = max(end for (start, end, step) in slice_info)
+  return (start_time is None or start_time < latest) and \
+         (end_time is None or end_time > earliest)
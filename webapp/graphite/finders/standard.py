@@ -1,122 +1,283 @@
+import heapq
 import os
-import operator
-from os.path import isdir, isfile, join, basename
+from os.path import isdir, isfile, islink, join, basename
 from django.conf import settings
 
 from graphite.logger import log
 from graphite.node import BranchNode, LeafNode
 from graphite.readers import WhisperReader, GzippedWhisperReader, RRDReader
-from graphite.util import find_escaped_pattern_fields
+from graphite.util import find_escaped_pattern_fields, path_key
 
-from . import fs_to_metric, get_real_metric_path, match_entries
+from . import compile_pattern, fs_to_metric, get_real_metric_path, limit_nodes, list_directory, match_entries
+
+try:
+  from scandir import scandir
+except ImportError:
+  scandir = None
+
+METRIC_EXTENSIONS = ('.wsp', '.wsp.gz', '.rrd')
 
 
 class StandardFinder:
   DATASOURCE_DELIMITER = '::RRD_DATASOURCE::'
+  # The nodes of a path found in several directories are yielded together
+  ordered_nodes = True
 
   def __init__(self, directories=None):
     directories = directories or settings.STANDARD_DIRS
     self.directories = directories
 
   def find_nodes(self, query):
+    # Each directory is walked in path order, so it can stop at query.limit
+    # paths, and the walks are merged lazily for the nodes found first to be
+    # fetched while the search goes on. The nodes of a path found in several
+    # directories are yielded together, in the order of the directories.
+    streams = [sort_keyed(index, limit_nodes(self._find_nodes_in(root_dir, query), query))
+               for (index, root_dir) in enumerate(self.directories)]
+    for (key, node) in heapq.merge(*streams):
+      yield node
+
+  def _find_nodes_in(self, root_dir, query):
     clean_pattern = query.pattern.replace('\\', '')
     pattern_parts = clean_pattern.split('.')
 
-    for root_dir in self.directories:
-      for absolute_path in self._find_paths(root_dir, pattern_parts):
-        if basename(absolute_path).startswith('.'):
-          continue
+    if '**' in pattern_parts:
+      paths = self._find_globstar_paths(root_dir, pattern_parts, query.listings, query.leaves_only)
+    else:
+      after = None
+      if query.cursor is not None and not any(find_escaped_pattern_fields(query.pattern)):
+        after = path_key(query.cursor)
+        if len(after) != len(pattern_parts):
+          after = None
+      paths = self._find_paths(root_dir, pattern_parts, after, query.listings, query.leaves_only)
+
+    for absolute_path in paths:
+      if basename(absolute_path).startswith('.'):
+        continue
 
-        if self.DATASOURCE_DELIMITER in basename(absolute_path):
-          (absolute_path, datasource_pattern) = absolute_path.rsplit(self.DATASOURCE_DELIMITER, 1)
-        else:
-          datasource_pattern = None
+      if self.DATASOURCE_DELIMITER in basename(absolute_path):
+        (absolute_path, datasource_pattern) = absolute_path.rsplit(self.DATASOURCE_DELIMITER, 1)
+      else:
+        datasource_pattern = None
 
-        relative_path = absolute_path[ len(root_dir): ].lstrip('/')
-        metric_path = fs_to_metric(relative_path)
-        real_metric_path = get_real_metric_path(absolute_path, metric_path)
+      relative_path = absolute_path[ len(root_dir): ].lstrip('/')
+      metric_path = fs_to_metric(relative_path)
+      real_metric_path = get_real_metric_path(absolute_path, metric_path)
 
-        metric_path_parts = metric_path.split('.')
-        for field_index in find_escaped_pattern_fields(query.pattern):
-          metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
-        metric_path = '.'.join(metric_path_parts)
+      metric_path_parts = metric_path.split('.')
+      for field_index in find_escaped_pattern_fields(query.pattern):
+        metric_path_parts[field_index] = pattern_parts[field_index].replace('\\', '')
+      metric_path = '.'.join(metric_path_parts)
 
-        # Now we construct and yield an appropriate Node object
-        if isdir(absolute_path):
-          yield BranchNode(metric_path)
+      # Now we construct and yield an appropriate Node object
+      if isdir(absolute_path):
+        yield BranchNode(metric_path)
 
-        elif isfile(absolute_path):
-          if absolute_path.endswith('.wsp') and WhisperReader.supported:
-            reader = WhisperReader(absolute_path, real_metric_path)
-            yield LeafNode(metric_path, reader)
+      elif isfile(absolute_path):
+        if absolute_path.endswith('.wsp') and WhisperReader.supported:
+          reader = WhisperReader(absolute_path, real_metric_path)
+          yield LeafNode(metric_path, reader)
 
-          elif absolute_path.endswith('.wsp.gz') and GzippedWhisperReader.supported:
-            reader = GzippedWhisperReader(absolute_path, real_metric_path)
-            yield LeafNode(metric_path, reader)
+        elif absolute_path.endswith('.wsp.gz') and GzippedWhisperReader.supported:
+          reader = GzippedWhisperReader(absolute_path, real_metric_path)
+          yield LeafNode(metric_path, reader)
 
-          elif absolute_path.endswith('.rrd') and RRDReader.supported:
-            if datasource_pattern is None:
+        elif absolute_path.endswith('.rrd') and RRDReader.supported:
+          if datasource_pattern is None:
+            if not query.leaves_only:
               yield BranchNode(metric_path)
 
-            else:
-              for datasource_name in RRDReader.get_datasources(absolute_path):
-                if match_entries([datasource_name], datasource_pattern):
-                  reader = RRDReader(absolute_path, datasource_name)
-                  yield LeafNode(metric_path + "." + datasource_name, reader)
+          else:
+            for datasource_name in sorted(RRDReader.get_datasources(absolute_path)):
+              if match_entries([datasource_name], datasource_pattern):
+                reader = RRDReader(absolute_path, datasource_name)
+                yield LeafNode(metric_path + "." + datasource_name, reader)
 
-  def _find_paths(self, current_dir, patterns):
+  def _find_paths(self, current_dir, patterns, after=None, listings=None, leaves_only=False):
     """Recursively generates absolute paths whose components underneath current_dir
-    match the corresponding pattern in patterns"""
+    match the corresponding pattern in patterns, in path order. Entries sorting
+    before the corresponding node of the after path are skipped, and so are
+    the matching directories with leaves_only."""
     pattern = patterns[0]
     patterns = patterns[1:]
 
-    has_wildcard = pattern.find('{') > -1 or pattern.find('[') > -1 or pattern.find('*') > -1 or pattern.find('?') > -1
-    using_globstar = pattern == "**"
+    has_wildcard = is_wildcard(pattern)
 
     if has_wildcard: # this avoids os.listdir() for performance
       try:
-        entries = os.listdir(current_dir)
+        entries = list(list_directory(current_dir, listings))
       except OSError as e:
         log.exception(e)
         entries = []
     else:
-      entries = [ pattern ]
+      entries = [ pattern ] + [ pattern + extension for extension in METRIC_EXTENSIONS ]
 
-    if using_globstar:
-        matching_subdirs = map(operator.itemgetter(0), os.walk(current_dir))
-    else:
-        subdirs = [entry for entry in entries if isdir(join(current_dir, entry))]
-        matching_subdirs = match_entries(subdirs, pattern)
+    if after:
+      entries = [entry for entry in entries if metric_name(entry) >= after[0]]
+    entries.sort(key=metric_name)
 
-    # if this is a terminal globstar, add a pattern for all files in subdirs
-    if using_globstar and not patterns:
-        patterns = ["*"]
+    # Entries are matched first, so that only the matching ones are stat'ed
+    subdirs = set(match_entries(entries, pattern))
 
-    if len(patterns) == 1 and RRDReader.supported: #the last pattern may apply to RRD data sources
-      if not has_wildcard:
-        entries = [ pattern + ".rrd" ]
-      files = [entry for entry in entries if isfile(join(current_dir, entry))]
-      rrd_files = match_entries(files, pattern + ".rrd")
+    if patterns: #we've still got more directories to traverse
+      rrd_files = set()
+      if len(patterns) == 1 and RRDReader.supported: #the last pattern may apply to RRD data sources
+        rrd_files.update(match_entries(entries, pattern + ".rrd"))
 
-      if rrd_files: #let's assume it does
-        datasource_pattern = patterns[0]
+      for entry in entries:
+        absolute_path = join(current_dir, entry)
 
-        for rrd_file in rrd_files:
-          absolute_path = join(current_dir, rrd_file)
+        if entry in rrd_files and isfile(absolute_path): #let's assume it does
+          datasource_pattern = patterns[0]
           yield absolute_path + self.DATASOURCE_DELIMITER + datasource_pattern
 
-    if patterns: #we've still got more directories to traverse
-      for subdir in matching_subdirs:
-
-        absolute_path = join(current_dir, subdir)
-        for match in self._find_paths(absolute_path, patterns):
-          yield match
+        elif entry in subdirs and isdir(absolute_path):
+          subdir_after = after[1:] if after and metric_name(entry) == after[0] else None
+          for match in self._find_paths(absolute_path, patterns, subdir_after, listings, leaves_only):
+            yield match
 
     else: #we've got the last pattern
-      if not has_wildcard:
-        entries = [ pattern + '.wsp', pattern + '.wsp.gz', pattern + '.rrd' ]
-      files = [entry for entry in entries if isfile(join(current_dir, entry))]
-      matching_files = match_entries(files, pattern + '.*')
+      files = set(match_entries(entries, pattern + '.*'))
+      if leaves_only:
+        subdirs = ()
+
+      for entry in entries:
+        absolute_path = join(current_dir, entry)
+        if (entry in files and isfile(absolute_path)) or (entry in subdirs and isdir(absolute_path)):
+          yield absolute_path
+
+  def _find_globstar_paths(self, root_dir, patterns, listings=None, leaves_only=False):
+    """Same as _find_paths for patterns with ** components (any number of
+    directories, like os.walk without following symbolic links).
+
+    The tree is walked once, carrying for each directory the positions in
+    patterns its path can have reached, so every directory is listed at most
+    once and subtrees none of the remaining patterns can match are never
+    entered. Stops after FIND_GLOBSTAR_MAX_RESULTS paths when it is set."""
+    if patterns[-1] == '**': # a terminal globstar matches all files in subdirs
+      patterns = patterns + ['*']
+
+    last = len(patterns) - 1
+    dir_matchers = [compile_pattern(pattern).match for pattern in patterns]
+    file_matcher = leaf_matcher(patterns[last])
+    if last > 0 and RRDReader.supported: #the last pattern may apply to RRD data sources
+      rrd_matcher = compile_pattern(patterns[last - 1] + '.rrd').match
+    else:
+      rrd_matcher = None
+
+    def walk(current_dir, positions):
+      if any(patterns[i] == '**' or is_wildcard(patterns[i]) for i in positions):
+        entries = list_directory(current_dir, listings, scan_dir)
+      else:
+        entries = stat_entries(current_dir, literal_names(patterns, positions))
+
+      for (name, is_dir, is_file, is_symlink) in entries:
+        absolute_path = join(current_dir, name)
+
+        if is_file:
+          if last in positions and file_matcher(name):
+            yield absolute_path
+          if last - 1 in positions and rrd_matcher and rrd_matcher(name):
+            yield absolute_path + self.DATASOURCE_DELIMITER + patterns[last]
+
+        elif is_dir:
+          if last in positions and not leaves_only and dir_matchers[last](name):
+            yield absolute_path
+
+          next_positions = set()
+          for i in positions:
+            if i == last:
+              continue
+            elif patterns[i] == '**':
+              if not is_symlink:
+                next_positions.add(i)
+            elif dir_matchers[i](name):
+              next_positions.add(i + 1)
+
+          if next_positions:
+            for match in walk(absolute_path, globstar_closure(patterns, next_positions)):
+              yield match
+
+    limit = settings.FIND_GLOBSTAR_MAX_RESULTS
+    for (count, match) in enumerate(walk(root_dir, globstar_closure(patterns, [0])), 1):
+      yield match
+      if count == limit:
+        log.info("find(%s) in %s stopped after %d results" % ('.'.join(patterns), root_dir, limit))
+        return
+
+
+def sort_keyed(index, nodes):
+  "Pairs nodes with keys sorting them by path, then by index, then in order"
+  for (count, node) in enumerate(nodes):
+    yield ((path_key(node.path), index, count), node)
+
+
+def is_wildcard(pattern):
+  return pattern.find('{') > -1 or pattern.find('[') > -1 or pattern.find('*') > -1 or pattern.find('?') > -1
+
+
+def leaf_matcher(pattern):
+  "Matches the file names of the metrics named by the last pattern"
+  if is_wildcard(pattern):
+    return compile_pattern(pattern + '.*').match
+  return frozenset(pattern + extension for extension in METRIC_EXTENSIONS).__contains__
+
+
+def literal_names(patterns, positions):
+  "The only entries patterns without wildcards can match at these positions"
+  last = len(patterns) - 1
+  names = set()
+  for i in positions:
+    names.add(patterns[i])
+    if i == last:
+      names.update(patterns[i] + extension for extension in METRIC_EXTENSIONS)
+    elif i == last - 1:
+      names.add(patterns[i] + '.rrd')
+  return sorted(names)
+
+
+def metric_name(entry):
+  "The metric path node of a directory entry, which sorts the entries in path order"
+  return entry.split('.')[0]
+
+
+def entry_order(entry):
+  # Files come before the directories of the same name, whose paths are longer
+  (name, is_dir, is_file, is_symlink) = entry
+  return (metric_name(name), is_dir)
+
+
+def globstar_closure(patterns, positions):
+  "Adds the positions reached by ** components matching no directory at all"
+  positions = set(positions)
+  for i in sorted(positions):
+    while patterns[i] == '**':
+      i += 1
+      positions.add(i)
+  return positions
+
+
+def scan_dir(path):
+  """Returns (name, is_dir, is_file, is_symlink) for the entries of a
+  directory, from the d_type scandir reads along with the names if it is
+  installed"""
+  try:
+    if scandir is not None:
+      return sorted(((entry.name, entry.is_dir(), entry.is_file(), entry.is_symlink())
+                     for entry in scandir(path)), key=entry_order)
+    return stat_entries(path, os.listdir(path))
+  except OSError as e:
+    log.exception(e)
+    return []
+
 
-      for base_name in matching_files + matching_subdirs:
-        yield join(current_dir, base_name)
+def stat_entries(path, names):
+  entries = []
+  for name in names:
+    entry_path = join(path, name)
+    if isdir(entry_path):
+      entries.append( (name, True, False, islink(entry_path)) )
+    elif isfile(entry_path):
+      entries.append( (name, False, True, False) )
+  entries.sort(key=entry_order)
+  return entries
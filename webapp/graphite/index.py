@@ -0,0 +1,364 @@
+import heapq
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from django.conf import settings
+from graphite.node import BranchNode, LeafNode
+
+TRIGRAMS_SUFFIX = '.trigrams'
+# The directories scanned by the last index build, see write_index
+MANIFEST_SUFFIX = '.manifest'
+TRIGRAMS_MAGIC = 'graphite-trigrams-1\n'
+# Size and modification time of the index file, number of lines and of trigrams
+TRIGRAMS_HEADER = struct.Struct('=QdII')
+LINE_OFFSET = struct.Struct('=Q')
+# A trigram, then the offset and number of the line numbers holding it
+TRIGRAM_ENTRY = struct.Struct('=3sQI')
+
+
+class MappedFile(object):
+  "A file mmap'd for reading, which is mapped again whenever it is replaced"
+
+  def __init__(self, path):
+    self.path = path
+    self.map = None
+    self.file_id = None
+    self.lock = Lock()
+
+  def refresh(self):
+    "Maps the file if it changed since it was last mapped"
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      self.map = self.file_id = None
+      return
+
+    file_id = (stat.st_ino, stat.st_mtime, stat.st_size)
+    if file_id == self.file_id:
+      return
+
+    with self.lock:
+      if file_id != self.file_id:
+        file_map = None
+        if stat.st_size:
+          with open(self.path, 'rb') as mapped_file:
+            file_map = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.map = file_map
+        self.file_id = file_id
+
+
+class MetricIndex(MappedFile):
+  """The sorted metric paths of an index file, one per line, as written by
+  write_index.
+
+  The file is mmap'd, so its pages are shared by every process reading it,
+  and searched by bisection. It is mapped again whenever it is replaced."""
+
+  def __init__(self, path):
+    MappedFile.__init__(self, path)
+    self.trigrams = TrigramIndex(path + TRIGRAMS_SUFFIX)
+
+  def lower_bound(self, index_map, key, lo=0):
+    "Offset of the first line from the one at lo that is not lower than key"
+    hi = len(index_map)
+
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = index_map.rfind('\n', lo, mid) + 1 or lo
+      end = index_map.find('\n', start)
+      if end < 0:
+        end = len(index_map)
+
+      if index_map[start:end] < key:
+        lo = end + 1
+      else:
+        hi = start
+
+    return min(lo, len(index_map))
+
+  def find(self, prefix, limit=None):
+    """Yields the nodes whose path starts with prefix among the children of
+    its parent (so 'a.b.c' finds a.b.cpu and a.b.cache), in path_key order
+    and at most limit paths. Each branch costs one more bisection, however
+    many metrics are underneath it."""
+    self.refresh()
+    index_map = self.map
+    if index_map is None:
+      return
+
+    parent = prefix[:prefix.rfind('.') + 1]
+    offset = self.lower_bound(index_map, prefix)
+    nodes = []
+    last_line = None
+
+    while offset < len(index_map):
+      end = index_map.find('\n', offset)
+      if end < 0:
+        end = len(index_map)
+      line = index_map[offset:end]
+      if not line.startswith(prefix):
+        break
+
+      (name, dot, rest) = line[len(parent):].partition('.')
+      path = parent + name
+
+      if dot:
+        nodes.append(BranchNode(path))
+        # Skip the whole subtree, '/' sorts right after '.'
+        offset = self.lower_bound(index_map, path + '/', end + 1)
+      else:
+        # Metrics stored in several formats are listed more than once
+        if line != last_line:
+          nodes.append(LeafNode(path, None))
+        last_line = line
+        offset = end + 1
+
+    # Lines sort a.cpu-0.x before a.cpu.x, where paths sort a.cpu first (the
+    # order of graphite.util.path_key, which imports this module)
+    nodes.sort(key=lambda node: node.path.split('.'))
+    paths = set()
+    for node in nodes:
+      if node.path not in paths:
+        if limit and len(paths) == limit:
+          return
+        paths.add(node.path)
+      yield node
+
+  def search(self, patterns, limit=None):
+    """Returns the lines matching any of the case insensitive regular
+    expressions in patterns, in index order, at most limit of them.
+
+    With an up to date trigram sidecar, a pattern is only matched against
+    the lines holding every trigram of the literal text it requires.
+    Patterns without any such trigram still scan the whole index."""
+    regexes = [re.compile(pattern, re.I) for pattern in patterns]
+
+    self.refresh()
+    self.trigrams.refresh()
+    (index_map, trigrams_map, file_id) = (self.map, self.trigrams.map, self.file_id)
+
+    line_numbers = None
+    if index_map is not None and self.trigrams.covers(trigrams_map, file_id):
+      line_numbers = self.trigrams.candidates(trigrams_map, patterns)
+
+    if line_numbers is None:
+      lines = self.lines()
+    else:
+      lines = (self.trigrams.line(trigrams_map, index_map, number) for number in line_numbers)
+
+    results = []
+    for line in lines:
+      if any(regex.search(line) for regex in regexes):
+        results.append(line.strip())
+        if limit and len(results) >= limit:
+          break
+    return results
+
+  def lines(self):
+    with open(self.path) as index_file:
+      for line in index_file:
+        yield line
+
+  def paths(self):
+    """Generates the distinct paths of the index file, in order. Raises
+    IOError right away if it can't be read.
+
+    Only an index with an up to date trigram sidecar is known to be sorted,
+    others (written by build-index before it sorted them) are sorted in
+    memory first."""
+    index_file = open(self.path)
+    stat = os.fstat(index_file.fileno())
+    self.trigrams.refresh()
+    lines = index_file
+    if not self.trigrams.covers(self.trigrams.map, (stat.st_ino, stat.st_mtime, stat.st_size)):
+      with index_file:
+        lines = sorted(index_file)
+
+    def paths():
+      try:
+        for line in unique(lines):
+          yield line.rstrip('\n')
+      finally:
+        index_file.close()
+
+    return paths()
+
+
+class TrigramIndex(MappedFile):
+  """The trigram sidecar of an index file. For every three consecutive
+  characters of its lower cased lines, it lists the sorted numbers of the
+  lines holding them, and the offset of every line in the index file."""
+
+  def layout(self, trigrams_map):
+    "The header fields and the offset of the trigram table"
+    (index_size, index_mtime, line_count, trigram_count) = \
+        TRIGRAMS_HEADER.unpack_from(trigrams_map, len(TRIGRAMS_MAGIC))
+    table = len(TRIGRAMS_MAGIC) + TRIGRAMS_HEADER.size + (line_count + 1) * LINE_OFFSET.size
+    return (index_size, index_mtime, line_count, trigram_count, table)
+
+  def covers(self, trigrams_map, index_file_id):
+    "Whether the sidecar was written for the index file currently in place"
+    if trigrams_map is None or index_file_id is None:
+      return False
+    if len(trigrams_map) < len(TRIGRAMS_MAGIC) + TRIGRAMS_HEADER.size or \
+       trigrams_map[:len(TRIGRAMS_MAGIC)] != TRIGRAMS_MAGIC:
+      return False
+    (index_size, index_mtime) = self.layout(trigrams_map)[:2]
+    return (index_mtime, index_size) == index_file_id[1:]
+
+  def candidates(self, trigrams_map, patterns):
+    """Generates, in order, the numbers of the lines that may match one of
+    patterns, or returns None when one of them has no trigram to narrow the
+    lines down with"""
+    matches = []
+
+    for pattern in patterns:
+      literals = required_literals(pattern)
+      if literals is None:
+        return None
+
+      trigrams = set()
+      for literal in literals:
+        literal = literal.lower()
+        trigrams.update(literal[i:i + 3] for i in xrange(len(literal) - 2))
+      if not trigrams:
+        return None
+
+      postings = sorted((self.postings(trigrams_map, trigram) for trigram in trigrams), key=len)
+      matches.append(intersect(postings[0], postings[1:]))
+
+    return unique(heapq.merge(*matches))
+
+  def postings(self, trigrams_map, trigram):
+    "The sorted numbers of the lines holding a trigram"
+    (index_size, index_mtime, line_count, trigram_count, table) = self.layout(trigrams_map)
+    postings = array('I')
+    (lo, hi) = (0, trigram_count)
+
+    while lo < hi:
+      mid = (lo + hi) // 2
+      (key, offset, count) = TRIGRAM_ENTRY.unpack_from(trigrams_map, table + mid * TRIGRAM_ENTRY.size)
+      if key < trigram:
+        lo = mid + 1
+      elif key > trigram:
+        hi = mid
+      else:
+        postings.fromstring(trigrams_map[offset:offset + count * postings.itemsize])
+        break
+
+    return postings
+
+  def line(self, trigrams_map, index_map, number):
+    position = len(TRIGRAMS_MAGIC) + TRIGRAMS_HEADER.size + number * LINE_OFFSET.size
+    (start,) = LINE_OFFSET.unpack_from(trigrams_map, position)
+    (end,) = LINE_OFFSET.unpack_from(trigrams_map, position + LINE_OFFSET.size)
+    return index_map[start:end]
+
+
+def intersect(numbers, others):
+  for number in numbers:
+    if all(contains(other, number) for other in others):
+      yield number
+
+
+def unique(numbers):
+  last = None
+  for number in numbers:
+    if number != last:
+      yield number
+    last = number
+
+
+def contains(numbers, number):
+  i = bisect_left(numbers, number)
+  return i < len(numbers) and numbers[i] == number
+
+
+def required_literals(pattern):
+  """Returns the literal substrings found in every match of a regular
+  expression, or None when they can't be told without parsing it (with
+  alternatives or groups). Characters that may repeat or be left out end
+  a substring."""
+  if '|' in pattern or '(' in pattern:
+    return None
+
+  literals = []
+  literal = []
+  i = 0
+
+  while i < len(pattern):
+    c = pattern[i]
+    i += 1
+
+    if c == '\\' and i < len(pattern) and not pattern[i].isalnum():
+      literal.append(pattern[i])
+      i += 1
+      continue
+    elif c in '*?{':
+      # The previous character may be left out
+      if literal:
+        literal.pop()
+      if c == '{':
+        i = pattern.find('}', i) + 1 or len(pattern)
+    elif c == '[':
+      end = pattern.find(']', i + 2 if pattern[i:i + 2] == '^]' else i + 1)
+      i = end + 1 if end > -1 else len(pattern)
+    elif c == '\\':
+      i += 1
+    elif c not in '.^$+':
+      literal.append(c)
+      continue
+
+    if literal:
+      literals.append(''.join(literal))
+    literal = []
+
+  if literal:
+    literals.append(''.join(literal))
+  return literals
+
+
+def write_trigrams(lines, index_mtime, trigrams_file):
+  """Writes the trigram sidecar of an index file made of lines (with their
+  line feeds) and last modified at index_mtime"""
+  postings = {}
+  offsets = [0]
+
+  for (number, line) in enumerate(lines):
+    offsets.append(offsets[-1] + len(line))
+    line = line.rstrip('\n').lower()
+    for trigram in set(line[i:i + 3] for i in xrange(len(line) - 2)):
+      if trigram not in postings:
+        postings[trigram] = array('I')
+      postings[trigram].append(number)
+
+  trigrams = sorted(postings)
+  trigrams_file.write(TRIGRAMS_MAGIC)
+  trigrams_file.write(TRIGRAMS_HEADER.pack(offsets[-1], index_mtime, len(lines), len(trigrams)))
+  for offset in offsets:
+    trigrams_file.write(LINE_OFFSET.pack(offset))
+
+  position = len(TRIGRAMS_MAGIC) + TRIGRAMS_HEADER.size + len(offsets) * LINE_OFFSET.size + \
+             len(trigrams) * TRIGRAM_ENTRY.size
+  for trigram in trigrams:
+    trigrams_file.write(TRIGRAM_ENTRY.pack(trigram, position, len(postings[trigram])))
+    position += len(postings[trigram]) * postings[trigram].itemsize
+
+  for trigram in trigrams:
+    postings[trigram].tofile(trigrams_file)
+
+
+INDEXES = {}
+
+
+def get_index(path=None):
+  "The shared MetricIndex of an index file, INDEX_FILE by default"
+  path = path or settings.INDEX_FILE
+  if path not in INDEXES:
+    INDEXES[path] = MetricIndex(path)
+  return INDEXES[path]
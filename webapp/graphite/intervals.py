@@ -1,17 +1,43 @@
+from bisect import bisect_right
+
 INFINITY = float('inf')
 NEGATIVE_INFINITY = -INFINITY
 
 
 class IntervalSet:
-  __slots__ = ('intervals', 'size')
+  """A sorted set of disjoint intervals, stored as parallel lists of start
+  and end times. The Interval objects are only built when the intervals
+  attribute is accessed.
+
+  This stays an old-style class pickled as {'intervals': [...], 'size': n}
+  so that cluster peers running older versions can exchange it."""
 
   def __init__(self, intervals, disjoint=False):
-    self.intervals = intervals
+    if disjoint:
+      self.intervals = intervals
+      starts = [i.start for i in intervals]
+      ends = [i.end for i in intervals]
+    else:
+      (starts, ends) = merge_bounds(sorted((i.start, i.end) for i in intervals))
+    self._set_bounds(starts, ends)
+
+  def _set_bounds(self, starts, ends):
+    self.starts = starts
+    self.ends = ends
+    self.size = sum(end - start for (start, end) in zip(starts, ends))
+
+  def __getattr__(self, name):
+    if name == 'intervals':
+      self.intervals = [Interval(start, end) for (start, end) in zip(self.starts, self.ends)]
+      return self.intervals
+    raise AttributeError(name)
 
-    if not disjoint:
-      self.intervals = union_overlapping(self.intervals)
+  def __getstate__(self):
+    return {'intervals': self.intervals, 'size': self.size}
 
-    self.size = sum(i.size for i in self.intervals)
+  def __setstate__(self, state):
+    (starts, ends) = merge_bounds(sorted((i.start, i.end) for i in state['intervals']))
+    self._set_bounds(starts, ends)
 
   def __repr__(self):
     return repr(self.intervals)
@@ -26,45 +52,74 @@ class IntervalSet:
     return self.intersect( other.complement() )
 
   def complement(self):
-    complementary = []
+    starts = []
+    ends = []
     cursor = NEGATIVE_INFINITY
 
-    for interval in self.intervals:
-      if cursor < interval.start:
-        complementary.append( Interval(cursor, interval.start) )
-        cursor = interval.end
+    for (start, end) in zip(self.starts, self.ends):
+      if cursor < start:
+        starts.append(cursor)
+        ends.append(start)
+      cursor = end
 
     if cursor < INFINITY:
-      complementary.append( Interval(cursor, INFINITY) )
+      starts.append(cursor)
+      ends.append(INFINITY)
 
-    return IntervalSet(complementary, disjoint=True)
+    return from_bounds(starts, ends)
 
-  def intersect(self, other): #XXX The last major bottleneck. Factorial-time hell.
-    # Then again, this function is entirely unused...
-    if (not self) or (not other):
-      return IntervalSet([])
-
-    #earliest = max(self.intervals[0].start, other.intervals[0].start)
-    #latest = min(self.intervals[-1].end, other.intervals[-1].end)
+  def intersect(self, other):
+    starts = []
+    ends = []
+    (a_starts, a_ends, b_starts, b_ends) = (self.starts, self.ends, other.starts, other.ends)
+    i = j = 0
 
-    #mine = [i for i in self.intervals if i.start >= earliest and i.end <= latest]
-    #theirs = [i for i in other.intervals if i.start >= earliest and i.end <= latest]
+    while i < len(a_starts) and j < len(b_starts):
+      start = max(a_starts[i], b_starts[j])
+      end = min(a_ends[i], b_ends[j])
+      if end > start:
+        starts.append(start)
+        ends.append(end)
 
-    intersections = [x for x in (i.intersect(j)
-                                 for i in self.intervals
-                                 for j in other.intervals)
-                     if x]
+      if a_ends[i] < b_ends[j]:
+        i += 1
+      else:
+        j += 1
 
-    return IntervalSet(intersections, disjoint=True)
+    return from_bounds(starts, ends)
 
   def intersect_interval(self, interval):
-    intersections = [x for x in (i.intersect(interval)
-                                 for i in self.intervals)
-                     if x]
-    return IntervalSet(intersections, disjoint=True)
+    starts = []
+    ends = []
+
+    i = bisect_right(self.ends, interval.start)
+    while i < len(self.starts) and self.starts[i] < interval.end:
+      start = max(self.starts[i], interval.start)
+      end = min(self.ends[i], interval.end)
+      if end > start:
+        starts.append(start)
+        ends.append(end)
+      i += 1
+
+    return from_bounds(starts, ends)
 
   def union(self, other):
-    return IntervalSet( sorted(self.intervals + other.intervals) )
+    (a_starts, a_ends, b_starts, b_ends) = (self.starts, self.ends, other.starts, other.ends)
+    bounds = []
+    i = j = 0
+
+    while i < len(a_starts) and j < len(b_starts):
+      if b_starts[j] < a_starts[i]:
+        bounds.append( (b_starts[j], b_ends[j]) )
+        j += 1
+      else:
+        bounds.append( (a_starts[i], a_ends[i]) )
+        i += 1
+
+    bounds.extend(zip(a_starts[i:], a_ends[i:]))
+    bounds.extend(zip(b_starts[j:], b_ends[j:]))
+    (starts, ends) = merge_bounds(bounds)
+    return from_bounds(starts, ends)
 
 
 
@@ -119,6 +174,30 @@ class Interval:
     return Interval(start, end)
 
 
+def from_bounds(starts, ends):
+  "Builds an IntervalSet from the sorted start and end times of disjoint intervals"
+  interval_set = IntervalSet([])
+  interval_set._set_bounds(starts, ends)
+  return interval_set
+
+
+def merge_bounds(bounds):
+  """Merges sorted (start, end) pairs that overlap or touch, returning the
+  start and end times of the resulting disjoint intervals."""
+  starts = []
+  ends = []
+
+  for (start, end) in bounds:
+    if ends and ends[-1] >= start:
+      if end > ends[-1]:
+        ends[-1] = end
+    else:
+      starts.append(start)
+      ends.append(end)
+
+  return (starts, ends)
+
+
 def union_overlapping(intervals):
   """Union any overlapping intervals in the given set."""
   disjoint_intervals = []
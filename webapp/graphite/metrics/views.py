@@ -12,22 +12,31 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 import fnmatch
+import heapq
 import os
 import urllib
+import urllib2
+from itertools import groupby, islice
 
 from django.conf import settings
-from graphite.compat import HttpResponse, HttpResponseBadRequest
-from graphite.util import getProfile, json
+from graphite.compat import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from graphite.util import getProfile, is_pattern, json
+from graphite.index import get_index, unique
 from graphite.logger import log
+from graphite.node import FindResult
 from graphite.readers import RRDReader
 from graphite.storage import STORE
 from graphite.carbonlink import CarbonLink
+from graphite.worker_pool.pool import Job, get_pool, pool_exec
 
 try:
   import cPickle as pickle
 except ImportError:
   import pickle
 
+# Number of paths encoded at a time by json_stream_for
+JSON_STREAM_BATCH_SIZE = 1000
+
 
 def index_json(request):
   queryParams = request.GET.copy()
@@ -36,57 +45,97 @@ def index_json(request):
   jsonp = queryParams.get('jsonp', False)
   cluster = queryParams.get('cluster', False)
 
-  def find_matches():
-    matches = []
-
-    for root, dirs, files in os.walk(settings.WHISPER_DIR):
-      root = root.replace(settings.WHISPER_DIR, '')
-      for basename in files:
-        if fnmatch.fnmatch(basename, '*.wsp'):
-          matches.append(os.path.join(root, basename))
-
-    for root, dirs, files in os.walk(settings.CERES_DIR):
-      root = root.replace(settings.CERES_DIR, '')
-      for filename in files:
-        if filename == '.ceres-node':
-          matches.append(root)
-
-    # unlike 0.9.x, we're going to use os.walk with followlinks
-    # since we require Python 2.7 and newer that supports it
-    if RRDReader.supported:
-      for root, dirs, files in os.walk(settings.RRD_DIR, followlinks=True):
-        root = root.replace(settings.RRD_DIR, '')
-        for basename in files:
-          if fnmatch.fnmatch(basename, '*.rrd'):
-            absolute_path = os.path.join(settings.RRD_DIR, root, basename)
-            (basename,extension) = os.path.splitext(basename)
-            metric_path = os.path.join(root, basename)
-            rrd = RRDReader(absolute_path, metric_path)
-            for datasource_name in rrd.get_datasources(absolute_path):
-              matches.append(os.path.join(metric_path, datasource_name))
-
-    matches = [
-      m
-      .replace('.wsp', '')
-      .replace('.rrd', '')
-      .replace('/', '.')
-      .lstrip('.')
-      for m in sorted(matches)
-    ]
-    return matches
-
-  matches = []
   if cluster and len(settings.CLUSTER_SERVERS) >= 1:
+    # Fetch the peers in parallel, and only start answering once all of
+    # them did, so that a failure can still be reported
+    jobs = [Job(fetch_index, "index.json from %s" % cluster_server, cluster_server)
+            for cluster_server in settings.CLUSTER_SERVERS]
     try:
-      matches = reduce( lambda x, y: list(set(x + y)), \
-        [json.loads(urllib.urlopen('http://' + cluster_server + '/metrics/index.json').read()) \
-        for cluster_server in settings.CLUSTER_SERVERS])
-    except urllib.URLError:
+      indexes = [job.get_result() for job in pool_exec(get_pool(), jobs)]
+    except Exception:
       log.exception()
-      return json_response_for(request, matches, jsonp=jsonp, status=500)
+      return json_response_for(request, [], jsonp=jsonp, status=500)
+    matches = unique(heapq.merge(*indexes))
   else:
-    matches = find_matches()
-  return json_response_for(request, matches, jsonp=jsonp)
+    matches = find_local_index()
+  return json_stream_for(request, matches, jsonp=jsonp)
+
+
+def fetch_index(cluster_server):
+  "The sorted metric paths of a cluster server"
+  response = urllib2.urlopen('http://' + cluster_server + '/metrics/index.json')
+  try:
+    # Older servers sort by filesystem path, which is not quite the same
+    return sorted(json.load(response))
+  finally:
+    response.close()
+
+
+def find_local_index():
+  """Generates the sorted, distinct paths of the local metrics, from
+  INDEX_FILE when it was built"""
+  try:
+    matches = [get_index().paths()]
+  except IOError:
+    matches = [walk_whisper_ceres()]
+
+  if RRDReader.supported:
+    matches.append(walk_rrd())
+  return unique(heapq.merge(*matches))
+
+
+def walk_whisper_ceres():
+  matches = []
+
+  for root, dirs, files in os.walk(settings.WHISPER_DIR):
+    root = root.replace(settings.WHISPER_DIR, '')
+    for basename in files:
+      if fnmatch.fnmatch(basename, '*.wsp'):
+        matches.append(os.path.join(root, basename))
+
+  for root, dirs, files in os.walk(settings.CERES_DIR):
+    root = root.replace(settings.CERES_DIR, '')
+    for filename in files:
+      if filename == '.ceres-node':
+        matches.append(root)
+
+  return sorted(to_metric_path(m) for m in matches)
+
+
+def walk_rrd():
+  matches = []
+
+  # unlike 0.9.x, we're going to use os.walk with followlinks
+  # since we require Python 2.7 and newer that supports it
+  for root, dirs, files in os.walk(settings.RRD_DIR, followlinks=True):
+    root = root.replace(settings.RRD_DIR, '')
+    for basename in files:
+      if fnmatch.fnmatch(basename, '*.rrd'):
+        absolute_path = os.path.join(settings.RRD_DIR, root, basename)
+        (basename,extension) = os.path.splitext(basename)
+        metric_path = os.path.join(root, basename)
+        rrd = RRDReader(absolute_path, metric_path)
+        for datasource_name in rrd.get_datasources(absolute_path):
+          matches.append(os.path.join(metric_path, datasource_name))
+
+  return sorted(to_metric_path(m) for m in matches)
+
+
+def to_metric_path(match):
+  return match.replace('.wsp', '').replace('.rrd', '').replace('/', '.').lstrip('.')
+
+
+def page_nodes(nodes, offset, limit):
+  """Returns the nodes of the limit paths following the first offset paths
+  of nodes, which yields the nodes of a path together and in path order, and
+  the path the next page starts after, or None if no path follows them"""
+  page = []
+  for (i, (path, path_nodes)) in enumerate(groupby(nodes, lambda node: node.path)):
+    if i == offset + limit:
+      return (page, page[-1].path if page else None)
+    if i >= offset:
+      page.extend(path_nodes)
+  return (page, None)
 
 
 def find_view(request):
@@ -102,6 +151,9 @@ def find_view(request):
   fromTime = int( queryParams.get('from', -1) )
   untilTime = int( queryParams.get('until', -1) )
   nodePosition = int( queryParams.get('position', -1) )
+  limit = int( queryParams.get('limit', 0) )
+  offset = int( queryParams.get('offset', 0) )
+  cursor = queryParams.get('cursor')
   jsonp = queryParams.get('jsonp', False)
 
   if fromTime == -1:
@@ -134,14 +186,33 @@ def find_view(request):
           query_parts[i] = '{%s}' % part
       query = '.'.join(query_parts)
 
+  # A page is the first offset + limit paths after the cursor, so the
+  # finders can stop searching there
+  # Completing a plain prefix of local metrics only takes a few bisections
+  # of the index file
+  use_index = (format == 'completer' and settings.COMPLETER_USE_INDEX and
+               not is_pattern(query[:-1]) and fromTime is None and untilTime is None and
+               not offset and cursor is None and (local_only or not settings.CLUSTER_SERVERS))
+
+  # One more path than the page tells whether another page follows it
+  next_cursor = None
   try:
-    matches = list( STORE.find(query, fromTime, untilTime, local=local_only) )
+    if use_index:
+      nodes = get_index().find(query[:-1], limit and limit + 1)
+    elif limit:
+      nodes = STORE.find(query, fromTime, untilTime, local=local_only,
+                         limit=offset + limit + 1, cursor=cursor)
+    else:
+      nodes = STORE.find(query, fromTime, untilTime, local=local_only, cursor=cursor)
+    if limit:
+      (nodes, next_cursor) = page_nodes(nodes, offset, limit)
+    matches = FindResult(nodes, with_intervals=(format == 'pickle'))
   except:
     log.exception()
     raise
 
   log.info('find_view query=%s local_only=%s matches=%d' % (query, local_only, len(matches)))
-  matches.sort(key=lambda node: node.name)
+  matches.sort_by_name()
   log.info("received remote find request: pattern=%s from=%s until=%s local_only=%s format=%s matches=%d" % (query, fromTime, untilTime, local_only, format, len(matches)))
 
   if format == 'treejson':
@@ -158,9 +229,10 @@ def find_view(request):
 
   elif format == 'completer':
     results = []
-    for node in matches:
-      node_info = dict(path=node.path, name=node.name, is_leaf=str(int(node.is_leaf)))
-      if not node.is_leaf:
+    for i, path in enumerate(matches.paths):
+      is_leaf = matches.is_leaf(i)
+      node_info = dict(path=path, name=matches.name(i), is_leaf=str(int(is_leaf)))
+      if not is_leaf:
         node_info['path'] += '.'
       results.append(node_info)
 
@@ -175,6 +247,8 @@ def find_view(request):
         content="Invalid value for 'format' parameter",
         content_type='text/plain')
 
+  if next_cursor is not None:
+    response['X-Graphite-Next-Cursor'] = next_cursor
   response['Pragma'] = 'no-cache'
   response['Cache-Control'] = 'no-cache'
   return response
@@ -190,12 +264,15 @@ def expand_view(request):
   leaves_only = int( queryParams.get('leavesOnly', 0) )
   jsonp = queryParams.get('jsonp', False)
 
-  results = {}
-  for query in queryParams.getlist('query'):
-    results[query] = set()
-    for node in STORE.find(query, local=local_only):
-      if node.is_leaf or not leaves_only:
-        results[query].add( node.path )
+  # The queries are expanded concurrently, listing each directory once
+  listings = {}
+
+  def expand(query):
+    nodes = STORE.find(query, local=local_only, leaves_only=bool(leaves_only), listings=listings)
+    return (query, set(node.path for node in nodes))
+
+  jobs = [Job(expand, "expand(%s)" % query, query) for query in queryParams.getlist('query')]
+  results = dict(job.get_result() for job in pool_exec(get_pool(), jobs))
 
   # Convert our results to sorted lists because sets aren't json-friendly
   if group_by_expr:
@@ -221,13 +298,25 @@ def get_metadata_view(request):
   key = queryParams.get('key')
   metrics = queryParams.getlist('metric')
   jsonp = queryParams.get('jsonp', False)
+
+  # Too many metrics for a query string can be posted as {"key": ..., "metrics": [...]}
+  if request.method == 'POST' and request.META.get('CONTENT_TYPE') == 'application/json':
+    body = json.loads( request.body )
+    key = body.get('key', key)
+    metrics = metrics + body.get('metrics', [])
+
+  try:
+    values = CarbonLink.get_metadata_many(metrics, key)
+  except Exception as e:
+    log.exception()
+    values = [e] * len(metrics)
+
   results = {}
-  for metric in metrics:
-    try:
-      results[metric] = CarbonLink.get_metadata(metric, key)
-    except:
-      log.exception()
-      results[metric] = dict(error="Unexpected error occurred in CarbonLink.get_metadata(%s, %s)" % (metric, key))
+  for (metric, value) in zip(metrics, values):
+    if isinstance(value, Exception):
+      log.info("CarbonLink.get_metadata(%s, %s) failed: %s" % (metric, key, value))
+      value = dict(error="Unexpected error occurred in CarbonLink.get_metadata(%s, %s)" % (metric, key))
+    results[metric] = value
 
   return json_response_for(request, results, jsonp=jsonp)
 
@@ -251,15 +340,24 @@ def set_metadata_view(request):
     else:
       operations = json.loads( request.POST['operations'] )
 
+    batch = []
     for op in operations:
-      metric = None
       try:
-        metric, key, value = op['metric'], op['key'], op['value']
-        results[metric] = CarbonLink.set_metadata(metric, key, value)
+        batch.append( (op['metric'], op['key'], op['value']) )
       except:
         log.exception()
-        if metric:
-          results[metric] = dict(error="Unexpected error occurred in bulk CarbonLink.set_metadata(%s)" % metric)
+
+    try:
+      batch_results = CarbonLink.set_metadata_many(batch)
+    except Exception as e:
+      log.exception()
+      batch_results = [e] * len(batch)
+
+    for ((metric, key, value), result) in zip(batch, batch_results):
+      if isinstance(result, Exception):
+        log.info("CarbonLink.set_metadata(%s, %s) failed: %s" % (metric, key, result))
+        result = dict(error="Unexpected error occurred in bulk CarbonLink.set_metadata(%s)" % metric)
+      results[metric] = result
 
   else:
     results = dict(error='Invalid request method')
@@ -285,7 +383,7 @@ def tree_json(nodes, base_path, wildcards=False):
   if len(nodes) > 1 and wildcards:
     wildcardNode = {'text' : '*', 'id' : base_path + '*'}
 
-    if any(not n.is_leaf for n in nodes):
+    if nodes.has_branches():
       wildcardNode.update(branchNode)
 
     else:
@@ -296,17 +394,18 @@ def tree_json(nodes, base_path, wildcards=False):
   found = set()
   results_leaf = []
   results_branch = []
-  for node in nodes: #Now let's add the matching children
-    if node.name in found:
+  for i in xrange(len(nodes)): #Now let's add the matching children
+    name = nodes.name(i)
+    if name in found:
       continue
 
-    found.add(node.name)
+    found.add(name)
     resultNode = {
-      'text' : urllib.unquote_plus(str(node.name)),
-      'id' : base_path + str(node.name),
+      'text' : urllib.unquote_plus(str(name)),
+      'id' : base_path + str(name),
     }
 
-    if node.is_leaf:
+    if nodes.is_leaf(i):
       resultNode.update(leafNode)
       results_leaf.append(resultNode)
     else:
@@ -321,8 +420,8 @@ def tree_json(nodes, base_path, wildcards=False):
 def nodes_by_position(matches, position):
   found = set()
 
-  for metric in matches:
-    nodes = metric.path.split('.')
+  for path in matches.paths:
+    nodes = path.split('.')
     found.add(nodes[position])
   results = { 'nodes' : sorted(found) }
   return results
@@ -331,10 +430,11 @@ def nodes_by_position(matches, position):
 def pickle_nodes(nodes):
   nodes_info = []
 
-  for node in nodes:
-    info = dict(path=node.path, is_leaf=node.is_leaf)
-    if node.is_leaf:
-      info['intervals'] = node.intervals
+  for i, path in enumerate(nodes.paths):
+    is_leaf = nodes.is_leaf(i)
+    info = dict(path=path, is_leaf=is_leaf)
+    if is_leaf:
+      info['intervals'] = nodes.intervals(i)
 
     nodes_info.append(info)
 
@@ -354,3 +454,35 @@ def json_response_for(request, data, content_type='application/json',
     content_type += ';charset=utf-8'
 
   return HttpResponse(content, content_type=content_type, **kwargs)
+
+
+def json_stream_for(request, items, content_type='application/json',
+                    jsonp=False, **kwargs):
+  """Like json_response_for, for a list given as an iterable, which is
+  encoded and sent a batch of items at a time"""
+  accept = request.META.get('HTTP_ACCEPT', 'application/json')
+  ensure_ascii = accept == 'application/json'
+
+  def content():
+    if jsonp:
+      yield "%s(" % jsonp
+    yield '['
+    separator = ''
+    items_iter = iter(items)
+    while True:
+      batch = list(islice(items_iter, JSON_STREAM_BATCH_SIZE))
+      if not batch:
+        break
+      # Strip the brackets of each batch encoded as a list
+      yield separator + json.dumps(batch, ensure_ascii=ensure_ascii)[1:-1]
+      separator = ', '
+    yield ']'
+    if jsonp:
+      yield ')'
+
+  if jsonp:
+    content_type = 'text/javascript'
+  if not ensure_ascii:
+    content_type += ';charset=utf-8'
+
+  return StreamingHttpResponse(content(), content_type=content_type, **kwargs)
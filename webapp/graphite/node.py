@@ -1,3 +1,6 @@
+from array import array
+
+from graphite.intervals import from_bounds
 
 
 class Node(object):
@@ -18,16 +21,100 @@ class BranchNode(Node):
 
 
 class LeafNode(Node):
-  __slots__ = ('reader', 'intervals')
+  __slots__ = ('reader', '_intervals')
 
   def __init__(self, path, reader):
     Node.__init__(self, path)
     self.reader = reader
-    self.intervals = reader.get_intervals()
+    self._intervals = None
     self.is_leaf = True
 
+  @property
+  def intervals(self):
+    # Reading intervals usually hits the disk, only do it when needed
+    if self._intervals is None:
+      self._intervals = self.reader.get_intervals()
+    return self._intervals
+
   def fetch(self, startTime, endTime):
     return self.reader.fetch(startTime, endTime)
 
   def __repr__(self):
     return '<LeafNode[%x]: %s (%s)>' % (id(self), self.path, self.reader)
+
+
+class FindResult(object):
+  """A compact, columnar list of found nodes.
+
+  Paths are kept in a single list, leaf flags in a bitmap and, when asked
+  for, the bounds of the intervals of the leaves in two flat lists, so they
+  keep their type (integer timestamps are pickled as such). Huge finds then
+  don't keep a node, reader and IntervalSet object around per result."""
+  __slots__ = ('paths', 'leaves', 'offsets', 'starts', 'ends')
+
+  def __init__(self, nodes=(), with_intervals=False):
+    self.paths = []
+    self.leaves = bytearray()
+    if with_intervals:
+      self.offsets = array('L', [0])
+      self.starts = []
+      self.ends = []
+    else:
+      self.offsets = self.starts = self.ends = None
+
+    for node in nodes:
+      self.append(node)
+
+  def __len__(self):
+    return len(self.paths)
+
+  def append(self, node):
+    index = len(self.paths)
+    self.paths.append(node.path)
+    if index % 8 == 0:
+      self.leaves.append(0)
+
+    if node.is_leaf:
+      self.leaves[index >> 3] |= 1 << (index & 7)
+      if self.offsets is not None:
+        for interval in node.intervals:
+          self.starts.append(interval.start)
+          self.ends.append(interval.end)
+
+    if self.offsets is not None:
+      self.offsets.append(len(self.starts))
+
+  def is_leaf(self, index):
+    return bool(self.leaves[index >> 3] & (1 << (index & 7)))
+
+  def has_branches(self):
+    return not all(self.is_leaf(i) for i in xrange(len(self.paths)))
+
+  def name(self, index):
+    return self.paths[index].rsplit('.', 1)[-1]
+
+  def intervals(self, index):
+    (start, end) = (self.offsets[index], self.offsets[index + 1])
+    return from_bounds(self.starts[start:end], self.ends[start:end])
+
+  def sort_by_name(self):
+    order = sorted(xrange(len(self.paths)), key=self.name)
+    leaves = [self.is_leaf(i) for i in order]
+    if self.offsets is not None:
+      intervals = [(self.starts[self.offsets[i]:self.offsets[i + 1]],
+                    self.ends[self.offsets[i]:self.offsets[i + 1]]) for i in order]
+
+    self.paths = [self.paths[i] for i in order]
+    self.leaves = bytearray((len(order) + 7) / 8)
+    for (index, is_leaf) in enumerate(leaves):
+      if is_leaf:
+        self.leaves[index >> 3] |= 1 << (index & 7)
+
+    if self.offsets is not None:
+      self.offsets = array('L', [0])
+      self.starts = []
+      self.ends = []
+      for (starts, ends) in intervals:
+        self.starts.extend(starts)
+        self.ends.extend(ends)
+        self.offsets.append(len(self.starts))
@@ -2,6 +2,7 @@ import os
 import sys
 import time
 from graphite.intervals import Interval, IntervalSet
+from graphite.cache import LRUCache
 from graphite.carbonlink import CarbonLink
 from graphite.logger import log
 from django.conf import settings
@@ -62,6 +63,9 @@ class MultiReader(object):
           except:
             log.exception("Failed to complete subfetch")
             results[i] = None
+        else:
+          # Local readers return their results right away
+          results[i] = result
 
       results = [r for r in results.values() if r is not None]
       if not results:
@@ -124,7 +128,7 @@ class CeresReader(object):
 
   def get_intervals(self):
     intervals = []
-    for info in self.ceres_node.slice_info:
+    for info in get_slice_info(self.ceres_node):
       (start, end, step) = info
       intervals.append( Interval(start, end) )
 
@@ -150,6 +154,45 @@ class CeresReader(object):
     return time_info, values
 
 
+# Slice info of recently seen Ceres nodes, keyed by their filesystem path
+SLICE_INFO_CACHE = LRUCache(100000)
+
+
+def get_slice_info(ceres_node):
+  """Returns ceres_node.slice_info, cached until the mtime of the node
+  directory (slices added or removed) or of its newest slice (datapoints
+  written) changes."""
+  fs_path = ceres_node.fsPath
+  cached = SLICE_INFO_CACHE.get(fs_path)
+  if cached is not None:
+    (mtimes, slice_info) = cached
+    if mtimes == slice_mtimes(fs_path, slice_info):
+      return slice_info
+
+  try:
+    node_mtime = os.stat(fs_path).st_mtime
+  except OSError:
+    return ceres_node.slice_info
+
+  slice_info = ceres_node.slice_info
+  mtimes = slice_mtimes(fs_path, slice_info)
+  if mtimes is not None and mtimes[0] == node_mtime:
+    SLICE_INFO_CACHE.set(fs_path, (mtimes, slice_info))
+  return slice_info
+
+
+def slice_mtimes(fs_path, slice_info):
+  try:
+    node_mtime = os.stat(fs_path).st_mtime
+    if not slice_info:
+      return (node_mtime, None)
+    (start, end, step) = max(slice_info)
+    slice_path = os.path.join(fs_path, '%d@%d.slice' % (start, step))
+    return (node_mtime, os.stat(slice_path).st_mtime)
+  except OSError:
+    return None
+
+
 class WhisperReader(object):
   __slots__ = ('fs_path', 'real_metric_path')
   supported = bool(whisper)
@@ -3,7 +3,7 @@ import httplib
 from urllib import urlencode
 from threading import Lock
 from django.conf import settings
-from django.core.cache import cache
+from graphite.cache import find_cache
 from graphite.node import LeafNode, BranchNode
 from graphite.readers import FetchInProgress
 from graphite.logger import log
@@ -50,12 +50,14 @@ class FindRequest(object):
       end = ""
 
     self.cacheKey = "find:%s:%s:%s:%s" % (store.host, compactHash(query.pattern), start, end)
+    if query.limit or query.cursor is not None:
+      self.cacheKey += ":%s:%s" % (query.limit, compactHash(query.cursor or ''))
     self.cachedResult = None
 
   def send(self):
     log.info("FindRequest.send(host=%s, query=%s) called" % (self.store.host, self.query))
 
-    self.cachedResult = cache.get(self.cacheKey)
+    self.cachedResult = find_cache.get(self.cacheKey)
     if self.cachedResult is not None:
       log.info("FindRequest(host=%s, query=%s) using cached result" % (self.store.host, self.query))
       return
@@ -75,6 +77,12 @@ class FindRequest(object):
     if self.query.endTime:
       query_params.append( ('until', self.query.endTime) )
 
+    if self.query.limit:
+      query_params.append( ('limit', self.query.limit) )
+
+    if self.query.cursor is not None:
+      query_params.append( ('cursor', self.query.cursor) )
+
     query_string = urlencode(query_params)
 
     try:
@@ -108,7 +116,14 @@ class FindRequest(object):
         self.store.fail()
         return
 
-      cache.set(self.cacheKey, results, settings.FIND_CACHE_DURATION)
+      # Patterns matching nothing are cached for a shorter time so that new
+      # metrics show up quickly
+      if results:
+        timeout = settings.FIND_CACHE_DURATION
+      else:
+        timeout = settings.FIND_NEGATIVE_CACHE_DURATION
+      if timeout:
+        find_cache.set(self.cacheKey, results, timeout)
 
     for node_info in results:
       if node_info.get('is_leaf'):
@@ -16,10 +16,17 @@ from graphite.logger import log
 from graphite.storage import STORE
 from graphite.readers import FetchInProgress
 from django.conf import settings
-from graphite.util import epoch
+from graphite.util import epoch, unpickle
 
+from array import array
+from collections import deque
 from traceback import format_exc
 
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
 class TimeSeries(list):
   def __init__(self, name, start, end, step, values, consolidate='average'):
     list.__init__(self, values)
@@ -105,6 +112,65 @@ class TimeSeries(list):
     }
 
 
+# Compact representation used by the data cache. Float values are packed into
+# a double array with a bitmap marking the None values, anything else falls
+# back to a plain list.
+def packSeriesList(seriesList):
+  packed = []
+  for series in seriesList:
+    values = list.__getslice__(series, 0, len(series))
+    if all(v is None or type(v) is float for v in values):
+      nones = bytearray((len(values) + 7) / 8)
+      for i, v in enumerate(values):
+        if v is None:
+          nones[i / 8] |= 1 << (i % 8)
+      data = array('d', [0.0 if v is None else v for v in values]).tostring()
+      packed.append( (series.__dict__, data, str(nones)) )
+    else:
+      packed.append( (series.__dict__, None, values) )
+
+  return pickle.dumps(packed, protocol=-1)
+
+
+def unpackSeriesList(payload):
+  seriesList = []
+  for (info, data, nones) in unpickle.loads(payload):
+    if data is None:
+      values = nones
+    else:
+      values = array('d')
+      values.fromstring(data)
+      values = values.tolist()
+      for (i, bits) in enumerate(bytearray(nones)):
+        if bits:
+          for bit in xrange(8):
+            if bits & (1 << bit):
+              values[i * 8 + bit] = None
+
+    series = TimeSeries(info['name'], info['start'], info['end'], info['step'], values)
+    series.__dict__.update(info)
+    seriesList.append(series)
+
+  return seriesList
+
+
+def startFetches(nodes, startTime, endTime, window):
+  """Starts fetching each leaf node as soon as it is found and yields the
+  (node, results) pairs in order, keeping at most window fetches started
+  ahead of the consumer."""
+  inflight = deque()
+  for node in nodes:
+    if not node.is_leaf:
+      continue
+
+    inflight.append( (node, node.fetch(startTime, endTime)) )
+    if len(inflight) >= window:
+      yield inflight.popleft()
+
+  while inflight:
+    yield inflight.popleft()
+
+
 # Data retrieval API
 def fetchData(requestContext, pathExpr):
   seriesList = {}
@@ -113,7 +179,7 @@ def fetchData(requestContext, pathExpr):
 
   def _fetchData(pathExpr,startTime, endTime, requestContext, seriesList):
     matching_nodes = STORE.find(pathExpr, startTime, endTime, local=requestContext['localOnly'])
-    fetches = [(node, node.fetch(startTime, endTime)) for node in matching_nodes if node.is_leaf]
+    fetches = startFetches(matching_nodes, startTime, endTime, settings.MAX_FETCHES_IN_FLIGHT)
 
     for node, results in fetches:
       if isinstance(results, FetchInProgress):
@@ -14,8 +14,14 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 from hashlib import md5
-from itertools import chain
+from time import mktime
 import bisect
+import pytz
+
+from django.conf import settings
+from graphite.cache import LRUCache
+from graphite.render.attime import parseATTime
+from graphite.util import epoch
 
 try:
   import pyhash
@@ -36,24 +42,102 @@ except ImportError:
       hval = (hval * fnv_32_prime) % uint32_max
     return hval
 
-def hashRequest(request):
+# Render parameters, other than the graph options, that change the response
+RENDER_PARAMS = frozenset([
+  'target', 'from', 'until', 'tz', 'format', 'jsonp', 'graphType', 'pieMode',
+  'maxDataPoints', 'noNullPoints', 'local',
+])
+
+
+def hashRequest(request, graphOptions=None):
+  """Hashes the parameters of a render request into a cache key.
+
+  Requests that produce the same output should get the same key: relative
+  and absolute times are resolved to timestamps aligned on
+  CACHE_KEY_TIME_RESOLUTION and, when the graph options of the requested
+  graph type are given, parameters that have no effect on the output are
+  dropped."""
+  # The parameters parseOptions renders from, where POST values come last
+  # and win over GET ones
+  queryParams = request.GET.copy()
+  queryParams.update(request.POST)
+  params = {}
+  for (key, values) in queryParams.lists():
+    if not key.startswith('_'):
+      params[key] = list(values)
+
+  normalizeRequestParams(params, graphOptions)
+
   # Normalize the request parameters so ensure we're deterministic
   queryParams = ["%s=%s" % (key, '&'.join(values))
-                 for (key,values) in chain(request.POST.lists(), request.GET.lists())
-                 if not key.startswith('_')]
+                 for (key,values) in params.items()]
 
   normalizedParams = ','.join( sorted(queryParams) )
   return compactHash(normalizedParams)
 
 
+def normalizeRequestParams(params, graphOptions=None):
+  # Targets and output format may each be given in a couple of ways
+  if 'target[]' in params:
+    targets = params.pop('target[]')
+    params.setdefault('target', targets)
+
+  format = None
+  if 'pickle' in params:
+    format = ['pickle']
+  if 'rawData' in params:
+    format = ['raw']
+  params.pop('pickle', None)
+  params.pop('rawData', None)
+  format = params.get('format', format)
+  if format is not None:
+    params['format'] = format
+
+  if graphOptions is not None:
+    for key in params.keys():
+      if key not in RENDER_PARAMS and key not in graphOptions and not key.startswith('template['):
+        del params[key]
+
+  tzinfo = pytz.timezone(settings.TIME_ZONE)
+  if 'tz' in params:
+    try:
+      tzinfo = pytz.timezone(params['tz'][-1])
+    except pytz.UnknownTimeZoneError:
+      pass
+
+  try:
+    untilTime = parseATTime(params.get('until', ['now'])[-1], tzinfo)
+    fromTime = parseATTime(params.get('from', ['-1d'])[-1], tzinfo)
+  except:
+    return  # invalid times are reported by parseOptions, leave them alone
+
+  startTime = alignTimestamp( epoch(min(fromTime, untilTime)) )
+  endTime = alignTimestamp( epoch(max(fromTime, untilTime)) )
+  params['from'] = [str(startTime)]
+  params['until'] = [str(endTime)]
+
+
+def alignTimestamp(timestamp):
+  resolution = settings.CACHE_KEY_TIME_RESOLUTION
+  if resolution > 1:
+    timestamp -= timestamp % resolution
+  return int(timestamp)
+
+
 def hashData(targets, startTime, endTime):
   targetsString = ','.join(sorted(targets))
-  startTimeString = startTime.strftime("%Y%m%d_%H%M")
-  endTimeString = endTime.strftime("%Y%m%d_%H%M")
+  startTimeString = str( alignTimestamp(toTimestamp(startTime)) )
+  endTimeString = str( alignTimestamp(toTimestamp(endTime)) )
   myHash = targetsString + '@' + startTimeString + ':' + endTimeString
   return compactHash(myHash)
 
 
+def toTimestamp(dt):
+  if dt.tzinfo is None:
+    return mktime(dt.timetuple())
+  return epoch(dt)
+
+
 def compactHash(string):
   hash = md5()
   hash.update(string.encode('utf-8'))
@@ -61,13 +145,21 @@ def compactHash(string):
 
 
 class ConsistentHashRing:
-  def __init__(self, nodes, replica_count=100, hash_type='carbon_ch'):
+  """Maps keys to nodes, each node having replica_count positions on the ring.
+
+  The distinct nodes met walking the ring from each of its positions are
+  computed once, the first time they are needed after the nodes changed, and
+  the nodes of the memo_size most recently looked up keys are remembered, so
+  a lookup costs at most a hash and a bisection."""
+  def __init__(self, nodes, replica_count=100, hash_type='carbon_ch', memo_size=10000):
     self.ring = []
     self.ring_len = len(self.ring)
     self.nodes = set()
     self.nodes_len = len(self.nodes)
     self.replica_count = replica_count
     self.hash_type = hash_type
+    self.successors = None
+    self.memo = LRUCache(memo_size)
     for node in nodes:
       self.add_node(node)
 
@@ -92,12 +184,16 @@ class ConsistentHashRing:
       entry = (position, key)
       bisect.insort(self.ring, entry)
     self.ring_len = len(self.ring)
+    self.successors = None
+    self.memo.clear()
 
   def remove_node(self, key):
     self.nodes.discard(key)
     self.nodes_len = len(self.nodes)
     self.ring = [entry for entry in self.ring if entry[1] != key]
     self.ring_len = len(self.ring)
+    self.successors = None
+    self.memo.clear()
 
   def get_node(self, key):
     assert self.ring
@@ -108,19 +204,47 @@ class ConsistentHashRing:
     return entry[1]
 
   def get_nodes(self, key):
+    "The distinct nodes met walking the ring from the position of key"
+    nodes = self.memo.get(key)
+    if nodes is None:
+      successors = self.successors or self.compute_successors()
+      position = self.compute_ring_position(key)
+      index = bisect.bisect_left(self.ring, (position, None)) % self.ring_len
+      nodes = successors[index]
+      self.memo.set(key, nodes)
+    return list(nodes)
+
+  def get_nodes_many(self, keys):
+    "Same as get_nodes for several keys"
+    return [self.get_nodes(key) for key in keys]
+
+  def compute_successors(self):
+    """Computes the distinct nodes met walking the ring from each position,
+    from the ones of the next position"""
+    ring_nodes = [node for (position, node) in self.ring]
+    ring_len = self.ring_len
+    successors = [()] * ring_len
+
+    # Walking the whole ring from the last position...
     nodes = []
-    position = self.compute_ring_position(key)
-    search_entry = (position, None)
-    index = bisect.bisect_left(self.ring, search_entry) % self.ring_len
-    last_index = (index - 1) % self.ring_len
-    nodes_len = len(nodes)
-    while nodes_len < self.nodes_len and index != last_index:
-      next_entry = self.ring[index]
-      (position, next_node) = next_entry
-      if next_node not in nodes:
-        nodes.append(next_node)
-        nodes_len += 1
-
-      index = (index + 1) % self.ring_len
-
-    return nodes
+    for node in ring_nodes[-1:] + ring_nodes[:-1]:
+      if node not in nodes:
+        nodes.append(node)
+    successors[-1] = tuple(nodes)
+
+    # ...each previous position comes first, followed by the others in order
+    for index in xrange(ring_len - 2, -1, -1):
+      node = ring_nodes[index]
+      successors[index] = (node,) + tuple(n for n in successors[index + 1] if n != node)
+
+    # A walk stops short of the position right before the one it starts at
+    counts = {}
+    for node in ring_nodes:
+      counts[node] = counts.get(node, 0) + 1
+    for index in xrange(ring_len):
+      node = ring_nodes[index - 1]
+      if counts[node] == 1:
+        successors[index] = tuple(n for n in successors[index] if n != node)
+
+    self.successors = successors
+    return successors
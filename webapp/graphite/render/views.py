@@ -27,10 +27,12 @@ try:
 except ImportError:
   import pickle
 
+from graphite.cache import data_cache, get_response, add_response
 from graphite.compat import HttpResponse
 from graphite.util import getProfileByUsername, json, unpickle
 from graphite.remote_storage import connector_class_selector
 from graphite.logger import log
+from graphite.render.datalib import packSeriesList, unpackSeriesList
 from graphite.render.evaluator import evaluateTarget
 from graphite.render.attime import parseATTime
 from graphite.render.functions import PieFunctions
@@ -39,7 +41,6 @@ from graphite.render.glyph import GraphTypes
 
 from django.http import HttpResponseServerError, HttpResponseRedirect
 from django.template import Context, loader
-from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from django.utils.cache import add_never_cache_headers, patch_response_headers
@@ -62,8 +63,8 @@ def renderView(request):
 
   # First we check the request cache
   if useCache:
-    requestKey = hashRequest(request)
-    cachedResponse = cache.get(requestKey)
+    requestKey = hashRequest(request, requestOptions['graphClass'].customizable)
+    cachedResponse = get_response(requestKey)
     if cachedResponse:
       log.cache('Request-Cache hit [%s]' % requestKey)
       log.rendering('Returned cached response in %.6f' % (time() - start))
@@ -95,7 +96,7 @@ def renderView(request):
       startTime = requestOptions['startTime']
       endTime = requestOptions['endTime']
       dataKey = hashData(targets, startTime, endTime)
-      cachedData = cache.get(dataKey)
+      cachedData = getCachedData(dataKey)
       if cachedData:
         log.cache("Data-Cache hit [%s]" % dataKey)
       else:
@@ -115,7 +116,7 @@ def renderView(request):
         data.extend(seriesList)
 
       if useCache:
-        cache.add(dataKey, data, cacheTimeout)
+        data_cache.add(dataKey, packSeriesList(data), cacheTimeout)
 
     # If data is all we needed, we're done
     format = requestOptions.get('format')
@@ -179,7 +180,7 @@ def renderView(request):
                                 content_type='application/json')
 
       if useCache:
-        cache.add(requestKey, response, cacheTimeout)
+        add_response(requestKey, response, cacheTimeout)
         patch_response_headers(response, cache_timeout=cacheTimeout)
       else:
         add_never_cache_headers(response)
@@ -201,7 +202,7 @@ def renderView(request):
       response = HttpResponse(content=result, content_type='application/json')
 
       if useCache:
-        cache.add(requestKey, response, cacheTimeout)
+        add_response(requestKey, response, cacheTimeout)
         patch_response_headers(response, cache_timeout=cacheTimeout)
       else:
         add_never_cache_headers(response)
@@ -223,7 +224,7 @@ def renderView(request):
                                 content_type='application/json')
 
       if useCache:
-        cache.add(requestKey, response, cacheTimeout)
+        add_response(requestKey, response, cacheTimeout)
         patch_response_headers(response, cache_timeout=cacheTimeout)
       else:
         add_never_cache_headers(response)
@@ -272,7 +273,7 @@ def renderView(request):
     response = buildResponse(image, 'image/svg+xml' if useSVG else 'image/png')
 
   if useCache:
-    cache.add(requestKey, response, cacheTimeout)
+    add_response(requestKey, response, cacheTimeout)
     patch_response_headers(response, cache_timeout=cacheTimeout)
   else:
     add_never_cache_headers(response)
@@ -281,6 +282,17 @@ def renderView(request):
   return response
 
 
+def getCachedData(dataKey):
+  payload = data_cache.get(dataKey)
+  if payload is None:
+    return None
+  try:
+    return unpackSeriesList(payload)
+  except:
+    log.exception("Failed to decode cached data [%s]" % dataKey)
+    return None
+
+
 def parseOptions(request):
   queryParams = request.GET.copy()
   queryParams.update(request.POST)
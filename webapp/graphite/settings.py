@@ -64,19 +64,44 @@ CARBONLINK_TIMEOUT = 1.0
 CARBONLINK_HASHING_KEYFUNC = None
 CARBONLINK_HASHING_TYPE = 'carbon_ch'
 CARBONLINK_RETRY_DELAY = 15
+CARBONLINK_POOL_SIZE = 10
+CARBONLINK_POOL_IDLE_TIMEOUT = 60
+CARBONLINK_QUERY_CACHE_DURATION = 0
 REPLICATION_FACTOR = 1
 MEMCACHE_HOSTS = []
 MEMCACHE_KEY_PREFIX = ''
 CACHES={}
 FIND_CACHE_DURATION = 300
 FIND_TOLERANCE = 2 * FIND_CACHE_DURATION
+FIND_NEGATIVE_CACHE_DURATION = 60
+LOCAL_FIND_CACHE_DURATION = 0
+LOCAL_FIND_NEGATIVE_CACHE_DURATION = 0
+LOCAL_FIND_CACHE_MAX_ENTRIES = 1000
+LOCAL_FIND_CACHE_CHECK_MTIME = False
 DEFAULT_CACHE_DURATION = 60 #metric data and graphs are cached for one minute by default
 DEFAULT_CACHE_POLICY = []
+CACHE_KEY_TIME_RESOLUTION = 60
+CACHE_COMPRESSION_THRESHOLD = 0
+CACHE_CHUNK_SIZE = 900 * 1024
+LOCAL_CACHE_MAX_ENTRIES = 0
+LOCAL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+LOCAL_CACHE_DURATION = 5
 
 LOG_CACHE_PERFORMANCE = False
 LOG_ROTATION = True
 LOG_ROTATION_COUNT = 1
 MAX_FETCH_RETRIES = 2
+MAX_FETCHES_IN_FLIGHT = 100
+
+# Concurrency of the work done for a single request
+USE_WORKER_POOL = True
+POOL_MAX_WORKERS = 10
+
+# Maximum number of paths a ** find pattern matches in each of STANDARD_DIRS (0 = unlimited)
+FIND_GLOBSTAR_MAX_RESULTS = 0
+
+# Complete plain metric prefixes from the sorted INDEX_FILE instead of the finders
+COMPLETER_USE_INDEX = False
 
 #Remote rendering settings
 REMOTE_RENDERING = False #if True, rendering is delegated to RENDERING_HOSTS
@@ -1,3 +1,7 @@
+import bisect
+import heapq
+import os.path
+from itertools import groupby
 import time
 
 try:
@@ -7,10 +11,12 @@ except ImportError:  # python < 2.7 compatibility
 
 from django.conf import settings
 
-from graphite.util import is_local_interface, is_pattern
+from graphite.cache import LRUCache
+from graphite.util import is_local_interface, is_pattern, path_key
+from graphite.worker_pool.pool import Job, get_pool, pool_exec
 from graphite.remote_storage import RemoteStore
 from graphite.node import LeafNode
-from graphite.intervals import Interval, IntervalSet
+from graphite.intervals import Interval
 from graphite.readers import MultiReader
 
 
@@ -31,28 +37,53 @@ class Store:
       hosts = settings.CLUSTER_SERVERS
     remote_hosts = [host for host in hosts if not settings.REMOTE_EXCLUDE_LOCAL or not is_local_interface(host)]
     self.remote_stores = [ RemoteStore(host) for host in remote_hosts ]
+    self.find_cache = LRUCache(settings.LOCAL_FIND_CACHE_MAX_ENTRIES)
 
 
-  def find(self, pattern, startTime=None, endTime=None, local=False):
-    query = FindQuery(pattern, startTime, endTime)
+  def find(self, pattern, startTime=None, endTime=None, local=False, limit=None, cursor=None,
+           leaves_only=False, listings=None):
+    """Yields the nodes matching pattern. With a cursor (a metric path) or a
+    limit, only the first limit paths after the cursor are yielded, in path
+    order, and finders can stop searching once they have found them.
+
+    With leaves_only, no branch node is yielded. Finds sharing a listings
+    dict list each directory once between them."""
+    query = FindQuery(pattern, startTime, endTime, limit, cursor, leaves_only, listings)
 
     # Start remote searches
+    remote_requests = []
     if not local:
       remote_requests = [ r.find(query) for r in self.remote_stores if r.available ]
 
+    # A single finder yielding the nodes of each path together has nothing
+    # else to reconcile them with, so they are yielded as soon as its next
+    # path is found and can be fetched right away
+    paginated = query.limit or query.cursor is not None
+    if len(self.finders) == 1 and getattr(self.finders[0], 'ordered_nodes', False) and \
+       not remote_requests and not paginated:
+      for node in self.stream_nodes(self.find_local(0, self.finders[0], query), query):
+        yield node
+      return
+
     matching_nodes = set()
 
-    # Search locally
-    for finder in self.finders:
-      for node in finder.find_nodes(query):
+    # Search locally, running the finders concurrently
+    def search(index, finder):
+      return list(self.find_local(index, finder, query))
+
+    jobs = [Job(search, "find(%s) with %s" % (pattern, finder.__class__.__name__), index, finder)
+            for (index, finder) in enumerate(self.finders)]
+    for job in pool_exec(get_pool(), jobs):
+      for node in job.get_result():
         #log.info("find() :: local :: %s" % node)
-        matching_nodes.add(node)
+        if node.is_leaf or not leaves_only:
+          matching_nodes.add(node)
 
     # Gather remote search results
-    if not local:
-      for request in remote_requests:
-        for node in request.get_results():
-          #log.info("find() :: remote :: %s from %s" % (node,request.store.host))
+    for request in remote_requests:
+      for node in request.get_results():
+        #log.info("find() :: remote :: %s from %s" % (node,request.store.host))
+        if node.is_leaf or not leaves_only:
           matching_nodes.add(node)
 
     # Group matching nodes by their path
@@ -63,10 +94,21 @@ class Store:
 
       nodes_by_path[node.path].append(node)
 
+    # Sources may each have found their own first page
+    paths = nodes_by_path.keys()
+    if paginated:
+      if query.cursor is not None:
+        after = path_key(query.cursor)
+        paths = [path for path in paths if path_key(path) > after]
+      paths.sort(key=path_key)
+      if query.limit:
+        paths = paths[:query.limit]
+
     # Reduce matching nodes for each path to a minimal set
     found_branch_nodes = set()
 
-    for path, nodes in nodes_by_path.iteritems():
+    for path in paths:
+      nodes = nodes_by_path[path]
       leaf_nodes = []
 
       # First we dispense with the BranchNodes
@@ -77,80 +119,75 @@ class Store:
           yield node
           found_branch_nodes.add(node.path)
 
-      if not leaf_nodes:
-        continue
-
-      # Calculate best minimal node set
-      minimal_node_set = set()
-      covered_intervals = IntervalSet([])
-
-      # If the query doesn't fall entirely within the FIND_TOLERANCE window
-      # we disregard the window. This prevents unnecessary remote fetches
-      # caused when carbon's cache skews node.intervals, giving the appearance
-      # remote systems have data we don't have locally, which we probably do.
-      now = int( time.time() )
-      tolerance_window = now - settings.FIND_TOLERANCE
-      disregard_tolerance_window = query.interval.start < tolerance_window
-      prior_to_window = Interval( float('-inf'), tolerance_window )
-
-      def measure_of_added_coverage(node, drop_window=disregard_tolerance_window):
-        relevant_intervals = node.intervals.intersect_interval(query.interval)
-        if drop_window:
-          relevant_intervals = relevant_intervals.intersect_interval(prior_to_window)
-        return covered_intervals.union(relevant_intervals).size - covered_intervals.size
-
-      nodes_remaining = list(leaf_nodes)
-
-      # Prefer local nodes first (and do *not* drop the tolerance window)
-      for node in leaf_nodes:
-        if node.local and measure_of_added_coverage(node, False) > 0:
-          nodes_remaining.remove(node)
-          minimal_node_set.add(node)
-          covered_intervals = covered_intervals.union(node.intervals)
-
-      if settings.REMOTE_STORE_MERGE_RESULTS:
-        remote_nodes = [n for n in nodes_remaining if not n.local]
-        for node in remote_nodes:
-          nodes_remaining.remove(node)
-          minimal_node_set.add(node)
-          covered_intervals = covered_intervals.union(node.intervals)
-      else:
-        while nodes_remaining:
-          node_coverages = [ (measure_of_added_coverage(n), n) for n in nodes_remaining ]
-          best_coverage, best_node = max(node_coverages)
-
-          if best_coverage == 0:
-            break
-
-          nodes_remaining.remove(best_node)
-          minimal_node_set.add(best_node)
-          covered_intervals = covered_intervals.union(best_node.intervals)
-
-        # Sometimes the requested interval falls within the caching window.
-        # We include the most likely node if the gap is within tolerance.
-        if not minimal_node_set:
-          def distance_to_requested_interval(node):
-            latest = sorted(node.intervals, key=lambda i: i.end)[-1]
-            distance = query.interval.start - latest.end
-            return distance if distance >= 0 else float('inf')
-
-          best_candidate = min(leaf_nodes, key=distance_to_requested_interval)
-          if distance_to_requested_interval(best_candidate) <= settings.FIND_TOLERANCE:
-            minimal_node_set.add(best_candidate)
-
-      if len(minimal_node_set) == 1:
-        yield minimal_node_set.pop()
-      elif len(minimal_node_set) > 1:
-        reader = MultiReader(minimal_node_set)
-        yield LeafNode(path, reader)
+      if leaf_nodes:
+        node = merge_leaf_nodes(path, leaf_nodes, query)
+        if node is not None:
+          yield node
+
+  def stream_nodes(self, nodes, query):
+    """Yields the nodes of a finder whose nodes of a same path are found
+    together, as soon as they are. The leaves of a path are reduced to a
+    minimal set, merged into one node, like those of several sources."""
+    found_branch_nodes = set()
+
+    for (path, path_nodes) in groupby(nodes, lambda node: node.path):
+      leaf_nodes = []
+      for node in path_nodes:
+        if node.is_leaf:
+          leaf_nodes.append(node)
+        elif not query.leaves_only and path not in found_branch_nodes:
+          found_branch_nodes.add(path)
+          yield node
+
+      if leaf_nodes:
+        node = merge_leaf_nodes(path, leaf_nodes, query)
+        if node is not None:
+          yield node
 
+  def find_local(self, index, finder, query):
+    """Returns the nodes found by a local finder. Results are cached for
+    LOCAL_FIND_CACHE_DURATION and empty results for
+    LOCAL_FIND_NEGATIVE_CACHE_DURATION, uncached ones are generated lazily."""
+    positive = settings.LOCAL_FIND_CACHE_DURATION
+    negative = settings.LOCAL_FIND_NEGATIVE_CACHE_DURATION
+    if not positive and not negative:
+      return finder.find_nodes(query)
+
+    resolution = positive or negative
+    start = query.startTime
+    if start:
+      start -= start % resolution
+    end = query.endTime
+    if end:
+      end -= end % resolution
+    key = (index, query.pattern, start, end, query.limit, query.cursor, query.leaves_only)
+
+    cached = self.find_cache.get(key)
+    if cached is not None:
+      (nodes, mtimes) = cached
+      if mtimes is None or all(directory_mtime(d) == m for (d, m) in mtimes):
+        return nodes
+
+    nodes = list(finder.find_nodes(query))
+    timeout = positive if nodes else negative
+    if timeout:
+      mtimes = None
+      if settings.LOCAL_FIND_CACHE_CHECK_MTIME:
+        mtimes = [(d, directory_mtime(d)) for d in finder_directories(finder, query.pattern, nodes)]
+      self.find_cache.set(key, (nodes, mtimes), timeout)
+    return nodes
 
 
 class FindQuery:
-  def __init__(self, pattern, startTime, endTime):
+  def __init__(self, pattern, startTime, endTime, limit=None, cursor=None,
+               leaves_only=False, listings=None):
     self.pattern = pattern
     self.startTime = startTime
     self.endTime = endTime
+    self.limit = limit
+    self.cursor = cursor
+    self.leaves_only = leaves_only
+    self.listings = listings
     self.isExact = is_pattern(pattern)
     self.interval = Interval(float('-inf') if startTime is None else startTime,
                              float('inf') if endTime is None else endTime)
@@ -169,4 +206,168 @@ class FindQuery:
 
     return '<FindQuery: %s from %s until %s>' % (self.pattern, startString, endString)
 
+def merge_leaf_nodes(path, leaf_nodes, query):
+  """Returns a single leaf node reading path from the minimal set of
+  leaf_nodes, or None when none of them has data for the query"""
+  minimal_node_set = select_minimal_nodes(leaf_nodes, query)
+
+  if len(minimal_node_set) == 1:
+    return minimal_node_set[0]
+  elif len(minimal_node_set) > 1:
+    reader = MultiReader(minimal_node_set)
+    return LeafNode(path, reader)
+  return None
+
+
+def select_minimal_nodes(leaf_nodes, query, now=None):
+  """Returns the smallest set of leaf_nodes (local ones first) covering as much
+  of the query interval as they all do together.
+
+  Coverage is tracked as sorted lists of disjoint intervals that are updated
+  and measured with bisection, and the greedy selection only re-measures a
+  node when it reaches the top of the heap, as its added coverage can only
+  shrink as more nodes are selected. Ties go to the earliest node."""
+  query_start, query_end = query.interval.start, query.interval.end
+
+  # A lone local node is selected whenever it has data for the query, as it
+  # would be by the greedy selection, without setting it up
+  if len(leaf_nodes) == 1 and leaf_nodes[0].local:
+    relevant = clip_intervals([(i.start, i.end) for i in leaf_nodes[0].intervals], query_start, query_end)
+    if uncovered_size(relevant, [], []) > 0:
+      return list(leaf_nodes)
+
+  minimal_node_set = []
+  covered_starts = []
+  covered_ends = []
+
+  # If the query doesn't fall entirely within the FIND_TOLERANCE window
+  # we disregard the window. This prevents unnecessary remote fetches
+  # caused when carbon's cache skews node.intervals, giving the appearance
+  # remote systems have data we don't have locally, which we probably do.
+  if now is None:
+    now = int( time.time() )
+  tolerance_window = now - settings.FIND_TOLERANCE
+  disregard_tolerance_window = query.interval.start < tolerance_window
+
+  relevant = [clip_intervals([(i.start, i.end) for i in node.intervals], query_start, query_end)
+              for node in leaf_nodes]
+  if disregard_tolerance_window:
+    windowed = [clip_intervals(intervals, query_start, min(query_end, tolerance_window)) for intervals in relevant]
+  else:
+    windowed = relevant
+
+  # Prefer local nodes first (and do *not* drop the tolerance window)
+  remaining = []
+  for (index, node) in enumerate(leaf_nodes):
+    if node.local and uncovered_size(relevant[index], covered_starts, covered_ends) > 0:
+      minimal_node_set.append(node)
+      cover_intervals(relevant[index], covered_starts, covered_ends)
+    else:
+      remaining.append(index)
+
+  if settings.REMOTE_STORE_MERGE_RESULTS:
+    minimal_node_set.extend(leaf_nodes[i] for i in remaining if not leaf_nodes[i].local)
+    return minimal_node_set
+
+  candidates = [(-uncovered_size(windowed[i], covered_starts, covered_ends), i) for i in remaining]
+  candidates = [c for c in candidates if c[0] < 0]
+  heapq.heapify(candidates)
+  while candidates:
+    (_, index) = heapq.heappop(candidates)
+    coverage = uncovered_size(windowed[index], covered_starts, covered_ends)
+    if coverage <= 0:
+      continue
+
+    if candidates and (-coverage, index) > candidates[0]:
+      heapq.heappush(candidates, (-coverage, index))
+      continue
+
+    minimal_node_set.append(leaf_nodes[index])
+    cover_intervals(relevant[index], covered_starts, covered_ends)
+
+  # Sometimes the requested interval falls within the caching window.
+  # We include the most likely node if the gap is within tolerance.
+  if not minimal_node_set:
+    def distance_to_requested_interval(node):
+      if not node.intervals:
+        return float('inf')
+      latest = max(node.intervals, key=lambda i: i.end)
+      distance = query.interval.start - latest.end
+      return distance if distance >= 0 else float('inf')
+
+    best_candidate = min(leaf_nodes, key=distance_to_requested_interval)
+    if distance_to_requested_interval(best_candidate) <= settings.FIND_TOLERANCE:
+      minimal_node_set.append(best_candidate)
+
+  return minimal_node_set
+
+
+def clip_intervals(intervals, start, end):
+  "Returns the (start, end) pairs clipped to start and end, sorted and merged"
+  clipped = []
+  for interval in sorted(intervals):
+    (i_start, i_end) = (max(interval[0], start), min(interval[1], end))
+    if i_end <= i_start:
+      continue
+    if clipped and clipped[-1][1] >= i_start:
+      if i_end > clipped[-1][1]:
+        clipped[-1] = (clipped[-1][0], i_end)
+    else:
+      clipped.append( (i_start, i_end) )
+  return clipped
+
+
+def uncovered_size(intervals, covered_starts, covered_ends):
+  "Returns the size of the part of intervals that isn't covered yet"
+  size = 0
+  count = len(covered_starts)
+  for (start, end) in intervals:
+    size += end - start
+    i = bisect.bisect_right(covered_ends, start)
+    while i < count and covered_starts[i] < end:
+      size -= min(end, covered_ends[i]) - max(start, covered_starts[i])
+      i += 1
+  return size
+
+
+def cover_intervals(intervals, covered_starts, covered_ends):
+  "Merges intervals into the covered ones, in place"
+  for (start, end) in intervals:
+    lo = bisect.bisect_left(covered_ends, start)
+    hi = bisect.bisect_right(covered_starts, end)
+    if lo < hi:
+      start = min(start, covered_starts[lo])
+      end = max(end, covered_ends[hi - 1])
+    covered_starts[lo:hi] = [start]
+    covered_ends[lo:hi] = [end]
+
+
+def finder_directories(finder, pattern, nodes):
+  """Returns the directories whose content determines the result of a find on
+  a filesystem based finder: the literal prefix of the pattern and the parent
+  directory of every node found. The other directories searched under
+  wildcards aren't included, metrics created there aren't noticed."""
+  roots = getattr(finder, 'directories', None) or [getattr(finder, 'directory', None)]
+  roots = [root for root in roots if root]
+
+  prefix = []
+  for part in pattern.split('.')[:-1]:
+    if is_pattern(part):
+      break
+    prefix.append(part)
+
+  parents = set([tuple(prefix)])
+  for node in nodes:
+    parents.add( tuple(node.path.split('.')[:-1]) )
+
+  return [os.path.join(root, *parent) for root in roots for parent in parents]
+
+
+def directory_mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
 STORE = Store()
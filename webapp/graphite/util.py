@@ -19,7 +19,7 @@ import time
 import sys
 import calendar
 import pytz
-from os.path import splitext, basename, relpath
+from os.path import splitext, basename, isdir, join
 from shutil import move
 from tempfile import mkstemp
 try:
@@ -34,9 +34,16 @@ try:
 except ImportError:
   from StringIO import StringIO
 
+try:
+  from scandir import scandir
+except ImportError:
+  scandir = None
+
 from django.conf import settings
 from django.contrib.auth.models import User
 from graphite.account.models import Profile
+from graphite.index import MANIFEST_SUFFIX, TRIGRAMS_SUFFIX, write_trigrams
+from graphite.worker_pool.pool import Job, get_pool, pool_exec
 from graphite.logger import log
 
 
@@ -123,6 +130,11 @@ def find_escaped_pattern_fields(pattern_string):
       yield index
 
 
+def path_key(path):
+  "Sort key ordering metric paths one node at a time, the way a tree is walked"
+  return path.split('.')
+
+
 def default_profile():
     # '!' is an unusable password. Since the default user never authenticates
     # this avoids creating a default (expensive!) password hash at every
@@ -212,45 +224,160 @@ else:
 unpickle = SafeUnpickler
 
 
-def write_index(whisper_dir=None, ceres_dir=None, index=None):
+def write_index(whisper_dir=None, ceres_dir=None, index=None, incremental=True):
+  """Writes the sorted index of the metrics in whisper_dir and ceres_dir,
+  along with its trigram sidecar.
+
+  The directories scanned are recorded in a manifest next to the index, so
+  that an incremental build only lists again the directories modified since
+  the previous one."""
   if not whisper_dir:
     whisper_dir = settings.WHISPER_DIR
   if not ceres_dir:
     ceres_dir = settings.CERES_DIR
   if not index:
     index = settings.INDEX_FILE
+  manifest_file = index + MANIFEST_SUFFIX
+  manifest = read_manifest(manifest_file) if incremental else {}
+  # Both files are written next to the index, so that moving them in place
+  # is atomic and keeps the modification time the trigrams were written for
+  index_dir = os.path.dirname(os.path.abspath(index))
+  tmp = tmp_trigrams = tmp_manifest = None
   try:
-    fd, tmp = mkstemp()
+    fd, tmp = mkstemp(dir=index_dir)
+    trigrams_fd, tmp_trigrams = mkstemp(dir=index_dir)
+    tmp_index = os.fdopen(fd, 'wt')
+    tmp_trigrams_file = os.fdopen(trigrams_fd, 'wb')
     try:
-      tmp_index = os.fdopen(fd, 'wt')
-      build_index(whisper_dir, ".wsp", tmp_index)
-      build_index(ceres_dir, ".ceres-node", tmp_index)
+      # The index is sorted, so that it can be searched by bisection
+      lines = []
+      directories = {}
+      for (base_path, extension) in ((whisper_dir, ".wsp"), (ceres_dir, ".ceres-node")):
+        key = (os.path.abspath(base_path), extension)
+        directories[key] = build_index(base_path, extension, lines, manifest.get(key))
+      lines.sort()
+      tmp_index.writelines(lines)
+      tmp_index.close()
+      write_trigrams(lines, os.stat(tmp).st_mtime, tmp_trigrams_file)
     finally:
       tmp_index.close()
+      tmp_trigrams_file.close()
     move(tmp, index)
+    move(tmp_trigrams, index + TRIGRAMS_SUFFIX)
+
+    manifest_fd, tmp_manifest = mkstemp(dir=index_dir)
+    with os.fdopen(manifest_fd, 'wb') as tmp_manifest_file:
+      pickle.dump(directories, tmp_manifest_file, pickle.HIGHEST_PROTOCOL)
+    move(tmp_manifest, manifest_file)
   finally:
-    try:
-      os.unlink(tmp)
-    except:
-      pass
+    for path in (tmp, tmp_trigrams, tmp_manifest):
+      try:
+        os.unlink(path)
+      except:
+        pass
   return None
 
 
-def build_index(base_path, extension, fd):
+def read_manifest(manifest_file):
+  """The directories recorded by the previous index build, if any. A manifest
+  that can't be read is ignored, so the index is built from scratch."""
+  try:
+    with open(manifest_file, 'rb') as f:
+      manifest = unpickle.loads(f.read())
+    if isinstance(manifest, dict) and all(isinstance(directories, dict) for directories in manifest.values()):
+      return manifest
+    log.info("Ignoring unexpected index manifest %s" % manifest_file)
+  except IOError:
+    pass
+  except Exception:
+    log.exception("Ignoring unreadable index manifest %s" % manifest_file)
+  return {}
+
+
+def build_index(base_path, extension, lines, directories=None):
+  """Appends the index lines of the metrics under base_path to lines and
+  returns the directories scanned, mapped to their modification time,
+  subdirectories and index lines.
+
+  Given those of a previous build as directories, the ones whose
+  modification time did not change are not listed again. Each level of the
+  tree is scanned on the worker pool."""
   t = time.time()
+  previous = directories or {}
+  directories = {}
+  pool = get_pool()
+  pending = ['.']
+
+  while pending:
+    # A few batches of directories per worker, to spread the uneven ones
+    batch_size = max(1, len(pending) // (settings.POOL_MAX_WORKERS * 4))
+    jobs = [Job(scan_index_dirs, "scan %d directories under %s" % (len(batch), base_path),
+                base_path, batch, extension, previous)
+            for batch in (pending[i:i + batch_size] for i in xrange(0, len(pending), batch_size))]
+    pending = []
+    for job in pool_exec(pool, jobs):
+      for (path, entry) in job.get_result():
+        if entry is not None:
+          directories[path] = entry
+          pending.extend(entry[1])
+
   total_entries = 0
-  contents = os.walk(base_path, followlinks=True)
+  rescanned = 0
+  for (path, (mtime, subdirs, dir_lines)) in directories.iteritems():
+    lines.extend(dir_lines)
+    total_entries += len(dir_lines)
+    if previous.get(path) is not directories[path]:
+      rescanned += 1
+  log.info("[IndexSearcher] index rebuild of \"%s\" took %.6f seconds (%d entries, %d of %d directories rescanned)" % (base_path, time.time() - t, total_entries, rescanned, len(directories)))
+  return directories
+
+
+def scan_index_dirs(base_path, paths, extension, previous):
+  return [scan_index_dir(base_path, path, extension, previous.get(path)) for path in paths]
+
+
+def scan_index_dir(base_path, path, extension, cached=None):
+  """Returns path along with the modification time, subdirectories and
+  index lines of the directory at path under base_path, or cached if the
+  directory was not modified since it was scanned"""
+  dir_path = base_path if path == '.' else join(base_path, path)
+  try:
+    mtime = os.stat(dir_path).st_mtime
+    if cached is not None and cached[0] == mtime:
+      return (path, cached)
+    entries = list_dir(dir_path)
+  except OSError:
+    # Like os.walk, skip the directories removed while scanning
+    return (path, None)
+
+  # A directory modified again within the resolution of its modification
+  # time would look unchanged, so a recent one is scanned again next time
+  if mtime >= time.time() - 1:
+    mtime = None
+
+  subdirs = []
+  dir_lines = []
   extension_len = len(extension)
-  for (dirpath, dirnames, filenames) in contents:
-    path = relpath(dirpath, base_path).replace('/', '.')
-    for metric in filenames:
-      if metric.endswith(extension):
-        metric = metric[:-extension_len]
+  for (name, is_dir) in entries:
+    if is_dir:
+      subdirs.append(name if path == '.' else join(path, name))
+    elif name.endswith(extension):
+      metric = name[:-extension_len]
+      if path == '.': # metrics at the top level
+        line = "{0}\n".format(metric)
+      elif not metric: # ceres nodes are the directories themselves
+        line = "{0}\n".format(path.replace('/', '.'))
       else:
-        continue
-      line = "{0}.{1}\n".format(path, metric)
-      total_entries += 1
-      fd.write(line)
-  fd.flush()
-  log.info("[IndexSearcher] index rebuild of \"%s\" took %.6f seconds (%d entries)" % (base_path, time.time() - t, total_entries))
-  return None
+        line = "{0}.{1}\n".format(path.replace('/', '.'), metric)
+      dir_lines.append(line)
+
+  return (path, (mtime, subdirs, dir_lines))
+
+
+def list_dir(path):
+  """Returns (name, is_dir) for the entries of a directory, following
+  symlinks, from the d_type scandir reads along with the names if it is
+  installed"""
+  if scandir is not None:
+    return [(entry.name, entry.is_dir()) for entry in scandir(path)]
+  return [(name, isdir(join(path, name))) for name in os.listdir(path)]
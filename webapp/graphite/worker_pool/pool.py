@@ -0,0 +1,96 @@
+import sys
+import time
+import Queue
+from threading import Lock, local
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+
+_init_lock = Lock()
+_pools = {}
+_worker = local()
+
+
+class PoolTimeoutError(Exception):
+  pass
+
+
+class Job(object):
+  __slots__ = ('func', 'description', 'args', 'kwargs', 'result', 'exception')
+
+  def __init__(self, func, description, *args, **kwargs):
+    self.func = func
+    self.description = description
+    self.args = args
+    self.kwargs = kwargs
+    self.result = None
+    self.exception = None
+
+  def __str__(self):
+    return self.description
+
+  def run(self):
+    try:
+      self.result = self.func(*self.args, **self.kwargs)
+    except:
+      self.exception = sys.exc_info()
+
+  def get_result(self):
+    "Returns the result of the job, re-raising the exception it failed with"
+    if self.exception is not None:
+      raise self.exception[0], self.exception[1], self.exception[2]
+    return self.result
+
+
+def get_pool(name='default', thread_count=None):
+  """Returns the named thread pool, creating it on first use, or None when
+  USE_WORKER_POOL is disabled."""
+  if not settings.USE_WORKER_POOL:
+    return None
+
+  with _init_lock:
+    pool = _pools.get(name)
+    if pool is None:
+      pool = ThreadPool(thread_count or settings.POOL_MAX_WORKERS, initializer=_init_worker, initargs=(name,))
+      _pools[name] = pool
+  return pool
+
+
+def _init_worker(name):
+  _worker.pool_name = name
+
+
+def pool_exec(pool, jobs, timeout=None):
+  """Runs the jobs on the pool and yields each of them as soon as it is done.
+
+  Jobs run inline, in order, when there is no pool, a single job or when
+  called from one of the pool's own threads, where waiting on the pool could
+  deadlock. The threads of another pool can wait on it, as long as its own
+  jobs never wait on theirs."""
+  if pool is None or len(jobs) < 2 or _pools.get(getattr(_worker, 'pool_name', None)) is pool:
+    for job in jobs:
+      job.run()
+      yield job
+    return
+
+  done = Queue.Queue()
+
+  def run(job):
+    job.run()
+    done.put(job)
+
+  for job in jobs:
+    pool.apply_async(run, [job])
+
+  if timeout is None:
+    for _ in xrange(len(jobs)):
+      yield done.get()
+    return
+
+  deadline = time.time() + timeout
+  for _ in xrange(len(jobs)):
+    try:
+      yield done.get(True, max(0, deadline - time.time()))
+    except Queue.Empty:
+      raise PoolTimeoutError("Timed out after %fs waiting for %d jobs" % (timeout, len(jobs)))
@@ -0,0 +1,163 @@
+import mock
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+
+from graphite.cache import CompactCache, LRUCache, TieredCache, chunk_key, encode_response, decode_response
+from graphite.compat import HttpResponse
+
+
+class CompactCacheTest(TestCase):
+
+    def setUp(self):
+        self.backend = LocMemCache('compact-cache-test', {})
+        self.backend.clear()
+        self.cache = CompactCache(self.backend)
+        self.old_threshold = settings.CACHE_COMPRESSION_THRESHOLD
+        self.old_chunk_size = settings.CACHE_CHUNK_SIZE
+
+    def tearDown(self):
+        settings.CACHE_COMPRESSION_THRESHOLD = self.old_threshold
+        settings.CACHE_CHUNK_SIZE = self.old_chunk_size
+
+    def test_raw_payload(self):
+        settings.CACHE_COMPRESSION_THRESHOLD = 0
+        self.assertTrue(self.cache.add('key', 'payload', 60))
+        self.assertEqual(self.cache.get('key'), 'payload')
+        self.assertEqual(self.backend.get('key'), 'rpayload')
+        self.assertFalse(self.cache.add('key', 'other', 60))
+        self.assertEqual(self.cache.get('missing'), None)
+
+    def test_compressed_payload(self):
+        settings.CACHE_COMPRESSION_THRESHOLD = 10
+        payload = 'a' * 1000
+        self.cache.set('key', payload, 60)
+        self.assertEqual(self.cache.get('key'), payload)
+        self.assertTrue(len(self.backend.get('key')) < 100)
+
+    def test_chunked_payload(self):
+        settings.CACHE_COMPRESSION_THRESHOLD = 0
+        settings.CACHE_CHUNK_SIZE = 100
+        payload = ''.join(chr(i % 256) for i in range(1050))
+        self.cache.set('key', payload, 60)
+        self.assertTrue(self.backend.get('key').startswith('c11:'))
+        self.assertEqual(self.cache.get('key'), payload)
+
+        # A missing chunk is a cache miss
+        digest = self.backend.get('key').split(':')[1]
+        self.backend.delete(chunk_key('key', digest, 3))
+        self.assertEqual(self.cache.get('key'), None)
+
+    def test_foreign_entries(self):
+        # Entries cached by previous releases are misses
+        self.backend.set('response', HttpResponse('body'), 60)
+        self.backend.set('series', [1, 2, 3], 60)
+        self.backend.set('marker', 'xpayload', 60)
+        self.backend.set('chunked', 'cbogus', 60)
+        self.backend.set('compressed', 'zbogus', 60)
+        for key in ('response', 'series', 'marker', 'chunked', 'compressed'):
+            self.assertEqual(self.cache.get(key), None)
+
+    def test_response_round_trip(self):
+        response = HttpResponse('{"a": 1}', content_type='application/json', status=201)
+        response['X-Test'] = 'yes'
+        decoded = decode_response(encode_response(response))
+        self.assertEqual(decoded.content, '{"a": 1}')
+        self.assertEqual(decoded.status_code, 201)
+        self.assertEqual(decoded['Content-Type'], 'application/json')
+        self.assertEqual(decoded['X-Test'], 'yes')
+
+
+class LRUCacheTest(TestCase):
+
+    def test_eviction(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+
+    def test_expiry(self):
+        lru = LRUCache(2)
+        lru.set('a', 1, -1)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(len(lru), 0)
+
+    def test_max_bytes(self):
+        lru = LRUCache(10, max_bytes=10)
+        lru.set('a', 'x' * 4)
+        lru.set('b', 'x' * 4)
+        lru.set('a', 'x' * 3)
+        self.assertEqual(lru.size, 7)
+
+        # Least recently used payloads make room, too large ones aren't kept
+        lru.set('c', 'x' * 5)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(sorted(lru.entries), ['a', 'c'])
+        lru.set('d', 'x' * 11)
+        self.assertEqual(lru.get('d'), None)
+        self.assertEqual(lru.size, 8)
+
+        lru.delete('a')
+        self.assertEqual(lru.size, 5)
+        lru.clear()
+        self.assertEqual(lru.size, 0)
+
+
+class TieredCacheTest(TestCase):
+
+    def setUp(self):
+        self.backend = LocMemCache('tiered-cache-test', {})
+        self.backend.clear()
+        self.old_max_entries = settings.LOCAL_CACHE_MAX_ENTRIES
+
+    def tearDown(self):
+        settings.LOCAL_CACHE_MAX_ENTRIES = self.old_max_entries
+
+    def test_local_tier(self):
+        settings.LOCAL_CACHE_MAX_ENTRIES = 10
+        tiered = TieredCache('test', self.backend)
+        self.assertEqual(tiered.get('key'), None)
+        self.assertTrue(tiered.add('key', 'value', 60))
+
+        # Served from the local tier even after the backend forgot the key
+        self.backend.clear()
+        self.assertEqual(tiered.get('key'), 'value')
+        self.assertEqual(tiered.stats(), {
+          'local': {'hits': 1, 'misses': 1},
+          'remote': {'hits': 0, 'misses': 1},
+        })
+
+    def test_remote_hit_fills_local_tier(self):
+        settings.LOCAL_CACHE_MAX_ENTRIES = 10
+        tiered = TieredCache('test', self.backend)
+        self.backend.set('key', 'value', 60)
+        self.assertEqual(tiered.get('key'), 'value')
+        self.assertEqual(tiered.get('key'), 'value')
+        self.assertEqual(tiered.stats(), {
+          'local': {'hits': 1, 'misses': 1},
+          'remote': {'hits': 1, 'misses': 0},
+        })
+
+    def test_stats_log(self):
+        tiered = TieredCache('test', self.backend)
+        with mock.patch('graphite.cache.log') as log:
+            tiered.get('key')
+            self.assertFalse(log.cache.called)
+            with mock.patch('graphite.cache.STATS_LOG_INTERVAL', 0):
+                tiered.get('key')
+            self.assertEqual(log.cache.call_count, 1)
+            self.assertEqual(log.cache.call_args[0][0], "TieredCache test stats: %s" % tiered.stats())
+
+    def test_local_tier_disabled(self):
+        settings.LOCAL_CACHE_MAX_ENTRIES = 0
+        tiered = TieredCache('test', self.backend)
+        tiered.set('key', 'value', 60)
+        self.backend.clear()
+        self.assertEqual(tiered.get('key'), None)
+        self.assertEqual(tiered.stats()['local'], {'hits': 0, 'misses': 0})
@@ -0,0 +1,302 @@
+import socket
+import struct
+import threading
+
+import mock
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from graphite.carbonlink import CarbonLinkPool, CarbonLinkRequestError, ConnectionPool, recv_exactly
+
+
+class FakeCarbon(object):
+    "A carbon cache answering cache queries and metadata requests, on a thread"
+
+    def __init__(self):
+        self.datapoints = {}
+        self.metadata = {}
+        # Cleared to hold the answers back
+        self.answering = threading.Event()
+        self.answering.set()
+        # Set to close the connections instead of answering
+        self.hanging_up = False
+        self.connections = 0
+        self.sockets = []
+        self.requests = []
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                (conn, address) = self.server.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            self.sockets.append(conn)
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        reader = conn.makefile('rb')
+        while True:
+            len_prefix = reader.read(4)
+            if len(len_prefix) < 4:
+                break
+            request = pickle.loads(reader.read(struct.unpack("!L", len_prefix)[0]))
+            self.requests.append(request)
+            if self.hanging_up:
+                break
+            response = pickle.dumps(self.answer(request), protocol=-1)
+            conn.sendall(struct.pack("!L", len(response)) + response)
+        conn.close()
+
+    def answer(self, request):
+        self.answering.wait()
+        if request['type'] == 'cache-query':
+            return dict(datapoints=self.datapoints.get(request['metric'], []))
+
+        key = (request['metric'], request['key'])
+        if request['key'] == 'bad':
+            return dict(error="Unsupported metadata key %s" % request['key'])
+        if request['type'] == 'set-metadata':
+            old_value = self.metadata.get(key)
+            self.metadata[key] = request['value']
+            return dict(old_value=old_value, new_value=request['value'])
+        return dict(value=self.metadata.get(key))
+
+    def disconnect(self):
+        "Closes the connections accepted so far"
+        for conn in self.sockets:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.sockets = []
+
+    def close(self):
+        self.answering.set()
+        # Wakes up the accept() of the serving thread
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server.close()
+
+
+class CarbonLinkPoolTest(TestCase):
+
+    def setUp(self):
+        self.carbons = [FakeCarbon(), FakeCarbon()]
+        for carbon in self.carbons:
+            self.addCleanup(carbon.close)
+        hosts = [('127.0.0.1', carbon.port, str(i)) for (i, carbon) in enumerate(self.carbons)]
+        self.pool = CarbonLinkPool(hosts, 1)
+
+    def test_metadata_many(self):
+        metrics = ['metric.%d' % i for i in range(50)]
+        results = self.pool.set_metadata_many([(metric, 'aggregationMethod', 'sum') for metric in metrics])
+        self.assertEqual(results, [dict(old_value=None, new_value='sum')] * len(metrics))
+
+        values = self.pool.get_metadata_many(metrics + ['metric.new'], 'aggregationMethod')
+        self.assertEqual(values, ['sum'] * len(metrics) + [None])
+        self.assertEqual(self.pool.get_metadata('metric.7', 'aggregationMethod'), 'sum')
+
+        # Requests are sent to the host the metric hashes to, down a single
+        # connection per host
+        for (i, carbon) in enumerate(self.carbons):
+            self.assertEqual(carbon.connections, 1)
+            for request in carbon.requests:
+                self.assertEqual(self.pool.select_host(request['metric']), ('127.0.0.1', str(i)))
+        self.assertEqual(sum(len(carbon.requests) for carbon in self.carbons), 2 * len(metrics) + 2)
+
+    def test_metadata_many_errors(self):
+        values = self.pool.get_metadata_many(['a', 'b'], 'bad')
+        self.assertTrue(all(isinstance(value, CarbonLinkRequestError) for value in values))
+
+        # The hosts that can't be reached fail their own requests only
+        self.carbons[0].close()
+        self.pool.connections[('127.0.0.1', '0')].clear()
+        metrics = ['metric.%d' % i for i in range(20)]
+        for carbon in self.carbons:
+            carbon.metadata.update(((metric, 'key'), metric) for metric in metrics)
+        values = self.pool.get_metadata_many(metrics, 'key')
+        for (metric, value) in zip(metrics, values):
+            if self.pool.select_host(metric) == ('127.0.0.1', '0'):
+                self.assertIsInstance(value, socket.error)
+            else:
+                self.assertEqual(value, metric)
+
+    def test_metadata_many_carbon_metrics(self):
+        # Carbon metrics are sent to every host, whose answers have no value:
+        # they fail on their own without failing the rest of the batch
+        for carbon in self.carbons:
+            carbon.metadata[('foo.bar', 'key')] = 'bar'
+        values = self.pool.get_metadata_many(['carbon.agents.a.cpu', 'foo.bar'], 'key')
+        self.assertIsInstance(values[0], KeyError)
+        self.assertEqual(values[1], 'bar')
+
+    def test_query_all_hosts(self):
+        for (i, carbon) in enumerate(self.carbons):
+            carbon.datapoints['carbon.agents.a.cpu'] = [(120 * i, i), (120 * i + 60, i)]
+        self.assertEqual(sorted(self.pool.query('carbon.agents.a.cpu').items()), [(0, 0), (60, 0), (120, 1), (180, 1)])
+        self.assertEqual([len(carbon.requests) for carbon in self.carbons], [1, 1])
+
+        # Hosts answering too late are left out
+        self.carbons[1].answering.clear()
+        self.pool.timeout = 0.2
+        self.assertEqual(sorted(self.pool.query('carbon.agents.a.cpu').items()), [(0, 0), (60, 0)])
+
+    @override_settings(CARBONLINK_QUERY_CACHE_DURATION=60)
+    def test_query_cache(self):
+        host = self.pool.select_host('metric')
+        carbon = self.carbons[int(host[1])]
+        carbon.datapoints['metric'] = [(60, 1.0)]
+        carbon.answering.clear()
+
+        # Queries for a metric already being queried wait for its datapoints
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.pool.query('metric')))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        carbon.answering.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[(60, 1.0)]] * 5)
+
+        # Which are then reused until they expire
+        carbon.datapoints['metric'] = [(60, 1.0), (120, 2.0)]
+        self.assertEqual(self.pool.query('metric'), [(60, 1.0)])
+        self.assertEqual(len(carbon.requests), 1)
+        self.assertEqual(self.pool.inflight_queries, {})
+
+        with self.settings(CARBONLINK_QUERY_CACHE_DURATION=0):
+            self.assertEqual(self.pool.query('metric'), [(60, 1.0), (120, 2.0)])
+        self.assertEqual(len(carbon.requests), 2)
+
+    @override_settings(CARBONLINK_QUERY_CACHE_DURATION=60)
+    def test_query_cache_failures(self):
+        host = self.pool.select_host('metric')
+        carbon = self.carbons[int(host[1])]
+        carbon.datapoints['metric'] = [(60, 1.0)]
+
+        # The empty result of a failed query is not cached
+        carbon.hanging_up = True
+        self.assertEqual(self.pool.query('metric'), [])
+        carbon.hanging_up = False
+        self.assertEqual(self.pool.query('metric'), [(60, 1.0)])
+        self.assertEqual(self.pool.query('metric'), [(60, 1.0)])
+        self.assertEqual(len(carbon.requests), 2)
+
+        # Nor are the datapoints of carbon metrics some hosts failed to send
+        for (i, carbon) in enumerate(self.carbons):
+            carbon.datapoints['carbon.agents.a.cpu'] = [(120 * i, i), (120 * i + 60, i)]
+        self.carbons[1].hanging_up = True
+        self.assertEqual(sorted(self.pool.query('carbon.agents.a.cpu').items()), [(0, 0), (60, 0)])
+        self.carbons[1].hanging_up = False
+        self.assertEqual(sorted(self.pool.query('carbon.agents.a.cpu').items()),
+                         [(0, 0), (60, 0), (120, 1), (180, 1)])
+
+    def test_unreachable_host(self):
+        host = self.pool.select_host('metric')
+        self.carbons[int(host[1])].close()
+        self.assertRaises(socket.error, self.pool.get_metadata, 'metric', 'key')
+        self.assertRaises(socket.error, self.pool.set_metadata, 'metric', 'key', 'value')
+        self.assertTrue(host in self.pool.last_failure)
+
+    def test_stale_connections(self):
+        host = self.pool.select_host('metric')
+        carbon = self.carbons[int(host[1])]
+        carbon.metadata[('metric', 'key')] = 'value'
+        self.assertEqual(self.pool.get_metadata('metric', 'key'), 'value')
+        self.assertEqual(self.pool.get_metadata('metric', 'key'), 'value')
+        stats = self.pool.stats()[host]
+        self.assertEqual((stats['created'], stats['reused'], stats['idle'], stats['in_use']), (1, 1, 1, 0))
+
+        # Connections closed while idle are found before use
+        carbon.disconnect()
+        self.assertEqual(self.pool.get_metadata('metric', 'key'), 'value')
+        stats = self.pool.stats()[host]
+        self.assertEqual((stats['created'], stats['stale'], stats['retried']), (2, 1, 0))
+
+        # Or when they turn out to be closed, and the request is sent again
+        carbon.disconnect()
+        with mock.patch('graphite.carbonlink.still_connected', return_value=True):
+            self.assertEqual(self.pool.get_metadata('metric', 'key'), 'value')
+        stats = self.pool.stats()[host]
+        self.assertEqual((stats['created'], stats['retried'], stats['discarded']), (3, 1, 1))
+        self.assertEqual(self.pool.last_failure, {})
+        self.assertEqual(carbon.connections, 3)
+
+
+class ConnectionPoolTest(TestCase):
+
+    def connection(self):
+        (conn, peer) = socket.socketpair()
+        self.addCleanup(peer.close)
+        self.addCleanup(conn.close)
+        self.peers[conn] = peer
+        return conn
+
+    def setUp(self):
+        self.peers = {}
+        self.pool = ConnectionPool(2, 60)
+
+    def test_pool(self):
+        conns = [self.connection() for _ in range(3)]
+        for conn in conns:
+            self.pool.opened(conn)
+            self.pool.put(conn)
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(self.pool.stats()['discarded'], 1)
+
+        # The most recently used first, skipping those closed by the host
+        self.peers[conns[1]].close()
+        self.assertEqual(self.pool.get(), conns[0])
+        self.assertEqual(self.pool.get(), None)
+        self.assertEqual(self.pool.stats(), dict(created=3, reused=1, expired=0, stale=1, retried=0,
+                                                 discarded=1, idle=0, in_use=1))
+
+    def test_idle_timeout(self):
+        conn = self.connection()
+        self.pool.opened(conn)
+        self.pool.put(conn)
+        self.pool.idle_timeout = -1
+        self.assertEqual(self.pool.get(), None)
+        self.assertEqual(self.pool.stats()['expired'], 1)
+
+
+class RecvExactlyTest(TestCase):
+
+    def test_recv_exactly(self):
+        (reader, writer) = socket.socketpair()
+        self.addCleanup(reader.close)
+        payload = pickle.dumps([(i, float(i)) for i in range(10000)], protocol=-1)
+
+        # The payload arrives in several pieces
+        def write():
+            for i in range(0, len(payload), 1000):
+                writer.sendall(payload[i:i + 1000])
+            writer.close()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        buf = recv_exactly(reader, len(payload) - 10)
+        self.assertEqual(bytes(buf), payload[:-10])
+        self.assertEqual(bytes(recv_exactly(reader, 10)), payload[-10:])
+        thread.join()
+
+        self.assertRaises(Exception, recv_exactly, reader, 1)
@@ -1,3 +1,4 @@
+import fnmatch
 import gzip
 import os
 from os.path import join, dirname, isdir
@@ -5,9 +6,12 @@ import random
 import shutil
 import time
 
+import mock
 from django.test import TestCase
 from django.conf import settings
 
+from graphite.finders import expand_braces, match_entries
+from graphite.finders.standard import StandardFinder
 from graphite.intervals import Interval, IntervalSet
 from graphite.node import LeafNode, BranchNode
 from graphite.storage import Store, FindQuery, get_finder
@@ -57,6 +61,29 @@ class DummyFinder(object):
                 yield LeafNode(path, DummyReader(path))
 
 
+class MatchEntriesTest(TestCase):
+    entries = ['foo', 'bar', 'baz', 'foobar', 'a,b', 'a{b', 'a}b', 'ab',
+               'b}', 'x[y', 'x!', '', '{c}', 'c']
+
+    def expected(self, pattern):
+        matching = set()
+        for variant in expand_braces(pattern):
+            matching.update(fnmatch.filter(self.entries, variant))
+        return matching
+
+    def test_match_entries(self):
+        patterns = ['foo', '*', 'ba?', '{foo,bar}', '{foo,ba}*', 'a{,}b',
+                    '{a,b}{b,}', 'a{b', 'a}b', 'a\\}b', '{a{b,c}}', '{}',
+                    'x[!a]', 'x[y', '[!x]*', '{[bf]oo,c}', '\\{c\\}', 'b}']
+        for pattern in patterns:
+            self.assertEqual(set(match_entries(self.entries, pattern)),
+                             self.expected(pattern), pattern)
+
+    def test_match_entries_order(self):
+        self.assertEqual(match_entries(self.entries, '{foo*,ba?}'),
+                         ['foo', 'bar', 'baz', 'foobar'])
+
+
 class StandardFinderTest(TestCase):
     _listdir_counter = 0
     _original_listdir = os.listdir
@@ -239,6 +266,133 @@ class StandardFinderTest(TestCase):
             self.assertNotIn(miss, paths)
             self.wipe_whisper()
 
+    def test_limit_and_cursor(self):
+        self.addCleanup(self.wipe_whisper)
+        for path in ["foo.e", "foo.a", "foo.d", "foo.c", "foo.b", "foo.c.x", "bar.a"]:
+            self.create_whisper(join(path.replace(".", os.sep)) + ".wsp")
+        finder = get_finder('graphite.finders.standard.StandardFinder')
+
+        nodes = finder.find_nodes(FindQuery('foo.*', None, None, limit=2))
+        self.assertEqual([node.path for node in nodes], ["foo.a", "foo.b"])
+
+        # foo.c is both a leaf and a branch
+        nodes = finder.find_nodes(FindQuery('foo.*', None, None, limit=2, cursor='foo.b'))
+        self.assertEqual(sorted((node.path, node.is_leaf) for node in nodes),
+                         [("foo.c", False), ("foo.c", True), ("foo.d", True)])
+
+        nodes = finder.find_nodes(FindQuery('*.*', None, None, cursor='bar.a'))
+        self.assertEqual([node.path for node in nodes],
+                         ["foo.a", "foo.b", "foo.c", "foo.c", "foo.d", "foo.e"])
+
+        nodes = finder.find_nodes(FindQuery('foo.**', None, None, limit=4))
+        self.assertEqual([node.path for node in nodes], ["foo.a", "foo.b", "foo.c", "foo.c", "foo.c.x"])
+
+    def test_several_directories(self):
+        self.addCleanup(self.wipe_whisper)
+        for path in ["one.foo.a", "one.foo.c", "one.zoo.a", "two.foo.a", "two.foo.b", "two.zoo.b"]:
+            self.create_whisper(join(path.replace(".", os.sep)) + ".wsp")
+        directories = [join(self.test_dir, 'one'), join(self.test_dir, 'two')]
+        finder = StandardFinder(directories)
+
+        listed = []
+        def listdir_mock(d):
+            listed.append(d)
+            return self._original_listdir(d)
+
+        # The directories are merged in path order as they are walked
+        with mock.patch('os.listdir', listdir_mock):
+            nodes = finder.find_nodes(FindQuery('*.*', None, None))
+            first = next(nodes)
+            self.assertEqual(first.path, "foo.a")
+            self.assertFalse([d for d in listed if d.endswith('zoo')])
+            nodes = [first] + list(nodes)
+
+        self.assertEqual([(node.path, node.reader.fs_path) for node in nodes], [
+            ("foo.a", join(directories[0], 'foo', 'a.wsp')),
+            ("foo.a", join(directories[1], 'foo', 'a.wsp')),
+            ("foo.b", join(directories[1], 'foo', 'b.wsp')),
+            ("foo.c", join(directories[0], 'foo', 'c.wsp')),
+            ("zoo.a", join(directories[0], 'zoo', 'a.wsp')),
+            ("zoo.b", join(directories[1], 'zoo', 'b.wsp')),
+        ])
+
+    def test_leaves_only(self):
+        self.addCleanup(self.wipe_whisper)
+        for path in ["foo.a", "foo.b.x", "foo.c", "foo.c.x"]:
+            self.create_whisper(join(path.replace(".", os.sep)) + ".wsp")
+        finder = get_finder('graphite.finders.standard.StandardFinder')
+
+        for (pattern, leaves) in [('foo.*', ["foo.a", "foo.c"]),
+                                  ('{foo,bar}.[abc]', ["foo.a", "foo.c"]),
+                                  ('foo.**', ["foo.a", "foo.b.x", "foo.c", "foo.c.x"])]:
+            nodes = finder.find_nodes(FindQuery(pattern, None, None, leaves_only=True))
+            self.assertEqual(sorted((node.path, node.is_leaf) for node in nodes),
+                             [(leaf, True) for leaf in leaves])
+
+    def test_shared_listings(self):
+        self.addCleanup(self.wipe_whisper)
+        for path in ["foo.a.x", "foo.b.x", "bar.a.x"]:
+            self.create_whisper(join(path.replace(".", os.sep)) + ".wsp")
+        finder = get_finder('graphite.finders.standard.StandardFinder')
+
+        listed = []
+        def listdir_mock(d):
+            listed.append(d)
+            return self._original_listdir(d)
+
+        listings = {}
+        with mock.patch('os.listdir', listdir_mock):
+            for pattern in ['*.a.x', '*.*.x', 'foo.*']:
+                nodes = finder.find_nodes(FindQuery(pattern, None, None, listings=listings))
+                self.assertTrue(list(nodes))
+
+        self.assertEqual(sorted(listed), sorted([self.test_dir, join(self.test_dir, 'bar'), join(self.test_dir, 'foo')]))
+
+    def test_globstar_walks_each_directory_once(self):
+        self.addCleanup(self.wipe_whisper)
+        for path in ["x.x.x", "x._.x.x", "x.x._.x", "x._._.x.x", "o.x.x.x"]:
+            self.create_whisper(join(path.replace(".", os.sep)) + ".wsp")
+        finder = get_finder('graphite.finders.standard.StandardFinder')
+
+        listed = []
+        def listdir_mock(d):
+            listed.append(d)
+            return self._original_listdir(d)
+
+        with mock.patch('os.listdir', listdir_mock), \
+                mock.patch('graphite.finders.standard.scandir', None):
+            paths = [node.path for node in finder.find_nodes(FindQuery('x.**.x.**.x', None, None))]
+
+        self.assertEqual(sorted(paths), ["x._._.x.x", "x._.x.x", "x.x._.x", "x.x.x"])
+        self.assertEqual(len(listed), len(set(listed)))
+        self.assertFalse([d for d in listed if d.startswith(join(self.test_dir, 'o'))])
+
+    def test_globstar_skips_symlinks(self):
+        self.addCleanup(self.wipe_whisper)
+        self.create_whisper(join('x', 'a', 'x.wsp'))
+        os.symlink(join(self.test_dir, 'x', 'a'), join(self.test_dir, 'x', 'b'))
+        finder = get_finder('graphite.finders.standard.StandardFinder')
+
+        paths = [node.path for node in finder.find_nodes(FindQuery('x.**.x', None, None))]
+        self.assertEqual(paths, ["x.a.x"])
+
+        paths = [node.path for node in finder.find_nodes(FindQuery('x.*.x', None, None))]
+        self.assertEqual(sorted(paths), ["x.a.x", "x.b.x"])
+
+    def test_globstar_max_results(self):
+        self.addCleanup(self.wipe_whisper)
+        for i in range(5):
+            self.create_whisper(join('x', str(i), 'x.wsp'))
+        finder = get_finder('graphite.finders.standard.StandardFinder')
+
+        with self.settings(FIND_GLOBSTAR_MAX_RESULTS=2):
+            nodes = list(finder.find_nodes(FindQuery('x.**.x', None, None)))
+        self.assertEqual(len(nodes), 2)
+
+        with self.settings(FIND_GLOBSTAR_MAX_RESULTS=0):
+            nodes = list(finder.find_nodes(FindQuery('x.**.x', None, None)))
+        self.assertEqual(len(nodes), 5)
+
 
 class CeresFinderTest(TestCase):
     _listdir_counter = 0
@@ -278,18 +432,18 @@ class CeresFinderTest(TestCase):
             self._listdir_counter = 0
             nodes = finder.find_nodes(FindQuery('foo', None, None))
             self.assertEqual(len(list(nodes)), 1)
-            self.assertEqual(self._listdir_counter, 2)
+            self.assertEqual(self._listdir_counter, 1)
 
             self._listdir_counter = 0
             nodes = finder.find_nodes(FindQuery('foo.bar.baz', None, None))
             self.assertEqual(len(list(nodes)), 1)
-            self.assertEqual(self._listdir_counter, 2)
+            self.assertEqual(self._listdir_counter, 1)
 
-            # No data in the expected time period
+            # No data in the expected time period, slice info is cached
             self._listdir_counter = 0
             nodes = finder.find_nodes(FindQuery('foo.bar.baz', 10000, 10060))
             self.assertEqual(len(list(nodes)), 0)
-            self.assertEqual(self._listdir_counter, 1)
+            self.assertEqual(self._listdir_counter, 0)
 
             self._listdir_counter = 0
             nodes = finder.find_nodes(FindQuery('foo.bar', None, None))
@@ -299,7 +453,7 @@ class CeresFinderTest(TestCase):
             self._listdir_counter = 0
             nodes = finder.find_nodes(FindQuery('*.ba?.{baz,foo}', None, None))
             self.assertEqual(len(list(nodes)), 2)
-            self.assertEqual(self._listdir_counter, 10)
+            self.assertEqual(self._listdir_counter, 4)
 
             # Search for something that isn't valid Ceres content
             fh = open(join(test_dir, 'foo', 'blah'), 'wb')
@@ -309,6 +463,11 @@ class CeresFinderTest(TestCase):
             self.assertEqual(len(list(nodes)), 0)
             self.assertEqual(self._listdir_counter, 0)
 
+            # Writing datapoints invalidates the cached slice info
+            ceres.CeresTree(test_dir).store('foo.bar.baz', [(10020, 1)])
+            nodes = finder.find_nodes(FindQuery('foo.bar.baz', 10000, 10060))
+            self.assertEqual(len(list(nodes)), 1)
+
         finally:
             os.listdir = self._original_listdir
             wipe_ceres()
@@ -0,0 +1,167 @@
+import os
+import re
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from graphite.index import MetricIndex, TRIGRAMS_SUFFIX, required_literals, write_trigrams
+
+PATHS = [
+    'a.b.cache',
+    'a.b.cpu',
+    'a.b.cpu',
+    'a.b.cpu-1.user',
+    'a.b.cpu.system',
+    'a.b.cpu.user',
+    'a.b.disk',
+    'a.c',
+    'ab',
+    'top',
+]
+
+
+class MetricIndexTest(TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.test_dir, 'index')
+        self.write_index(PATHS)
+        self.index = MetricIndex(self.index_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_index(self, paths):
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as index_file:
+            index_file.write(''.join(path + '\n' for path in sorted(paths)))
+        os.rename(tmp, self.index_file)
+
+    def find(self, prefix, limit=None):
+        return [(node.path, node.is_leaf) for node in self.index.find(prefix, limit)]
+
+    def test_find(self):
+        self.assertEqual(self.find(''), [('a', False), ('ab', True), ('top', True)])
+        self.assertEqual(self.find('a'), [('a', False), ('ab', True)])
+        self.assertEqual(self.find('a.b.'), [
+            ('a.b.cache', True),
+            ('a.b.cpu', True),
+            ('a.b.cpu', False),
+            ('a.b.cpu-1', False),
+            ('a.b.disk', True),
+        ])
+        self.assertEqual(self.find('a.b.cp'), [('a.b.cpu', True), ('a.b.cpu', False), ('a.b.cpu-1', False)])
+        self.assertEqual(self.find('a.b.cpu.'), [('a.b.cpu.system', True), ('a.b.cpu.user', True)])
+        self.assertEqual(self.find('a.b.x'), [])
+        self.assertEqual(self.find('zzz'), [])
+
+    def test_limit(self):
+        # Paths come in path_key order, so a.b.cpu-1 isn't found before a.b.cpu
+        self.assertEqual(self.find('a.b.', limit=2), [('a.b.cache', True), ('a.b.cpu', True), ('a.b.cpu', False)])
+        self.assertEqual(self.find('a.b.', limit=3),
+                         [('a.b.cache', True), ('a.b.cpu', True), ('a.b.cpu', False), ('a.b.cpu-1', False)])
+
+    def test_lower_bound(self):
+        self.index.refresh()
+        index_map = self.index.map
+        lines = ''.join(path + '\n' for path in PATHS)
+        for key in PATHS + ['', 'a.b.cpu.', 'a.b.d', 'b', 'zzz']:
+            offset = self.index.lower_bound(index_map, key)
+            self.assertEqual(offset, sum(len(path) + 1 for path in PATHS if path < key))
+            self.assertTrue(offset == 0 or lines[offset - 1] == '\n')
+
+    def test_replaced(self):
+        self.assertEqual(self.find('top'), [('top', True)])
+        self.write_index(PATHS + ['topmost'])
+        self.assertEqual(self.find('top'), [('top', True), ('topmost', True)])
+
+        self.write_index([])
+        self.assertEqual(self.find(''), [])
+
+        os.unlink(self.index_file)
+        self.assertEqual(self.find(''), [])
+
+
+class TrigramSearchTest(TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.test_dir, 'index')
+        self.index = MetricIndex(self.index_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_index(self, paths, trigrams=True):
+        lines = [path + '\n' for path in sorted(paths)]
+        with open(self.index_file, 'w') as index_file:
+            index_file.writelines(lines)
+        if trigrams:
+            with open(self.index_file + TRIGRAMS_SUFFIX, 'wb') as trigrams_file:
+                write_trigrams(lines, os.stat(self.index_file).st_mtime, trigrams_file)
+
+    def test_required_literals(self):
+        self.assertEqual(required_literals('cpu'), ['cpu'])
+        self.assertEqual(required_literals('cpu.user'), ['cpu', 'user'])
+        self.assertEqual(required_literals(r'cpu\.user'), ['cpu.user'])
+        self.assertEqual(required_literals('^servers.*load$'), ['servers', 'load'])
+        self.assertEqual(required_literals('cpus?x'), ['cpu', 'x'])
+        self.assertEqual(required_literals('ab+c'), ['ab', 'c'])
+        self.assertEqual(required_literals('ab{2,3}c'), ['a', 'c'])
+        self.assertEqual(required_literals(r'disk[0-9]\d+used'), ['disk', 'used'])
+        self.assertEqual(required_literals('[]x]abc'), ['abc'])
+        self.assertEqual(required_literals('cpu|mem'), None)
+        self.assertEqual(required_literals('(cpu)?x'), None)
+
+    def test_search(self):
+        paths = ['servers.%s.%s' % (host, metric)
+                 for host in ('web1', 'web2', 'db1')
+                 for metric in ('cpu.user', 'cpu.system', 'Load.midterm', 'disk0.used')]
+        self.write_index(paths)
+        queries = [['cpu'], ['load'], ['LOAD.MID'], ['db1.*user'], ['web\\d'], ['used', 'system'],
+                   ['xyz'], ['d.'], ['cpu|load'], ['(?i)disk'], ['^servers.web2'], ['k0.u']]
+
+        for patterns in queries:
+            expected = sorted(path for path in paths
+                              if any(re.search(p, path, re.I) for p in patterns))
+            self.assertEqual(self.index.search(patterns), expected)
+
+            # Without the sidecar, the whole index is scanned
+            self.write_index(paths, trigrams=False)
+            os.unlink(self.index_file + TRIGRAMS_SUFFIX)
+            self.assertEqual(self.index.search(patterns), expected)
+            self.write_index(paths)
+
+        self.assertEqual(len(self.index.search(['serv'], 5)), 5)
+
+    def test_narrowed(self):
+        self.write_index(['a.cpu', 'b.cpu', 'c.mem'])
+        self.index.refresh()
+        self.index.trigrams.refresh()
+        trigrams_map = self.index.trigrams.map
+        self.assertTrue(self.index.trigrams.covers(trigrams_map, self.index.file_id))
+        self.assertEqual(list(self.index.trigrams.candidates(trigrams_map, ['cpu'])), [0, 1])
+        self.assertEqual(list(self.index.trigrams.candidates(trigrams_map, ['CPU', 'mem$'])), [0, 1, 2])
+        self.assertEqual(list(self.index.trigrams.candidates(trigrams_map, ['cpux'])), [])
+        self.assertEqual(self.index.trigrams.candidates(trigrams_map, ['c.']), None)
+
+    def test_stale_sidecar(self):
+        self.write_index(['a.cpu', 'b.cpu'])
+        with open(self.index_file + TRIGRAMS_SUFFIX, 'rb') as trigrams_file:
+            stale = trigrams_file.read()
+        self.write_index(['a.cpu', 'b.cpu', 'c.cpu'], trigrams=False)
+        with open(self.index_file + TRIGRAMS_SUFFIX, 'wb') as trigrams_file:
+            trigrams_file.write(stale)
+
+        self.assertEqual(self.index.search(['cpu']), ['a.cpu', 'b.cpu', 'c.cpu'])
+
+    def test_paths(self):
+        self.write_index(['b.cpu', 'a.cpu', 'a.cpu'])
+        self.assertEqual(list(self.index.paths()), ['a.cpu', 'b.cpu'])
+
+        # Indexes written before they were sorted have no sidecar
+        os.unlink(self.index_file + TRIGRAMS_SUFFIX)
+        with open(self.index_file, 'w') as index_file:
+            index_file.write('b.cpu\na.cpu\nc.cpu\na.cpu\n')
+        self.assertEqual(list(self.index.paths()), ['a.cpu', 'b.cpu', 'c.cpu'])
@@ -0,0 +1,72 @@
+import pickle
+import random
+
+from django.test import TestCase
+
+from graphite.intervals import Interval, IntervalSet
+from graphite.util import unpickle
+
+
+# IntervalSet([Interval(0, 10), Interval(20, 30)]) as pickled by the former
+# list based implementation
+LEGACY_PICKLE = (
+    '\x80\x02(cgraphite.intervals\nIntervalSet\nq\x00oq\x01}q\x02(U\tintervalsq'
+    '\x03]q\x04((cgraphite.intervals\nInterval\nq\x05oq\x06}q\x07(U\x05startq\x08'
+    'K\x00U\x04sizeq\tK\nU\x03endq\nK\nU\x05tupleq\x0bK\x00K\n\x86q\x0cub(h\x05oq'
+    '\r}q\x0e(h\x08K\x14h\tK\nh\nK\x1eh\x0bK\x14K\x1e\x86q\x0fubeh\tK\x14ub.')
+
+
+def points(interval_set):
+    # The integer points covered by a set, to check operations against
+    return set(t for i in interval_set for t in range(i.start, i.end))
+
+
+class IntervalSetTest(TestCase):
+
+    def random_set(self, rng):
+        intervals = []
+        for i in range(rng.randint(0, 6)):
+            start = rng.randint(0, 100)
+            intervals.append(Interval(start, start + rng.randint(1, 20)))
+        return IntervalSet(intervals)
+
+    def test_init(self):
+        interval_set = IntervalSet([Interval(20, 30), Interval(0, 10), Interval(5, 12), Interval(30, 35)])
+        self.assertEqual(interval_set.intervals, [Interval(0, 12), Interval(20, 35)])
+        self.assertEqual(interval_set.size, 27)
+        self.assertFalse(IntervalSet([]))
+
+    def test_operations(self):
+        rng = random.Random(7)
+        for i in range(500):
+            a = self.random_set(rng)
+            b = self.random_set(rng)
+            interval = Interval(*sorted([rng.randint(0, 120), rng.randint(0, 120)]))
+
+            self.assertEqual(points(a.union(b)), points(a) | points(b))
+            self.assertEqual(points(a.intersect(b)), points(a) & points(b))
+            self.assertEqual(points(a - b), points(a) - points(b))
+            self.assertEqual(points(a.intersect_interval(interval)),
+                             points(a) & set(range(interval.start, interval.end)))
+
+            union = a.union(b)
+            self.assertEqual(union.size, len(points(union)))
+            self.assertEqual(union.intervals, IntervalSet(a.intervals + b.intervals).intervals)
+
+    def test_complement(self):
+        interval_set = IntervalSet([Interval(float('-inf'), 0), Interval(10, 20)])
+        self.assertEqual(interval_set.complement().intervals,
+                         [Interval(0, 10), Interval(20, float('inf'))])
+
+    def test_pickle(self):
+        interval_set = unpickle.loads(LEGACY_PICKLE)
+        self.assertEqual(interval_set.intervals, [Interval(0, 10), Interval(20, 30)])
+        self.assertEqual(interval_set.size, 20)
+
+        # Pickles keep the legacy state so that older peers can load them
+        interval_set = IntervalSet([Interval(20, 30), Interval(0, 12)])
+        self.assertEqual(interval_set.__getstate__(),
+                         {'intervals': [Interval(0, 12), Interval(20, 30)], 'size': 22})
+        loaded = unpickle.loads(pickle.dumps(interval_set, protocol=-1))
+        self.assertEqual(loaded.intervals, interval_set.intervals)
+        self.assertEqual(loaded.size, 22)
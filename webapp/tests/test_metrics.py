@@ -1,8 +1,10 @@
 import copy
 import json
+import mock
 import os
 import shutil
 import time
+from StringIO import StringIO
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
@@ -10,7 +12,9 @@ from django.test import TestCase
 
 import whisper
 
-from graphite.util import unpickle
+from graphite.metrics.views import page_nodes
+from graphite.node import BranchNode, LeafNode
+from graphite.util import unpickle, write_index
 
 
 class MetricsTester(TestCase):
@@ -55,14 +59,24 @@ class MetricsTester(TestCase):
 
         url = reverse('graphite.metrics.views.index_json')
 
-        # default
-        request = {}
-        response = self.client.post(url, request)
-        self.assertEqual(response.status_code, 200)
-        data = json.loads(response.content)
+        def get_index(request):
+            response = self.client.post(url, request)
+            self.assertEqual(response.status_code, 200)
+            return ''.join(response.streaming_content)
+
+        # default, walking the storage directories without an index
+        if os.path.exists(settings.INDEX_FILE):
+            os.remove(settings.INDEX_FILE)
+        data = json.loads(get_index({}))
         self.assertEqual(data[0], 'hosts.worker1.cpu')
         self.assertEqual(data[1], 'hosts.worker2.cpu')
 
+        # from the index file once it is built
+        write_index()
+        os.remove(self.hostcpu.replace('hostname', 'worker2'))
+        data = json.loads(get_index({}))
+        self.assertEqual(data, ['hosts.worker1.cpu', 'hosts.worker2.cpu'])
+
         # XXX Disabling this test for now since a local running
         # Graphite webapp will always return a 200, breaking our test
         ## cluster failure
@@ -73,13 +87,30 @@ class MetricsTester(TestCase):
         #self.assertEqual(data, [])
 
         # jsonp
-        request = {'jsonp': 'callback'}
-        response = self.client.post(url, request)
-        self.assertEqual(response.status_code, 200)
-        data = json.loads(response.content.split("(")[1].strip(")"))
+        content = get_index({'jsonp': 'callback'})
+        data = json.loads(content.split("(")[1].strip(")"))
         self.assertEqual(data[0], 'hosts.worker1.cpu')
         self.assertEqual(data[1], 'hosts.worker2.cpu')
 
+    def test_index_json_cluster(self):
+        url = reverse('graphite.metrics.views.index_json')
+        indexes = {
+            'http://127.1.1.1/metrics/index.json': ['b.c', 'x', 'a'],
+            'http://127.1.1.2/metrics/index.json': ['a', 'z'],
+        }
+
+        # peers are merged into a single sorted list
+        with mock.patch('urllib2.urlopen', side_effect=lambda url: StringIO(json.dumps(indexes[url]))):
+            response = self.client.post(url, {'cluster': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(''.join(response.streaming_content)), ['a', 'b.c', 'x', 'z'])
+
+        # cluster failure
+        with mock.patch('urllib2.urlopen', side_effect=IOError('unreachable')):
+            response = self.client.post(url, {'cluster': 1})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(json.loads(response.content), [])
+
 
     def test_find_view(self):
         self.create_whisper_hosts()
@@ -286,6 +317,72 @@ class MetricsTester(TestCase):
         data = json.loads(content)
         self.assertEqual(data, {u'nodes': [u'hosts']})
 
+        #
+        # limit, offset and cursor
+        #
+        request=copy.deepcopy(request_default)
+        request['format']='completer'
+        request['query']='hosts.*'
+        request['limit']='1'
+        response = self.client.post(url, request)
+        self.assertEqual(response['X-Graphite-Next-Cursor'], 'hosts.worker1')
+        data = json.loads(response.content)
+        self.assertEqual([m['path'] for m in data['metrics']], ['hosts.worker1.'])
+
+        # The last page has no next cursor
+        request['cursor']='hosts.worker1'
+        response = self.client.post(url, request)
+        self.assertFalse(response.has_header('X-Graphite-Next-Cursor'))
+        data = json.loads(response.content)
+        self.assertEqual([m['path'] for m in data['metrics']], ['hosts.worker2.'])
+
+        request['cursor']='hosts.worker2'
+        response = self.client.post(url, request)
+        self.assertFalse(response.has_header('X-Graphite-Next-Cursor'))
+        data = json.loads(response.content)
+        self.assertEqual(data['metrics'], [])
+
+        del request['cursor']
+        request['offset']='1'
+        response = self.client.post(url, request)
+        data = json.loads(response.content)
+        self.assertEqual([m['path'] for m in data['metrics']], ['hosts.worker2.'])
+
+        #
+        # format=completer from the index file
+        #
+        write_index()
+        self.addCleanup(os.remove, settings.INDEX_FILE)
+        with self.settings(COMPLETER_USE_INDEX=True):
+            request=copy.deepcopy(request_default)
+            request['format']='completer'
+            request['local']=1
+            request['query']='hosts.worker'
+            content = test_find_view_basics(request)
+            data = json.loads(content)
+            self.assertEqual(data['metrics'], [
+                {u'path': u'hosts.worker1.', u'name': u'worker1', u'is_leaf': u'0'},
+                {u'path': u'hosts.worker2.', u'name': u'worker2', u'is_leaf': u'0'},
+            ])
+
+            request['query']='hosts.worker1.'
+            content = test_find_view_basics(request)
+            data = json.loads(content)
+            self.assertEqual(data['metrics'], [
+                {u'path': u'hosts.worker1.cpu', u'name': u'cpu', u'is_leaf': u'1'},
+            ])
+
+
+    def test_page_nodes(self):
+        nodes = [BranchNode('a'), LeafNode('a', None), LeafNode('b', None), LeafNode('b', None),
+                 BranchNode('c'), LeafNode('d', None)]
+        pages = [page_nodes(iter(nodes), offset, 2) for offset in (0, 2, 4)]
+        # Offset and limit count paths, however many nodes they have
+        self.assertEqual([([node.path for node in page], cursor) for (page, cursor) in pages], [
+            (['a', 'a', 'b', 'b'], 'b'),
+            (['c', 'd'], None),
+            ([], None),
+        ])
 
     def test_expand_view(self):
         self.create_whisper_hosts()
@@ -307,6 +404,28 @@ class MetricsTester(TestCase):
         data = json.loads(response.content)
         self.assertEqual(data['results'], [u''])
 
+        # several queries
+        request = {'query': ['hosts.*', 'hosts.worker1.*', 'hosts.*.*']}
+        response = self.client.post(url, request)
+        data = json.loads(response.content)
+        self.assertEqual(data['results'], [u'hosts.worker1', u'hosts.worker1.cpu', u'hosts.worker2',
+                                           u'hosts.worker2.cpu'])
+
+        request['groupByExpr'] = 1
+        response = self.client.post(url, request)
+        data = json.loads(response.content)
+        self.assertEqual(data['results'], {
+            u'hosts.*': [u'hosts.worker1', u'hosts.worker2'],
+            u'hosts.worker1.*': [u'hosts.worker1.cpu'],
+            u'hosts.*.*': [u'hosts.worker1.cpu', u'hosts.worker2.cpu'],
+        })
+
+        # leavesOnly
+        request = {'query': ['hosts.*', 'hosts.*.*'], 'leavesOnly': 1}
+        response = self.client.post(url, request)
+        data = json.loads(response.content)
+        self.assertEqual(data['results'], [u'hosts.worker1.cpu', u'hosts.worker2.cpu'])
+
     def test_get_metadata_view(self):
         """Stub to test get_metadata_view.  This currently doesn't test a valid key """
         self.create_whisper_hosts()
@@ -321,6 +440,14 @@ class MetricsTester(TestCase):
         data = json.loads(response.content)
         self.assertEqual(data['hosts.worker1.cpu']['error'], "Unexpected error occurred in CarbonLink.get_metadata(hosts.worker1.cpu, a)")
 
+        # bulk, posted as JSON
+        request = {'key': 'a', 'metrics': ['hosts.worker1.cpu', 'hosts.worker2.cpu']}
+        response = self.client.post(url, json.dumps(request), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(sorted(data), ['hosts.worker1.cpu', 'hosts.worker2.cpu'])
+        self.assertEqual(data['hosts.worker2.cpu']['error'], "Unexpected error occurred in CarbonLink.get_metadata(hosts.worker2.cpu, a)")
+
     def test_set_metadata_view(self):
         """Stub to test set_metadata_view.  This currently doesn't test a valid key """
         self.create_whisper_hosts()
@@ -0,0 +1,57 @@
+from django.test import TestCase
+
+from graphite.intervals import Interval, IntervalSet
+from graphite.node import BranchNode, FindResult, LeafNode
+
+
+class IntervalsReader(object):
+    def __init__(self, intervals):
+        self.intervals = intervals
+        self.calls = 0
+
+    def get_intervals(self):
+        self.calls += 1
+        return self.intervals
+
+
+class NodeTest(TestCase):
+
+    def test_lazy_intervals(self):
+        reader = IntervalsReader(IntervalSet([Interval(0, 10)]))
+        node = LeafNode('foo.bar', reader)
+        self.assertEqual(reader.calls, 0)
+        self.assertEqual(node.intervals.size, 10)
+        self.assertEqual(node.intervals.size, 10)
+        self.assertEqual(reader.calls, 1)
+
+
+class FindResultTest(TestCase):
+
+    def nodes(self):
+        return [
+            LeafNode('foo.d', IntervalsReader(IntervalSet([Interval(0, 10), Interval(20, 30)]))),
+            BranchNode('foo.c'),
+            LeafNode('foo.a', IntervalsReader(IntervalSet([]))),
+        ] + [LeafNode('foo.b%d' % i, IntervalsReader(IntervalSet([Interval(i, i + 1)]))) for i in range(8)]
+
+    def test_columns(self):
+        result = FindResult(self.nodes())
+        self.assertEqual(len(result), 11)
+        self.assertEqual(result.paths[:3], ['foo.d', 'foo.c', 'foo.a'])
+        self.assertEqual([result.is_leaf(i) for i in range(3)], [True, False, True])
+        self.assertTrue(result.is_leaf(10))
+        self.assertEqual(result.name(1), 'c')
+        self.assertTrue(result.has_branches())
+        self.assertFalse(FindResult(self.nodes()[:1]).has_branches())
+
+    def test_sort_by_name(self):
+        result = FindResult(self.nodes(), with_intervals=True)
+        result.sort_by_name()
+        self.assertEqual(result.paths[:3], ['foo.a', 'foo.b0', 'foo.b1'])
+        self.assertEqual(result.paths[-2:], ['foo.c', 'foo.d'])
+        self.assertEqual([result.is_leaf(i) for i in range(len(result))], [True] * 9 + [False, True])
+        self.assertEqual(result.intervals(0).intervals, [])
+        self.assertEqual(result.intervals(3).intervals, [Interval(2, 3)])
+        self.assertEqual(result.intervals(10).intervals, [Interval(0, 10), Interval(20, 30)])
+        # Integer timestamps are pickled to peers as such
+        self.assertEqual([type(i.start) for i in result.intervals(10)], [int, int])
@@ -1,3 +1,4 @@
+import bisect
 from datetime import datetime
 import json
 import os
@@ -177,6 +178,55 @@ class RenderTest(TestCase):
         self.assertEqual(hashData(targets, start_time, end_time),
                         hashData(reversed(targets), start_time, end_time))
 
+    def test_hash_request_normalization(self):
+        def make_request(query):
+            request = HttpRequest()
+            request.GET = QueryDict(query)
+            request.POST = QueryDict('')
+            return request
+
+        graphOptions = ('width', 'height')
+
+        # Equivalent relative and absolute times share a key
+        self.assertEqual(hashRequest(make_request('target=a&from=-1h')),
+                         hashRequest(make_request('target=a&from=-60min&until=now')))
+        self.assertEqual(hashRequest(make_request('target=a&from=1465844400&until=1465848000')),
+                         hashRequest(make_request('target=a&from=1465844410&until=1465848030')))
+        self.assertNotEqual(hashRequest(make_request('target=a&from=1465844400&until=1465848000')),
+                            hashRequest(make_request('target=a&from=1465844400&until=1465848060')))
+
+        # Parameters that don't affect the output are ignored
+        self.assertEqual(hashRequest(make_request('target=a&width=100&t=1234'), graphOptions),
+                         hashRequest(make_request('target=a&width=100&t=5678'), graphOptions))
+        self.assertNotEqual(hashRequest(make_request('target=a&width=100'), graphOptions),
+                            hashRequest(make_request('target=a&width=200'), graphOptions))
+        self.assertEqual(hashRequest(make_request('target[]=a&rawData=1'), graphOptions),
+                         hashRequest(make_request('target=a&format=raw'), graphOptions))
+
+        # Target order changes the output
+        self.assertNotEqual(hashRequest(make_request('target=a&target=b')),
+                            hashRequest(make_request('target=b&target=a')))
+
+        # POST parameters override GET ones, as in parseOptions
+        def make_post_request(query, post):
+            request = make_request(query)
+            request.POST = QueryDict(post)
+            return request
+
+        self.assertEqual(hashRequest(make_post_request('target=a&from=-1h', 'from=-2d')),
+                         hashRequest(make_request('target=a&from=-1h&from=-2d')))
+        self.assertNotEqual(hashRequest(make_post_request('target=a&from=-1h', 'from=-2d')),
+                            hashRequest(make_post_request('target=a&from=-2d', 'from=-1h')))
+        self.assertNotEqual(hashRequest(make_post_request('target=a&tz=UTC&from=00:00_20160101', 'tz=Asia/Tokyo')),
+                            hashRequest(make_post_request('target=a&tz=Asia/Tokyo&from=00:00_20160101', 'tz=UTC')))
+
+    def test_hash_data_resolution(self):
+        targets = ['foo=1', 'bar=2']
+        self.assertEqual(hashData(targets, datetime.fromtimestamp(60), datetime.fromtimestamp(1000)),
+                         hashData(targets, datetime.fromtimestamp(119), datetime.fromtimestamp(1019)))
+        self.assertNotEqual(hashData(targets, datetime.fromtimestamp(60), datetime.fromtimestamp(1000)),
+                            hashData(targets, datetime.fromtimestamp(120), datetime.fromtimestamp(1000)))
+
     def test_correct_timezone(self):
         url = reverse('graphite.render.views.renderView')
         response = self.client.get(url, {
@@ -354,6 +404,35 @@ class ConsistentHashRingTest(TestCase):
         node = hashring.get_nodes('hosts.worker1.cpu')
         self.assertEqual(node, [('127.0.0.1', 'cache2'), ('127.0.0.1', 'cache0'), ('127.0.0.1', 'cache1')])
 
+    def walk_ring(self, hashring, key):
+        # Walks the ring one position at a time, up to the one before the start
+        nodes = []
+        position = hashring.compute_ring_position(key)
+        index = bisect.bisect_left(hashring.ring, (position, None)) % hashring.ring_len
+        last_index = (index - 1) % hashring.ring_len
+        while len(nodes) < hashring.nodes_len and index != last_index:
+            node = hashring.ring[index][1]
+            if node not in nodes:
+                nodes.append(node)
+            index = (index + 1) % hashring.ring_len
+        return nodes
+
+    def test_chr_get_nodes_walk(self):
+        keys = ['hosts.worker%d.cpu' % i for i in range(200)]
+        for replica_count in (1, 2, 100):
+            hosts = [("127.0.0.%d" % (i % 3), "cache%d" % i) for i in range(8)]
+            hashring = ConsistentHashRing(hosts, replica_count=replica_count, memo_size=50)
+            for key in keys:
+                self.assertEqual(hashring.get_nodes(key), self.walk_ring(hashring, key))
+
+            # The lookups follow the nodes added and removed
+            hashring.remove_node(hosts[3])
+            hashring.add_node(("127.0.0.9", "cache9"))
+            self.assertEqual(hashring.get_nodes_many(keys), [self.walk_ring(hashring, key) for key in keys])
+
+        hashring = ConsistentHashRing([("127.0.0.1", "cache0")], replica_count=1)
+        self.assertEqual(hashring.get_nodes('hosts.worker1.cpu'), [])
+
 
 class ConsistentHashRingTestFNV1A(TestCase):
     def test_chr_compute_ring_position_fnv1a(self):
@@ -1,6 +1,7 @@
 from django.test import TestCase
 
-from graphite.render.datalib import TimeSeries, nonempty
+from graphite.node import BranchNode
+from graphite.render.datalib import TimeSeries, nonempty, packSeriesList, unpackSeriesList, startFetches
 
 class TimeSeriesTest(TestCase):
 
@@ -48,6 +49,22 @@ class TimeSeriesTest(TestCase):
       series = TimeSeries("collectd.test-db.load.value", 0, len(values), 1, values)
       self.assertEqual(series.getInfo(), {'name': 'collectd.test-db.load.value', 'values': values, 'start': 0, 'step': 1, 'end': len(values)} )
 
+    def test_TimeSeries_pack_floats(self):
+      values = [float(v) for v in range(0,20)] + [None, 1.5, None]
+      series = TimeSeries("collectd.test-db.load.value", 0, len(values), 1, values)
+      series.pathExpression = 'collectd.*.load.value'
+      series.color = 'white'
+      series.consolidate(2)
+      unpacked = unpackSeriesList(packSeriesList([series]))
+      self.assertEqual(unpacked, [series])
+      self.assertEqual(unpacked[0].pathExpression, 'collectd.*.load.value')
+      self.assertEqual(list.__getslice__(unpacked[0], 0, len(values)), values)
+
+    def test_TimeSeries_pack_mixed(self):
+      values = range(0,10) + [None, 'a']
+      series = TimeSeries("collectd.test-db.load.value", 0, len(values), 1, values)
+      self.assertEqual(unpackSeriesList(packSeriesList([series])), [series])
+
     def test_TimeSeries_consolidate(self):
       values = range(0,100)
       series = TimeSeries("collectd.test-db.load.value", 0, len(values)/2, 1, values)
@@ -129,3 +146,25 @@ class DatalibFunctionTest(TestCase):
     def test_nonempty_false_nones(self):
       series = TimeSeries("collectd.test-db.load.value", 0, 4, 1, [None, None, None, None])
       self.assertFalse(nonempty(series))
+
+    def test_startFetches_window(self):
+        started = []
+
+        class Node(object):
+            is_leaf = True
+
+            def __init__(self, path):
+                self.path = path
+
+            def fetch(self, startTime, endTime):
+                started.append(self.path)
+                return self.path
+
+        nodes = [Node('a'), BranchNode('b'), Node('c'), Node('d'), Node('e')]
+        fetches = startFetches(iter(nodes), 0, 60, 2)
+
+        self.assertEqual(next(fetches), (nodes[0], 'a'))
+        self.assertEqual(started, ['a', 'c'])
+        self.assertEqual(next(fetches), (nodes[2], 'c'))
+        self.assertEqual(started, ['a', 'c', 'd'])
+        self.assertEqual([r for (n, r) in fetches], ['d', 'e'])
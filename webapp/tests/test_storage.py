@@ -1,6 +1,17 @@
 import logging
+import os
+import random
+import shutil
+import tempfile
+import time
 
-from graphite.storage import Store
+import whisper
+
+from graphite.finders.standard import StandardFinder
+from graphite.intervals import Interval, IntervalSet
+from graphite.node import BranchNode, LeafNode
+from graphite.readers import MultiReader
+from graphite.storage import FindQuery, Store, select_minimal_nodes
 
 from django.conf import settings
 from django.test import TestCase
@@ -40,3 +51,348 @@ class StorageTest(TestCase):
         # Restore original settings
         settings.CLUSTER_SERVERS = old_cluster_servers
         settings.REMOTE_EXCLUDE_LOCAL = old_remote_exclude_local
+
+
+class CountingFinder:
+    def __init__(self):
+        self.calls = 0
+
+    def find_nodes(self, query):
+        self.calls += 1
+        if not query.pattern.startswith('missing'):
+            yield BranchNode(query.pattern)
+
+
+class IntervalsReader(object):
+    def __init__(self, intervals):
+        self.intervals = intervals
+
+    def get_intervals(self):
+        return self.intervals
+
+
+class StreamingFinder:
+    def __init__(self, nodes, ordered_nodes=False):
+        self.nodes = nodes
+        self.ordered_nodes = ordered_nodes
+        self.found = 0
+
+    def find_nodes(self, query):
+        for node in self.nodes:
+            self.found += 1
+            yield node
+
+
+class StreamingFindTest(TestCase):
+
+    def test_stream(self):
+        full = IntervalSet([Interval(100, 200)])
+        nodes = [
+            LeafNode('foo.a', IntervalsReader(full)),
+            # Duplicates are merged when they add coverage
+            LeafNode('foo.a', IntervalsReader(IntervalSet([Interval(120, 180)]))),
+            BranchNode('foo.b'),
+            BranchNode('foo.b'),
+            LeafNode('foo.c', IntervalsReader(IntervalSet([Interval(100, 150)]))),
+            LeafNode('foo.c', IntervalsReader(IntervalSet([Interval(140, 200)]))),
+            # No data in the requested interval
+            LeafNode('foo.d', IntervalsReader(IntervalSet([Interval(0, 50)]))),
+        ]
+        finder = StreamingFinder(nodes, ordered_nodes=True)
+        store = Store(finders=[finder], hosts=[])
+
+        found = store.find('foo.*', 100, 200, local=True)
+        self.assertTrue(next(found) is nodes[0])
+        self.assertEqual(finder.found, 3)
+        found = list(found)
+        self.assertEqual(found[0], nodes[2])
+        self.assertEqual(len(found), 2)
+        self.assertEqual(found[1].path, 'foo.c')
+        self.assertTrue(isinstance(found[1].reader, MultiReader))
+        self.assertEqual(found[1].reader.nodes, nodes[4:6])
+
+    def test_unordered(self):
+        # Nodes of a same path found apart are still merged
+        nodes = [
+            LeafNode('foo.a', IntervalsReader(IntervalSet([Interval(100, 150)]))),
+            LeafNode('foo.b', IntervalsReader(IntervalSet([Interval(100, 200)]))),
+            LeafNode('foo.a', IntervalsReader(IntervalSet([Interval(140, 200)]))),
+        ]
+        store = Store(finders=[StreamingFinder(nodes)], hosts=[])
+        found = sorted(store.find('foo.*', 100, 200, local=True), key=lambda node: node.path)
+        self.assertEqual([node.path for node in found], ['foo.a', 'foo.b'])
+        self.assertEqual(sorted(found[0].reader.nodes), sorted([nodes[0], nodes[2]]))
+
+
+class ParallelFindTest(TestCase):
+
+    def setUp(self):
+        self._use_worker_pool = settings.USE_WORKER_POOL
+        settings.USE_WORKER_POOL = True
+        self.test_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+
+    def tearDown(self):
+        settings.USE_WORKER_POOL = self._use_worker_pool
+        for test_dir in self.test_dirs:
+            shutil.rmtree(test_dir)
+
+    def test_find(self):
+        for (i, test_dir) in enumerate(self.test_dirs):
+            os.makedirs(os.path.join(test_dir, 'foo'))
+            whisper.create(os.path.join(test_dir, 'foo', 'm%d.wsp' % i), [(1, 60)])
+            whisper.create(os.path.join(test_dir, 'foo', 'shared.wsp'), [(1, 60)])
+
+        finders = [StandardFinder(self.test_dirs), CountingFinder()]
+        store = Store(finders=finders, hosts=[])
+        paths = sorted(node.path for node in store.find('foo.*', local=True))
+        self.assertEqual(paths, ['foo.*', 'foo.m0', 'foo.m1', 'foo.shared'])
+        self.assertEqual(finders[1].calls, 1)
+
+    def test_find_single_finder(self):
+        # A path found in several directories is read from all of them
+        for (i, test_dir) in enumerate(self.test_dirs):
+            os.makedirs(os.path.join(test_dir, 'foo'))
+            whisper.create(os.path.join(test_dir, 'foo', 'a.wsp'), [(1 + i, 60)])
+        whisper.create(os.path.join(self.test_dirs[0], 'foo', 'b.wsp'), [(1, 60)])
+
+        store = Store(finders=[StandardFinder(self.test_dirs)], hosts=[])
+        nodes = list(store.find('foo.*', local=True))
+        self.assertEqual([node.path for node in nodes], ['foo.a', 'foo.b'])
+        self.assertTrue(isinstance(nodes[0].reader, MultiReader))
+        self.assertEqual(sorted(node.reader.fs_path for node in nodes[0].reader.nodes),
+                         [os.path.join(test_dir, 'foo', 'a.wsp') for test_dir in sorted(self.test_dirs)])
+
+        # And their datapoints are merged
+        now = int(time.time())
+        (time_info, values) = nodes[0].fetch(now - 30, now).waitForResults()
+        (start, end, step) = time_info
+        self.assertEqual(step, 1)
+        self.assertEqual(len(values), (end - start) // step)
+
+
+class PaginatedFindTest(TestCase):
+
+    def setUp(self):
+        self.test_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+
+    def tearDown(self):
+        for test_dir in self.test_dirs:
+            shutil.rmtree(test_dir)
+
+    def test_find(self):
+        for (test_dir, names) in zip(self.test_dirs, ['ace', 'bd']):
+            os.makedirs(os.path.join(test_dir, 'foo'))
+            for name in names:
+                whisper.create(os.path.join(test_dir, 'foo', '%s.wsp' % name), [(1, 60)])
+
+        # Finders that do not honor the limit are cut down to it as well
+        finders = [StandardFinder(self.test_dirs), StreamingFinder([BranchNode('foo.z'), BranchNode('foo.0')])]
+        store = Store(finders=finders, hosts=[])
+
+        paths = [node.path for node in store.find('foo.*', local=True, limit=2)]
+        self.assertEqual(paths, ['foo.0', 'foo.a'])
+
+        paths = [node.path for node in store.find('foo.*', local=True, limit=2, cursor='foo.a')]
+        self.assertEqual(paths, ['foo.b', 'foo.c'])
+
+        paths = [node.path for node in store.find('foo.*', local=True, cursor='foo.c')]
+        self.assertEqual(paths, ['foo.d', 'foo.e', 'foo.z'])
+
+
+class LocalFindCacheTest(TestCase):
+
+    def setUp(self):
+        self._settings = (settings.LOCAL_FIND_CACHE_DURATION,
+                          settings.LOCAL_FIND_NEGATIVE_CACHE_DURATION,
+                          settings.LOCAL_FIND_CACHE_CHECK_MTIME)
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        (settings.LOCAL_FIND_CACHE_DURATION,
+         settings.LOCAL_FIND_NEGATIVE_CACHE_DURATION,
+         settings.LOCAL_FIND_CACHE_CHECK_MTIME) = self._settings
+        shutil.rmtree(self.test_dir)
+
+    def test_disabled(self):
+        settings.LOCAL_FIND_CACHE_DURATION = 0
+        settings.LOCAL_FIND_NEGATIVE_CACHE_DURATION = 0
+        finder = CountingFinder()
+        store = Store(finders=[finder], hosts=[])
+        list(store.find('foo.*', local=True))
+        list(store.find('foo.*', local=True))
+        self.assertEqual(finder.calls, 2)
+
+    def test_cached(self):
+        settings.LOCAL_FIND_CACHE_DURATION = 60
+        finder = CountingFinder()
+        store = Store(finders=[finder], hosts=[])
+        first = [node.path for node in store.find('foo.*', 120, 150, local=True)]
+        second = [node.path for node in store.find('foo.*', 130, 170, local=True)]
+        self.assertEqual(first, ['foo.*'])
+        self.assertEqual(first, second)
+        self.assertEqual(finder.calls, 1)
+
+        # A different pattern or time window misses the cache
+        list(store.find('bar.*', 120, 150, local=True))
+        list(store.find('foo.*', 180, 200, local=True))
+        self.assertEqual(finder.calls, 3)
+
+    def test_negative(self):
+        settings.LOCAL_FIND_CACHE_DURATION = 0
+        settings.LOCAL_FIND_NEGATIVE_CACHE_DURATION = 60
+        finder = CountingFinder()
+        store = Store(finders=[finder], hosts=[])
+        self.assertEqual(list(store.find('missing.*', local=True)), [])
+        self.assertEqual(list(store.find('missing.*', local=True)), [])
+        self.assertEqual(finder.calls, 1)
+
+        # Results that matched something are not cached
+        list(store.find('foo.*', local=True))
+        list(store.find('foo.*', local=True))
+        self.assertEqual(finder.calls, 3)
+
+    def test_check_mtime(self):
+        settings.LOCAL_FIND_CACHE_DURATION = 60
+        settings.LOCAL_FIND_CACHE_CHECK_MTIME = True
+        store = Store(finders=[StandardFinder([self.test_dir])], hosts=[])
+        os.makedirs(os.path.join(self.test_dir, 'foo'))
+        whisper.create(os.path.join(self.test_dir, 'foo', 'a.wsp'), [(1, 60)])
+
+        paths = [node.path for node in store.find('foo.*', local=True)]
+        self.assertEqual(paths, ['foo.a'])
+
+        # Adding a metric changes the directory mtime and invalidates the entry
+        os.utime(os.path.join(self.test_dir, 'foo'), (0, 0))
+        whisper.create(os.path.join(self.test_dir, 'foo', 'b.wsp'), [(1, 60)])
+        paths = sorted(node.path for node in store.find('foo.*', local=True))
+        self.assertEqual(paths, ['foo.a', 'foo.b'])
+
+        # Empty results are invalidated by changes to the pattern's prefix
+        settings.LOCAL_FIND_NEGATIVE_CACHE_DURATION = 60
+        self.assertEqual(list(store.find('foo.c', local=True)), [])
+        os.utime(os.path.join(self.test_dir, 'foo'), (0, 0))
+        whisper.create(os.path.join(self.test_dir, 'foo', 'c.wsp'), [(1, 60)])
+        paths = [node.path for node in store.find('foo.c', local=True)]
+        self.assertEqual(paths, ['foo.c'])
+
+
+class FakeLeafNode(object):
+    is_leaf = True
+
+    def __init__(self, intervals, local):
+        self.intervals = intervals
+        self.local = local
+
+
+def reference_minimal_nodes(leaf_nodes, query, now):
+    # The greedy selection Store.find used to run, with ties going to the
+    # earliest node
+    minimal_node_set = set()
+    covered_intervals = IntervalSet([])
+
+    tolerance_window = now - settings.FIND_TOLERANCE
+    disregard_tolerance_window = query.interval.start < tolerance_window
+    prior_to_window = Interval(float('-inf'), tolerance_window)
+
+    def measure_of_added_coverage(node, drop_window=disregard_tolerance_window):
+        relevant_intervals = node.intervals.intersect_interval(query.interval)
+        if drop_window:
+            relevant_intervals = relevant_intervals.intersect_interval(prior_to_window)
+        return covered_intervals.union(relevant_intervals).size - covered_intervals.size
+
+    nodes_remaining = list(leaf_nodes)
+
+    for node in leaf_nodes:
+        if node.local and measure_of_added_coverage(node, False) > 0:
+            nodes_remaining.remove(node)
+            minimal_node_set.add(node)
+            covered_intervals = covered_intervals.union(node.intervals)
+
+    if settings.REMOTE_STORE_MERGE_RESULTS:
+        for node in [n for n in nodes_remaining if not n.local]:
+            minimal_node_set.add(node)
+    else:
+        while nodes_remaining:
+            node_coverages = [(measure_of_added_coverage(n), n) for n in nodes_remaining]
+            best_coverage, best_node = max(node_coverages, key=lambda c: c[0])
+            if best_coverage == 0:
+                break
+
+            nodes_remaining.remove(best_node)
+            minimal_node_set.add(best_node)
+            covered_intervals = covered_intervals.union(best_node.intervals)
+
+        if not minimal_node_set:
+            def distance_to_requested_interval(node):
+                latest = sorted(node.intervals, key=lambda i: i.end)[-1]
+                distance = query.interval.start - latest.end
+                return distance if distance >= 0 else float('inf')
+
+            best_candidate = min(leaf_nodes, key=distance_to_requested_interval)
+            if distance_to_requested_interval(best_candidate) <= settings.FIND_TOLERANCE:
+                minimal_node_set.add(best_candidate)
+
+    return minimal_node_set
+
+
+class MinimalNodesTest(TestCase):
+
+    def setUp(self):
+        self._merge_results = settings.REMOTE_STORE_MERGE_RESULTS
+
+    def tearDown(self):
+        settings.REMOTE_STORE_MERGE_RESULTS = self._merge_results
+
+    def random_nodes(self, rng, now):
+        nodes = []
+        for i in range(rng.randint(1, 8)):
+            intervals = []
+            start = now - rng.randint(0, 2000)
+            for j in range(rng.randint(1, 4)):
+                end = start + rng.randint(1, 600)
+                intervals.append(Interval(start, end))
+                start = end + rng.randint(-100, 400)
+            intervals.sort()
+            nodes.append(FakeLeafNode(IntervalSet(intervals), rng.random() < 0.3))
+        return nodes
+
+    def random_query(self, rng, now):
+        start = rng.choice([None, now - rng.randint(0, 2500)])
+        end = rng.choice([None, now - rng.randint(-100, 1000)])
+        if start is not None and end is not None and end < start:
+            start, end = end, start
+        return FindQuery('foo', start, end)
+
+    def test_against_reference(self):
+        rng = random.Random(42)
+        now = 1000000
+        for merge_results in (False, True):
+            settings.REMOTE_STORE_MERGE_RESULTS = merge_results
+            for i in range(2000):
+                nodes = self.random_nodes(rng, now)
+                query = self.random_query(rng, now)
+                expected = reference_minimal_nodes(nodes, query, now)
+                selected = select_minimal_nodes(nodes, query, now)
+                self.assertEqual(len(selected), len(set(selected)))
+                self.assertEqual(set(selected), expected, (i, nodes, query))
+
+    def test_prefers_local(self):
+        settings.REMOTE_STORE_MERGE_RESULTS = False
+        now = 1000000
+        remote = FakeLeafNode(IntervalSet([Interval(now - 1000, now)]), False)
+        local = FakeLeafNode(IntervalSet([Interval(now - 500, now)]), True)
+        query = FindQuery('foo', now - 1000, now)
+        self.assertEqual(select_minimal_nodes([remote, local], query, now), [local, remote])
+        self.assertEqual(select_minimal_nodes([local], query, now), [local])
+
+    def test_lone_local_node(self):
+        now = 1000000
+        local = FakeLeafNode(IntervalSet([Interval(now - 500, now)]), True)
+        empty = FakeLeafNode(IntervalSet([]), True)
+        self.assertEqual(select_minimal_nodes([local], FindQuery('foo', None, None), now), [local])
+        self.assertEqual(select_minimal_nodes([local], FindQuery('foo', now - 100, None), now), [local])
+
+        # Like any other, it is left out when it has no data for the query
+        self.assertEqual(select_minimal_nodes([empty], FindQuery('foo', None, None), now), [])
+        query = FindQuery('foo', now - 1000000, now - 100000)
+        self.assertEqual(select_minimal_nodes([local], query, now), [])
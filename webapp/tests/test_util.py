@@ -1,5 +1,8 @@
+import mock
 import os
+import pickle
 import shutil
+import tempfile
 import time
 import whisper
 
@@ -98,6 +101,64 @@ class UtilTest(TestCase):
         self.assertEqual(None, util.write_index() )
         self.assertEqual(None, util.write_index(settings.WHISPER_DIR, settings.CERES_DIR, settings.INDEX_FILE) )
 
+        whisper.create(os.path.join(settings.WHISPER_DIR, 'top.wsp'), [(1, 60)])
+        self.addCleanup(os.remove, os.path.join(settings.WHISPER_DIR, 'top.wsp'))
+        util.write_index()
+        with open(settings.INDEX_FILE) as index_file:
+            self.assertEqual(index_file.read().splitlines(),
+                             ['hosts.worker1.cpu', 'hosts.worker2.cpu', 'top'])
+
+    def test_write_index_incremental(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        (whisper_dir, ceres_dir) = (os.path.join(test_dir, 'whisper'), os.path.join(test_dir, 'ceres'))
+        index = os.path.join(test_dir, 'index')
+        for path in ('whisper/a/b/cpu.wsp', 'whisper/a/c/cpu.wsp', 'whisper/top.wsp', 'ceres/x/y/.ceres-node'):
+            path = os.path.join(test_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+        def age(path):
+            # Directories modified within the last second are always listed
+            os.utime(os.path.join(test_dir, path), (time.time() - 60, time.time() - 60))
+
+        def build(**kwargs):
+            with mock.patch('graphite.util.list_dir', side_effect=util.list_dir) as list_dir:
+                util.write_index(whisper_dir, ceres_dir, index, **kwargs)
+            with open(index) as index_file:
+                lines = index_file.read().splitlines()
+            return (lines, sorted(os.path.relpath(call[0][0], test_dir) for call in list_dir.call_args_list))
+
+        for path in ('whisper', 'whisper/a', 'whisper/a/b', 'whisper/a/c', 'ceres', 'ceres/x', 'ceres/x/y'):
+            age(path)
+        expected = ['a.b.cpu', 'a.c.cpu', 'top', 'x.y']
+        self.assertEqual(build(), (expected, ['ceres', 'ceres/x', 'ceres/x/y',
+                                              'whisper', 'whisper/a', 'whisper/a/b', 'whisper/a/c']))
+        self.assertTrue(os.path.exists(index + '.manifest'))
+        self.assertEqual(build(), (expected, []))
+
+        open(os.path.join(test_dir, 'whisper/a/b/mem.wsp'), 'w').close()
+        shutil.rmtree(os.path.join(test_dir, 'whisper/a/c'))
+        age('whisper/a/b')
+        age('whisper/a')
+        self.assertEqual(build(), (['a.b.cpu', 'a.b.mem', 'top', 'x.y'], ['whisper/a', 'whisper/a/b']))
+        self.assertEqual(build(incremental=False)[1], ['ceres', 'ceres/x', 'ceres/x/y', 'whisper', 'whisper/a', 'whisper/a/b'])
+
+        # Recently modified directories are listed again next time
+        open(os.path.join(test_dir, 'whisper/new.wsp'), 'w').close()
+        self.assertEqual(build(), (['a.b.cpu', 'a.b.mem', 'new', 'top', 'x.y'], ['whisper']))
+        self.assertEqual(build()[1], ['whisper'])
+
+        # Broken or unsafe manifests are ignored and the index built again
+        everything = ['ceres', 'ceres/x', 'ceres/x/y', 'whisper', 'whisper/a', 'whisper/a/b']
+        with open(index + '.manifest', 'rb') as manifest_file:
+            manifest = manifest_file.read()
+        for broken in (manifest[:len(manifest) // 2], 'garbage', pickle.dumps(os.system), pickle.dumps([1])):
+            with open(index + '.manifest', 'wb') as manifest_file:
+                manifest_file.write(broken)
+            self.assertEqual(build(), (['a.b.cpu', 'a.b.mem', 'new', 'top', 'x.y'], everything))
+
     def test_load_module(self):
         with self.assertRaises(IOError):
             module = util.load_module('test', member=None)
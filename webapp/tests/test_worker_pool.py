@@ -0,0 +1,94 @@
+import threading
+
+from django.conf import settings
+from django.test import TestCase
+
+from graphite.worker_pool.pool import Job, PoolTimeoutError, get_pool, pool_exec
+
+
+class PoolTest(TestCase):
+
+    def setUp(self):
+        self._use_worker_pool = settings.USE_WORKER_POOL
+        settings.USE_WORKER_POOL = True
+
+    def tearDown(self):
+        settings.USE_WORKER_POOL = self._use_worker_pool
+
+    def test_pool_exec(self):
+        jobs = [Job(lambda x: x * 2, 'double %d' % i, i) for i in range(10)]
+        results = [job.get_result() for job in pool_exec(get_pool(), jobs)]
+        self.assertEqual(sorted(results), [i * 2 for i in range(10)])
+
+    def test_concurrent(self):
+        # Both jobs must run at the same time for either to finish
+        barrier = threading.Semaphore(0)
+
+        def meet():
+            barrier.release()
+            barrier.acquire()
+            return True
+
+        jobs = [Job(meet, 'meet'), Job(meet, 'meet')]
+        results = [job.get_result() for job in pool_exec(get_pool('test', 2), jobs, 5)]
+        self.assertEqual(results, [True, True])
+
+    def test_exception(self):
+        def fail():
+            raise ValueError('failed')
+
+        jobs = [Job(fail, 'fail'), Job(int, 'int', '1')]
+        results = {}
+        for job in pool_exec(get_pool(), jobs):
+            results[str(job)] = job
+        self.assertEqual(results['int'].get_result(), 1)
+        self.assertRaises(ValueError, results['fail'].get_result)
+
+    def test_timeout(self):
+        event = threading.Event()
+        jobs = [Job(event.wait, 'wait', 5), Job(event.wait, 'wait', 5)]
+        try:
+            with self.assertRaises(PoolTimeoutError):
+                list(pool_exec(get_pool(), jobs, 0.01))
+        finally:
+            event.set()
+
+    def test_nested(self):
+        # Jobs started from a pool thread run inline instead of waiting on
+        # the pool they are occupying
+        pool = get_pool('nested', 1)
+
+        def outer():
+            inner = [Job(threading.current_thread, 'inner') for i in range(2)]
+            return [job.get_result() for job in pool_exec(pool, inner)]
+
+        jobs = [Job(outer, 'outer'), Job(threading.current_thread, 'other')]
+        for job in pool_exec(pool, jobs, 5):
+            if str(job) == 'outer':
+                self.assertEqual(len(set(job.get_result())), 1)
+
+    def test_nested_other_pool(self):
+        # Jobs started from a pool thread on another pool run concurrently
+        barrier = threading.Semaphore(0)
+
+        def meet():
+            barrier.release()
+            barrier.acquire()
+            return True
+
+        def outer():
+            inner = [Job(meet, 'meet'), Job(meet, 'meet')]
+            return [job.get_result() for job in pool_exec(get_pool('inner', 2), inner, 5)]
+
+        jobs = [Job(outer, 'outer'), Job(int, 'int', '1')]
+        for job in pool_exec(get_pool('outer', 1), jobs, 5):
+            if str(job) == 'outer':
+                self.assertEqual(job.get_result(), [True, True])
+
+    def test_disabled(self):
+        settings.USE_WORKER_POOL = False
+        self.assertEqual(get_pool(), None)
+
+        jobs = [Job(threading.current_thread, 'thread %d' % i) for i in range(3)]
+        results = [job.get_result() for job in pool_exec(get_pool(), jobs)]
+        self.assertEqual(results, [threading.current_thread()] * 3)